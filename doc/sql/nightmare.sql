@@ -70,7 +70,8 @@ CREATE TABLE `crashes` (
   `total_samples` int(11) NOT NULL,
   `additional` mediumtext,
   `crash_hash` varchar(48),
-  PRIMARY KEY (`crash_id`)
+  PRIMARY KEY (`crash_id`),
+  KEY `idx_crashes_hash` (`project_id`,`crash_hash`)
 ) ENGINE=InnoDB AUTO_INCREMENT=826 DEFAULT CHARSET=latin1;
 /*!40101 SET character_set_client = @saved_cs_client */;
 
@@ -151,6 +152,8 @@ CREATE TABLE `projects` (
   `enabled` tinyint(1) DEFAULT '1',
   `archived` tinyint(1) DEFAULT '1',
   `ignore_duplicates` tinyint(1) DEFAULT '0',
+  `priority` int(11) NOT NULL DEFAULT '1',
+  `job_ttr` int(11) NOT NULL DEFAULT '0',
   PRIMARY KEY (`project_id`)
 ) ENGINE=InnoDB AUTO_INCREMENT=25 DEFAULT CHARSET=latin1;
 /*!40101 SET character_set_client = @saved_cs_client */;
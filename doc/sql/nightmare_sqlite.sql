@@ -67,7 +67,9 @@ CREATE TABLE `projects` (
   `maximum_iteration` int(11) NOT NULL DEFAULT '1000000',
   `enabled` tinyint(1) DEFAULT '1',
   `archived` tinyint(1) DEFAULT '1',
-  `ignore_duplicates` tinyint(1) DEFAULT '0'
+  `ignore_duplicates` tinyint(1) DEFAULT '0',
+  `priority` int(11) NOT NULL DEFAULT '1',
+  `job_ttr` int(11) NOT NULL DEFAULT '0'
 );
 CREATE TABLE `samples` (
   `sample_id` INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -112,5 +114,6 @@ INSERT INTO "sqlite_sequence" VALUES('config',11);
 
 CREATE UNIQUE INDEX `project_id` on project_engines (`project_id`,`mutation_engine_id`);
 CREATE UNIQUE INDEX idx_uq_config_name on config (`name`);
+CREATE INDEX idx_crashes_hash on crashes (`project_id`,`crash_hash`);
 
 COMMIT;
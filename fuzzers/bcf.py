@@ -12,7 +12,6 @@ generate "stellar" results.
 import os
 import sys
 import time
-import shutil
 import random
 import ConfigParser
 import simplejson as json
@@ -31,6 +30,11 @@ sys.path.append(tmp_path)
 from nfp_log import log, debug
 from nfp_coverage import BININST_AVAILABLE_TOOLS
 from nfp_process import RETURN_SIGNALS
+from nfp_limits import read_resource_limits, set_default_limits
+from nfp_affinity import get_affinity_planner, set_affinity
+from nfp_timeout import read_timeout_calibrator
+from nfp_input import CInputDelivery, DEFAULT_INPUT_MODE, DEFAULT_INPUT_PATH, \
+                      build_command
 
 #-----------------------------------------------------------------------
 class CBlindCoverageFuzzer:
@@ -43,6 +47,8 @@ class CBlindCoverageFuzzer:
     self.section = section
     self.metrics = 10
     self.bininst_tool=None
+    self.limits = None
+    self.calibrator = None
 
     self.mgr = Manager()
     self.stats = self.mgr.dict()
@@ -62,6 +68,13 @@ class CBlindCoverageFuzzer:
       log("The number of processes is bigger than the number of metrics, adjusting it to %d" % self.procs)
       self.metrics = self.procs
 
+    # CPUs of every process recording metrics, the fuzzer itself uses the
+    # first ones. None if they aren't pinned.
+    self.cpus = None
+    planner = get_affinity_planner()
+    if planner is not None:
+      self.cpus = planner.plan(self.procs)
+
     # Default output directory is current path
     self.output = "."
     self.input_file = None
@@ -80,6 +93,7 @@ class CBlindCoverageFuzzer:
     self.max_generations = 10
     
     self.bugs = 0
+    self.input = None
 
   def read_configuration(self):
     if not os.path.exists(self.cfg):
@@ -93,6 +107,12 @@ class CBlindCoverageFuzzer:
     self.read_bininst_configuration(parser)
     self.read_fuzzer_configuration(parser)
 
+    # Calibrated apart from the other fuzzers, the overhead of the
+    # binary instrumentation toolkit is very different
+    name = "%s:%s" % (self.section, self.bininst_tool)
+    self.calibrator = read_timeout_calibrator(parser, self.section, self.cfg,
+                                              name, self.timeout, self.calibrator)
+
   def read_fuzzer_configuration(self, parser):
     """ Read this specific fuzzer additional configuration options from 
         the config file instead of adding a gazilion command line
@@ -235,18 +255,53 @@ class CBlindCoverageFuzzer:
     except:
       self.non_uniques = False
 
-  def record_metric(self, input_file, l):
+    try:
+      self.input_mode = parser.get(self.section, 'input-mode')
+    except:
+      self.input_mode = DEFAULT_INPUT_MODE
+
+    try:
+      self.input_path = parser.get(self.section, 'input-path')
+    except:
+      self.input_path = DEFAULT_INPUT_PATH
+
+    # Applied to every target launched by the coverage tools
+    self.limits = read_resource_limits(parser, self.section, self.limits)
+    set_default_limits(self.limits)
+
+  def get_input(self):
+    """ Return the delivery of the mutated test cases, created again if
+        its configuration changed. """
+    if self.input is not None:
+      if self.input.mode == self.input_mode and \
+         self.input.extension == self.extension and \
+         self.input.path == self.input_path:
+        return self.input
+      self.input.close()
+
+    self.input = CInputDelivery(self.input_mode, self.extension, self.input_path)
+    return self.input
+
+  def get_timeout(self):
+    """ Return the calibrated timeout, if enabled, or the configured one. """
+    if self.calibrator is not None:
+      return self.calibrator.get_timeout()
+    return self.timeout
+
+  def record_metric(self, input_file, l, cpus=None):
+    """ Record the coverage of the target with @input_file, None meaning
+        it's given in the standard input. """
+    if cpus is not None:
+      set_affinity(cpus)
+
     cov_tool = BININST_AVAILABLE_TOOLS[self.bininst_tool](self.bininst_path, self.arch)
-    if input_file.find(" ") and not input_file.startswith('"'):
+    if input_file is not None and input_file.find(" ") and not input_file.startswith('"'):
       input_file = '"%s"' % input_file
 
-    if self.command.find("@@") > -1:
-      cmd_line = self.command.replace("@@", input_file)
-    else:
-      cmd_line = "%s %s" % (self.command, input_file)
+    cmd_line = build_command(self.command, input_file)
 
     #log("Launching command %s" % cmd_line)
-    cov_data = cov_tool.coverage(command=cmd_line, timeout=self.timeout, hide_output=self.hide_output)
+    cov_data = cov_tool.coverage(command=cmd_line, timeout=self.get_timeout(), hide_output=self.hide_output)
     l.append(cov_data)
 
   def record_metrics(self, input_file):    
@@ -255,7 +310,10 @@ class CBlindCoverageFuzzer:
 
     procs = []
     for i in range(self.metrics):
-      p = Process(target=self.record_metric, args=(input_file, metrics_data))
+      cpus = None
+      if self.cpus is not None:
+        cpus = self.cpus[i % self.procs]
+      p = Process(target=self.record_metric, args=(input_file, metrics_data, cpus))
       p.start()
       procs.append(p)
 
@@ -514,21 +572,39 @@ class CBlindCoverageFuzzer:
     # Get mutated data using @template as the template buffer.
     offset, size, buf = self.mutate(template)
 
-    filename = mktemp(suffix = self.extension)
-    debug("Creating temporary file %s" % filename)
-    with open(filename, "wb") as f:
-      f.write(buf)
+    data_input = self.get_input()
+    data_input.write(buf)
 
     debug("Performing code coverage...")
     metrics = []
-    self.record_metric(filename, metrics)
+    timeout = self.get_timeout()
+    data_input.redirect_stdin()
+    try:
+      start = time.time()
+      self.record_metric(data_input.get_path(), metrics)
+      elapsed = time.time() - start
+    finally:
+      data_input.restore_stdin()
+
+    if self.calibrator is not None and \
+       (self.limits is None or self.limits.last_outcome is None):
+      self.calibrator.add(elapsed, elapsed >= timeout)
 
     for metric in metrics:
+      if self.limits is not None and self.limits.last_outcome is not None:
+        # Killed by a resource limit (already reported), the coverage is
+        # partial and it isn't a bug
+        self.discard_bytes(offset, size, buf)
+        self.generation_value -= 1
+        continue
+
       bbs = int(metric.unique_bbs)
       if False and len(metric.all_unique_bbs-self.stats["all"])>0:
         if len(self.stats["all"])==0:
           log("=+= Found yet unseen basic block! Saving to templates.")
-          shutil.copyfile(filename,os.path.join(self.templates_path,os.path.basename(filename)))
+          filename = "%s%s" % (sha1(buf).hexdigest(), self.extension)
+          with open(os.path.join(self.templates_path, filename), "wb") as f:
+            f.write(buf)
 
         self.stats["all"]=self.stats["all"] | metric.all_unique_bbs
 
@@ -569,16 +645,12 @@ class CBlindCoverageFuzzer:
         ret = metric.exit_code
         if RETURN_SIGNALS[ret] != "SIGTERM":
           log("*** Found a BUG, caught signal %d (%s), hurra!" % (ret, RETURN_SIGNALS[ret]))
-          self.dump_poc(filename, offset, size, buf)
+          self.dump_poc(data_input.get_path(), offset, size, buf)
           self.bugs += 1
         else:
-          log("*** Target received signal SIGTERM. Bug found or the box is running out of resources...")
-          log("Waiting for at least 1 minute...")
-          time.sleep(60)
-          log("Resuming...")
-
-    debug("Removing test-case %s" % filename)
-    os.remove(filename)
+          # Resource exhaustion is reported by the resource limits, this
+          # is usually the timeout
+          log("*** Target received signal SIGTERM, it was probably killed after the timeout")
 
   def show_generation(self, i):
     line = "Iteration %d, current generation value %d, total generation(s) preserved %d"
@@ -618,6 +690,10 @@ class CBlindCoverageFuzzer:
       self.template = bytearray(open(input_file, "rb").read())
       self.lock = Lock()
 
+    if self.cpus is not None:
+      # The coverage of every mutation is recorded from this process
+      set_affinity(self.cpus[0])
+
     if max_iterations != 0:
       log("Maximizing file in %d iteration(s)" % max_iterations)
     else:
@@ -627,23 +703,31 @@ class CBlindCoverageFuzzer:
       self.radamsa = True
 
     i = 0
-    while 1:
-      # Re-read the configuration on each try
-      self.read_configuration()
-
-      if max_iterations != 0 and i > max_iterations:
-        break
-
-      if self.generation_value < self.generation_bottom_level and len(self.generations) > 0:
-        log("Dropping current generation and statistics as we have too many bad results")
-        self.template, self.stats, self.generation_value = self.generations.pop()
-        self.print_statistics()
-        self.show_generation(i)
-      self.fuzz_one(self.template)
-      i += 1
-
-      if (i % 10 == 0 and max_iterations != 0) or i % 100 == 0:
-        self.show_generation(i)
+    try:
+      while 1:
+        # Re-read the configuration on each try
+        self.read_configuration()
+
+        if max_iterations != 0 and i > max_iterations:
+          break
+
+        if self.generation_value < self.generation_bottom_level and len(self.generations) > 0:
+          log("Dropping current generation and statistics as we have too many bad results")
+          self.template, self.stats, self.generation_value = self.generations.pop()
+          self.print_statistics()
+          self.show_generation(i)
+        self.fuzz_one(self.template)
+        i += 1
+
+        if (i % 10 == 0 and max_iterations != 0) or i % 100 == 0:
+          self.show_generation(i)
+    finally:
+      if self.input is not None:
+        self.input.close()
+      if self.limits is not None:
+        self.limits.close()
+      if self.calibrator is not None:
+        self.calibrator.close()
 
     # Return the maximized file
     return self.template
@@ -0,0 +1,104 @@
+/*
+ * libfork_server.so version 0.0.1
+ * Copyright (c) Joxean Koret
+ *
+ * Fork server for the generic fuzzer. The target is stopped right before
+ * calling main, after the dynamic linking and its static initialization,
+ * and then a new child is forked every time the fuzzer asks for it. The
+ * fuzzer only pays the cost of a fork() per sample instead of a full
+ * execve() plus the target's initialization.
+ *
+ * Protocol, all the values are 4 bytes in the native byte order:
+ *
+ *  - The server writes a hello message in the status fd.
+ *  - The fuzzer writes any value in the control fd to run a new child.
+ *  - The server writes the child's pid and, after it finishes, the
+ *    waitpid() status in the status fd.
+ *
+ * If the status fd isn't open the target just runs normally.
+ *
+*/
+#include <stdlib.h>
+#include <unistd.h>
+#include <dlfcn.h>
+#include <sys/types.h>
+#include <sys/wait.h>
+
+//----------------------------------------------------------------------
+#define NFPAPI extern "C"
+
+// The same file descriptors used by the fuzzer (see nfp_forkserver.py)
+#define FORKSRV_FD 198
+#define FORKSRV_CTL_FD FORKSRV_FD
+#define FORKSRV_ST_FD (FORKSRV_FD + 1)
+#define FORKSRV_HELLO 0x4E465053
+
+//----------------------------------------------------------------------
+typedef int (*main_func_t)(int, char **, char **);
+typedef int (*libc_start_main_t)(main_func_t, int, char **, void (*)(void),
+                                 void (*)(void), void (*)(void), void *);
+
+//----------------------------------------------------------------------
+static main_func_t g_main = NULL;
+
+//----------------------------------------------------------------------
+// Returns in the forked children, the server itself never returns when
+// the fuzzer is listening.
+static void fork_server(void)
+{
+  unsigned int hello = FORKSRV_HELLO;
+  unsigned int cmd;
+  int status;
+  pid_t pid;
+
+  if ( write(FORKSRV_ST_FD, &hello, 4) != 4 )
+    return;
+
+  while ( 1 )
+  {
+    // The fuzzer finished or died
+    if ( read(FORKSRV_CTL_FD, &cmd, 4) != 4 )
+      _exit(0);
+
+    pid = fork();
+    if ( pid < 0 )
+      _exit(1);
+
+    if ( pid == 0 )
+    {
+      close(FORKSRV_CTL_FD);
+      close(FORKSRV_ST_FD);
+      return;
+    }
+
+    if ( write(FORKSRV_ST_FD, &pid, 4) != 4 )
+      _exit(1);
+
+    if ( waitpid(pid, &status, 0) < 0 )
+      _exit(1);
+
+    if ( write(FORKSRV_ST_FD, &status, 4) != 4 )
+      _exit(1);
+  }
+}
+
+//----------------------------------------------------------------------
+static int fork_server_main(int argc, char **argv, char **envp)
+{
+  fork_server();
+  return g_main(argc, argv, envp);
+}
+
+//----------------------------------------------------------------------
+// Replace the target's main with our own before glibc calls it.
+NFPAPI int __libc_start_main(main_func_t main, int argc, char **argv,
+                             void (*init)(void), void (*fini)(void),
+                             void (*rtld_fini)(void), void *stack_end)
+{
+  libc_start_main_t real_start_main;
+
+  real_start_main = (libc_start_main_t)dlsym(RTLD_NEXT, "__libc_start_main");
+  g_main = main;
+  return real_start_main(fork_server_main, argc, argv, init, fini,
+                         rtld_fini, stack_end);
+}
@@ -13,9 +13,6 @@ processes, debug them, restart them and launching clients against it.
 import os
 import sys
 import time
-import json
-import base64
-import tempfile
 import ConfigParser
 
 from multiprocessing import Process, Queue
@@ -126,12 +123,25 @@ class CClientServerFuzzer(CGenericFuzzer):
     value = self.q.stats_tube(self.tube_name)["current-jobs-ready"]
     debug("Total of %d job(s) in queue" % value)
     job = self.q.reserve()
-    buf, temp_file = json.loads(job.body)
-    buf = base64.b64decode(buf)
-    log("Launching sample %s..." % os.path.basename(temp_file))
+    self.lease_jobs([job])
+    buf, temp_file, diff = self.read_sample(job)
+
+    # Created by fuzz(), shared by every client process
+    data_input = self.input
+    if buf is None:
+      # The engine's file is in this same box, use it if it can be linked
+      if not data_input.link(temp_file):
+        data_input.write(file(temp_file, "rb").read())
+    else:
+      data_input.write(buf)
+    cmd = data_input.get_command(self.client_command)
+    log("Launching sample with command %s..." % cmd)
 
-    cmd = "%s %s" % (self.client_command, temp_file)
-    ret = os.system(cmd)
+    data_input.redirect_stdin()
+    try:
+      ret = os.system(cmd)
+    finally:
+      data_input.restore_stdin()
     crash_info = None
     try:
       crash_info = shared_queue.get(timeout=1)
@@ -141,43 +151,54 @@ class CClientServerFuzzer(CGenericFuzzer):
     if crash_info is not None:
       log("We have a crash, moving to %s queue..." % self.crash_tube)
       crash = crash_info
-      d = {temp_file:crash_info}
-      self.crash_q.put(json.dumps(d))
+      self.crash_q.put(self.get_crash_job(crash_info, buf, temp_file, diff))
       self.crash_info = None
 
       log("$PC 0x%08x Signal %s Exploitable %s " % (crash["pc"], crash["signal"], crash["exploitable"]))
       if crash["disasm"] is not None:
         log("%08x: %s" % (crash["disasm"][0], crash["disasm"][1]))
-    else:
-      file_delete = os.path.basename(temp_file)
-      self.delete_q.put(str(file_delete))
+    elif temp_file is not None:
+      # The client process finishes after this job, don't keep it
+      self.queue_delete(temp_file)
+      self.flush_deletes()
     
     if self.cleanup is not None:
       debug("Running clean-up command %s" % self.cleanup)
       os.system(self.cleanup)
       debug("Done")
-    job.delete()
+
+    # Delete it with the locked connection, it may be being touched
+    self.q.delete_many(self.release_jobs([job]))
 
   def fuzz(self):
     log("Launching client/server fuzzer, listening in tube %s" % self.tube_name)
     self.shared_queue = Queue()
-    while 1:
-      self.crash_info = None
-      log("Launching server with command %s" % self.command)
-      self.p = Process(target=self.debug_server, args=(self.shared_queue,))
-      self.p.start()
-      self.p.join(10)
-
-      while self.p.is_alive():
-        log("Running client")
-        client = Process(target=self.launch_client, args=(self.shared_queue,))
-        client.start()
-        client.join()
-
-      if self.crash_info is not None:
-        log("Server crashed, yuppie!")
-      else:
-        log("Server exited...")
+    try:
+      while 1:
+        self.crash_info = None
+        log("Launching server with command %s" % self.command)
+        self.p = Process(target=self.debug_server, args=(self.shared_queue,))
+        self.p.start()
+        self.p.join(10)
+
+        while self.p.is_alive():
+          # Opened here and inherited by the client processes, so the
+          # test cases are always delivered in the same place.
+          self.read_configuration()
+          self.get_input().open()
+
+          log("Running client")
+          client = Process(target=self.launch_client, args=(self.shared_queue,))
+          client.start()
+          client.join()
+
+        if self.crash_info is not None:
+          log("Server crashed, yuppie!")
+        else:
+          log("Server exited...")
+    finally:
+      if self.input is not None:
+        self.input.close()
 
 #-----------------------------------------------------------------------
 def main(cfg, fuzzer):
@@ -8,9 +8,8 @@ Generic application fuzzer
 
 import os
 import sys
-import json
-import base64
-import tempfile
+import time
+import random
 import ConfigParser
 
 from multiprocessing import Process, cpu_count
@@ -22,7 +21,18 @@ import config
 
 from nfp_log import log, debug
 from nfp_queue import get_queue
-from nfp_process import process_manager
+from nfp_lease import CLeaseManager
+from nfp_queue_local import DEFAULT_TTR
+from nfp_frame import decode_sample_job, is_seeded_sample, encode_crash, \
+                      encode_deletes, decode_header, is_local_sample
+from nfp_mutators import CSeededSamples
+from nfp_process import process_manager, RETURN_SIGNALS
+from nfp_forkserver import CForkServer, CForkServerError, CForkServerStartError
+from nfp_limits import read_resource_limits, set_default_limits
+from nfp_timeout import read_timeout_calibrator, CALIBRATION_SAMPLES
+from nfp_input import CInputDelivery, DEFAULT_INPUT_MODE, DEFAULT_INPUT_PATH, \
+                      build_command
+from lib.crash_data import CCrashData
 
 try:
   from lib.interfaces import vtrace_iface, gdb_iface, asan_iface, pykd_iface
@@ -31,11 +41,21 @@ except ImportError:
   from lib.interfaces import vtrace_iface, gdb_iface, asan_iface
   has_pykd = False
 
+#-----------------------------------------------------------------------
+# Maximum number of sample files to remove put in a single delete job and
+# maximum number of seconds to keep them before putting the job.
+DELETE_BATCH_SIZE = 50
+DELETE_FLUSH_INTERVAL = 5
+
 #-----------------------------------------------------------------------
 class CGenericFuzzer:
   def __init__(self, cfg, section):
     self.cfg = cfg
     self.section = section
+    self.limits = None
+    self.calibrator = None
+    # Set when the target can't start the fork server
+    self.fork_server_failed = False
     self.read_configuration()
   
     self.q = get_queue(name=self.tube_name, watch=True)
@@ -43,6 +63,13 @@ class CGenericFuzzer:
     self.crash_q = get_queue(name=self.crash_tube, watch=False)
 
     self.crash_info = None
+    self.seeded_samples = None
+    self.leases = None
+    self.fork_server = None
+    self.input = None
+
+    self.pending_deletes = []
+    self.last_delete_flush = time.time()
 
   def read_configuration(self):
     if not os.path.exists(self.cfg):
@@ -161,11 +188,139 @@ class CGenericFuzzer:
 
       self.asan_symbolizer_path = None
 
-  def launch_debugger(self, timeout, command, filename):
-    if command.find("@@") > -1:
-      cmd = [command.replace("@@", filename), ]
+    try:
+      self.templates_path = parser.get(self.section, 'templates-path')
+    except:
+      # Only needed for seeded samples
+      self.templates_path = None
+
+    try:
+      self.mutators_path = parser.get(self.section, 'mutators-path')
+    except:
+      self.mutators_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "mutators")
+
+    try:
+      self.reserve_batch = max(parser.getint(self.section, 'reserve-batch'), 1)
+    except:
+      # Reserve jobs one by one by default, jobs reserved and waiting in a
+      # batch are counting their time to run.
+      self.reserve_batch = 1
+
+    if self.iface == gdb_iface:
+      # Only one job is processed per run with GDB
+      self.reserve_batch = 1
+
+    try:
+      self.use_fork_server = parser.getboolean(self.section, 'fork-server')
+    except:
+      self.use_fork_server = False
+
+    if self.fork_server_failed:
+      self.use_fork_server = False
+
+    try:
+      self.fork_server_library = parser.get(self.section, 'fork-server-library')
+    except:
+      self.fork_server_library = os.path.join(os.path.dirname(os.path.abspath(__file__)), "extensions", "libfork_server.so")
+
+    try:
+      self.input_mode = parser.get(self.section, 'input-mode')
+    except:
+      self.input_mode = DEFAULT_INPUT_MODE
+
+    try:
+      self.input_path = parser.get(self.section, 'input-path')
+    except:
+      # Only used by the "file" input mode
+      self.input_path = DEFAULT_INPUT_PATH
+
+    # Applied to every target launched by this fuzzer
+    self.limits = read_resource_limits(parser, self.section, self.limits)
+    set_default_limits(self.limits)
+
+    # Runs in the fork server and under every debugger are calibrated
+    # apart, their overhead is very different.
+    if self.use_fork_server:
+      name = "%s:fork-server" % self.section
     else:
-      cmd = [command, filename]
+      name = "%s:%s" % (self.section, self.iface.__name__.split(".")[-1])
+    self.calibrator = read_timeout_calibrator(parser, self.section, self.cfg,
+                                              name, self.timeout, self.calibrator)
+
+    try:
+      self.job_ttr = parser.getint(self.section, 'job-ttr')
+    except:
+      # Only used for jobs put by engines not telling their TTR
+      self.job_ttr = DEFAULT_TTR
+
+  def get_seeded_samples(self):
+    if self.seeded_samples is None:
+      if self.templates_path is None:
+        raise Exception("No templates-path specified in the configuration file for section %s, required for seeded samples" % self.section)
+      self.seeded_samples = CSeededSamples(self.templates_path, self.mutators_path)
+    return self.seeded_samples
+
+  def read_sample(self, job):
+    """ Return the tuple (buffer, temporary file, diff lines) of a job.
+        Seeded samples are created locally and have no temporary file.
+        The buffer of samples sent by an engine in this same box is None,
+        the temporary file must be used directly. """
+    header, buf = decode_sample_job(job.body)
+    if is_seeded_sample(header):
+      buf, diff = self.get_seeded_samples().create(header)
+      return buf, None, diff
+    elif is_local_sample(header):
+      if not os.path.exists(header["temp_file"]):
+        raise Exception("Sample file %s not found, LOCAL_SAMPLES requires the fuzzers to run in the engine's box" % header["temp_file"])
+      return None, header["temp_file"], None
+    return buf, header["temp_file"], None
+
+  def get_leases(self):
+    if self.leases is None:
+      self.leases = CLeaseManager(self.q, self.job_ttr)
+      self.leases.start()
+    return self.leases
+
+  def lease_jobs(self, jobs):
+    """ Keep the reserved @jobs alive until they are released. """
+    leases = self.get_leases()
+    for job in jobs:
+      leases.acquire(job, decode_header(job.body).get("ttr"))
+
+  def release_jobs(self, jobs):
+    """ Stop touching @jobs and return the ones still reserved by us. The
+        others were handed out again after their lease expired. """
+    return [job for job in jobs if self.leases.release(job)]
+
+  def get_crash_job(self, crash_info, buf, temp_file, diff):
+    if temp_file is None:
+      # Seeded sample, only the fuzzer has it
+      return encode_crash(crash_info, buf=buf, diff=diff)
+    return encode_crash(crash_info, temp_file)
+
+  def queue_delete(self, temp_file):
+    """ Ask the engine to remove the sample file @temp_file. Files are
+        sent in batches of, at most, DELETE_BATCH_SIZE basenames. """
+    self.pending_deletes.append(os.path.basename(temp_file))
+    if len(self.pending_deletes) >= DELETE_BATCH_SIZE or \
+       time.time() - self.last_delete_flush >= DELETE_FLUSH_INTERVAL:
+      self.flush_deletes()
+
+  def flush_deletes(self):
+    if len(self.pending_deletes) > 0:
+      debug("Putting %d file(s) to remove in the delete queue" % len(self.pending_deletes))
+      self.delete_q.put(encode_deletes(self.pending_deletes))
+      self.pending_deletes = []
+    self.last_delete_flush = time.time()
+
+  def get_reserve_timeout(self):
+    # Don't wait forever for new jobs with deletes pending
+    if len(self.pending_deletes) > 0:
+      return DELETE_FLUSH_INTERVAL
+    return None
+
+  def launch_debugger(self, timeout, command, filename):
+    cmd = [build_command(command, filename), ]
 
     log("Launching debugger with command %s" % " ".join(cmd))
     if not has_pykd or self.iface != pykd_iface:
@@ -176,19 +331,117 @@ class CGenericFuzzer:
         crash = self.iface.main(cmd)
     else:
       reload(pykd_iface)
-      crash = pykd_iface.main(cmd, self.timeout, mode=self.mode, windbg_path=self.windbg_path, exploitable_path=self.exploitable_path)
+      if self.limits is not None:
+        self.limits.warn_unsupported("pykd")
+      crash = pykd_iface.main(cmd, timeout, mode=self.mode, windbg_path=self.windbg_path, exploitable_path=self.exploitable_path)
     return crash
 
-  def launch_sample(self, buf):
+  def get_timeout(self):
+    """ Return the calibrated timeout, if enabled, or the configured one. """
+    if self.calibrator is not None:
+      return self.calibrator.get_timeout()
+    return self.timeout
+
+  def record_time(self, elapsed, timed_out):
+    if self.calibrator is not None:
+      self.calibrator.add(elapsed, timed_out)
+
+  def calibrate_timeout(self):
+    """ Calibrate the timeout running a sample of the templates, unless
+        it was already calibrated in a previous run. """
+    if self.calibrator is None or self.calibrator.is_calibrated() or \
+       self.templates_path is None:
+      return
+
+    templates = []
+    for name in os.listdir(self.templates_path):
+      filename = os.path.join(self.templates_path, name)
+      if os.path.isfile(filename):
+        templates.append(filename)
+    if len(templates) == 0:
+      return
+
+    random.shuffle(templates)
+    log("Calibrating the timeout running %d template(s)..." % min(len(templates), CALIBRATION_SAMPLES))
+    for i in range(CALIBRATION_SAMPLES):
+      buf = file(templates[i % len(templates)], "rb").read()
+      if self.launch_sample(buf):
+        # Nothing to report, templates aren't fuzzed samples
+        log("A template crashed while calibrating the timeout")
+        self.crash_info = None
+
+  def get_input(self):
+    """ Return the test cases' delivery of this worker, created again if
+        its configuration changed. """
+    if self.input is not None:
+      if self.input.mode == self.input_mode and \
+         self.input.extension == self.extension and \
+         self.input.path == self.input_path:
+        return self.input
+      self.input.close()
+
+    self.input = CInputDelivery(self.input_mode, self.extension, self.input_path)
+    return self.input
+
+  def get_fork_server(self):
+    """ Return the fork server for the current command line, starting a
+        new one if the command or the input changed. Samples are always
+        delivered in the same place, the one given to the target. """
+    data_input = self.get_input()
+    cmd = data_input.get_command(self.command)
+    stdin = data_input.get_stdin()
+
+    if self.fork_server is not None and \
+       (self.fork_server.command != cmd or self.fork_server.stdin != stdin):
+      self.fork_server.stop()
+      self.fork_server = None
+
+    if self.fork_server is None:
+      self.fork_server = CForkServer(cmd, self.fork_server_library, stdin)
+    return self.fork_server
+
+  def run_fork_server(self):
+    """ Run the sample already delivered in the fork server. Return the
+        signal's name if it crashed, an empty string if it didn't or None
+        if the fork server failed and the sample must be run under the
+        debugger. """
+    try:
+      server = self.get_fork_server()
+      timeout = self.get_timeout()
+      if str(timeout).lower() == "auto":
+        timeout = 60
+      start = time.time()
+      ret, timed_out = server.run(float(timeout))
+      if server.outcome is None:
+        self.record_time(time.time() - start, timed_out)
+    except CForkServerStartError:
+      # Every try would wait START_TIMEOUT seconds before failing again
+      log("Cannot start the fork server, disabled in this fuzzer: %s" % str(sys.exc_info()[1]))
+      self.fork_server.stop()
+      self.fork_server = None
+      self.fork_server_failed = True
+      self.use_fork_server = False
+      return None
+    except CForkServerError:
+      log("Fork server error, using the debugger: %s" % str(sys.exc_info()[1]))
+      if self.fork_server is not None:
+        self.fork_server.stop()
+      return None
+
+    if timed_out:
+      debug("Sample timed out in the fork server")
+    elif server.outcome is not None:
+      # Hit a resource limit, already reported
+      pass
+    elif server.is_crash(ret):
+      return RETURN_SIGNALS[ret]
+    return ""
+
+  def launch_sample(self, buf, temp_file=None):
     # Re-read configuration each time we're running the fuzzer so the 
     # new changes are immediately applied.
     self.read_configuration()
 
-    filename = tempfile.mktemp(suffix=self.extension)
-    f = open(filename, "wb")
-    f.write(buf)
-    f.close()
-
     #os.putenv("NIGHTMARE_TIMEOUT", str(self.timeout))
     for key in self.env:
       debug("Setting environment variable %s=%s" % (key, self.env[key]))
@@ -197,58 +450,137 @@ class CGenericFuzzer:
     if self.pre_command is not None:
       os.system(self.pre_command)
 
+    data_input = self.get_input()
+    if buf is None:
+      # Sample created by the engine in this same box: the target reads
+      # that same file, hard linked, or a copy in another filesystem.
+      if not data_input.link(temp_file):
+        data_input.write(file(temp_file, "rb").read())
+    else:
+      data_input.write(buf)
+
+    # Only the samples crashing in the fork server are run again under
+    # the debugger to get the crash information.
+    signal_name = None
+    if self.use_fork_server:
+      signal_name = self.run_fork_server()
+      if signal_name == "":
+        if self.post_command is not None:
+          os.system(self.post_command)
+        return False
+
+    if self.use_fork_server:
+      # Only crashes are run under the debugger, with the configured
+      # timeout as the calibrated one is for the fork server.
+      timeout = self.timeout
+    else:
+      timeout = self.get_timeout()
+
     crash = None
+    elapsed = None
     for i in range(0,3):
+      # Rewinds the standard input in every try
+      data_input.redirect_stdin()
+      if self.limits is not None:
+        self.limits.reset()
       try:
-        crash = self.launch_debugger(self.timeout, self.command, filename)
+        start = time.time()
+        crash = self.launch_debugger(timeout, self.command, data_input.get_path())
+        elapsed = time.time() - start
         break
       except:
         log("Exception: %s" % sys.exc_info()[1])
         continue
+      finally:
+        data_input.restore_stdin()
 
     if self.post_command is not None:
       os.system(self.post_command)
 
+    if self.limits is not None and self.limits.last_outcome is not None:
+      # Killed by a resource limit, it isn't a bug in the target
+      crash = None
+      signal_name = None
+    elif self.calibrator is not None and elapsed is not None and \
+         not self.use_fork_server:
+      self.record_time(elapsed, elapsed >= timeout)
+
+    if crash is None and signal_name is not None:
+      log("Crash with %s in the fork server not reproduced under the debugger" % signal_name)
+      crash = CCrashData(0, signal_name).dump_dict()
+
     if crash is not None:
       self.crash_info = crash
       return True
-    else:
-      os.remove(filename)
     return False
 
   def fuzz(self):
     log("Launching fuzzer, listening in tube %s" % self.tube_name)
+    try:
+      self.calibrate_timeout()
+      self.process_jobs()
+    finally:
+      self.flush_deletes()
+      if self.calibrator is not None:
+        self.calibrator.close()
+      if self.fork_server is not None:
+        self.fork_server.stop()
+      if self.input is not None:
+        self.input.close()
+      if self.limits is not None:
+        self.limits.close()
+
+  def process_jobs(self):
     while 1:
-      value = self.q.stats_tube(self.tube_name)["current-jobs-ready"]
-      debug("Total of %d job(s) in queue" % value)
-      job = self.q.reserve()
-      buf, temp_file = json.loads(job.body)
-      buf = base64.b64decode(buf)
+      if config.DEBUG:
+        value = self.q.stats_tube(self.tube_name)["current-jobs-ready"]
+        debug("Total of %d job(s) in queue" % value)
 
-      debug("Launching sample %s..." % os.path.basename(temp_file))
-      if self.launch_sample(buf):
-        log("We have a crash, moving to %s queue..." % self.crash_tube)
-        crash = self.crash_info
-        d = {temp_file:self.crash_info}
-        self.crash_q.put(json.dumps(d))
-        self.crash_info = None
+      jobs = self.q.reserve_many(self.reserve_batch, timeout=self.get_reserve_timeout())
+      if len(jobs) == 0:
+        self.flush_deletes()
+        continue
+
+      self.lease_jobs(jobs)
+      done = []
+      try:
+        for job in jobs:
+          self.process_job(job)
+          done.append(job)
+      finally:
+        # Jobs not processed are handed out again when their TTR expires
+        held = self.release_jobs(jobs)
+        done = [job for job in done if job in held]
+        if len(done) > 0:
+          self.q.delete_many(done)
 
-        log("$PC 0x%08x Signal %s Exploitable %s " % (crash["pc"], crash["signal"], crash["exploitable"]))
-        if crash["disasm"] is not None:
-          log("%08x: %s" % (crash["disasm"][0], crash["disasm"][1]))
-      else:
-        file_delete = os.path.basename(temp_file)
-        self.delete_q.put(str(file_delete))
-      
-      if self.cleanup is not None:
-        debug("Running clean-up command %s" % self.cleanup)
-        os.system(self.cleanup)
-        debug("Done")
-      job.delete()
-      
       if self.iface == gdb_iface:
         break
 
+  def process_job(self, job):
+    buf, temp_file, diff = self.read_sample(job)
+
+    if temp_file is not None:
+      debug("Launching sample %s..." % os.path.basename(temp_file))
+    else:
+      debug("Launching seeded sample...")
+    if self.launch_sample(buf, temp_file):
+      log("We have a crash, moving to %s queue..." % self.crash_tube)
+      crash = self.crash_info
+      self.crash_q.put(self.get_crash_job(self.crash_info, buf, temp_file, diff))
+      self.crash_info = None
+
+      log("$PC 0x%08x Signal %s Exploitable %s " % (crash["pc"], crash["signal"], crash["exploitable"]))
+      if crash["disasm"] is not None:
+        log("%08x: %s" % (crash["disasm"][0], crash["disasm"][1]))
+    elif temp_file is not None:
+      self.queue_delete(temp_file)
+    
+    if self.cleanup is not None:
+      debug("Running clean-up command %s" % self.cleanup)
+      os.system(self.cleanup)
+      debug("Done")
+
 #-----------------------------------------------------------------------
 def do_fuzz(cfg, section):
   try:
@@ -278,6 +610,9 @@ def usage():
   print
   print "Environment variables:"
   print "NIGHTMARE_PROCESSES     Number of processes to run at the same time"
+  print "NIGHTMARE_AFFINITY      Set to 1 to pin every process to its own CPU"
+  print "NIGHTMARE_RESERVED_CPUS CPUs not used by the processes (i.e., 0-1)"
+  print "NIGHTMARE_AVOID_SMT     Set to 1 to not use the SMT siblings"
   print
 
 if __name__ == "__main__":
@@ -17,6 +17,7 @@ sys.path.append("../lib")
 sys.path.append("../lib/interfaces")
 
 from crash_data import CCrashData
+from nfp_limits import get_default_limits
 
 from vtrace import vtrace
 
@@ -119,6 +120,11 @@ def kill_process(tr, kill=True):
   except:
     pass
 
+#-----------------------------------------------------------------------
+def kill_after_timeout(tr, timed_out):
+  timed_out.append(True)
+  kill_process(tr, True)
+
 #-----------------------------------------------------------------------
 def sig2name(sig):
   if os.name == "nt":
@@ -138,6 +144,10 @@ def main(args):
   if os.getenv("NIGHTMARE_TIMEOUT"):
     timeout = float(os.getenv("NIGHTMARE_TIMEOUT"))
 
+  # Only applied to the processes we start
+  limits = None
+  timed_out = []
+
   if args[0] in ["--attach", "-A"]:
     if len(args) == 1:
       usage()
@@ -152,14 +162,22 @@ def main(args):
   else:    
     if timeout != 0:
       # Schedule a timer to kill the process after 5 seconds
-      timer = threading.Timer(timeout, kill_process, (tr, True, ))
+      timer = threading.Timer(timeout, kill_after_timeout, (tr, timed_out, ))
       timer.start()
 
     cmd = args
     if type(args) is list:
       cmd = " ".join(args)
 
+    limits = get_default_limits()
+    if limits is not None:
+      limits.prepare()
+
     tr.execute(" ".join(args))
+    # The process is stopped right after the exec
+    if limits is not None and not limits.apply_to(tr.getPid()):
+      limits.warn_unsupported("vtrace in this platform")
+      limits = None
     tr.run()
 
   signal = tr.getCurrentSignal()
@@ -175,6 +193,16 @@ def main(args):
 
   if timeout != 0:
     timer.cancel()
+
+  if limits is not None and os.name != "nt":
+    ret = None
+    if signal is not None:
+      ret = 128 + signal
+    if limits.check(ret, len(timed_out) > 0) is not None:
+      # SIGXCPU, SIGXFSZ or an OOM kill, not a crash
+      kill_process(tr, True)
+      return None
+
   # Don't do anything else, the process is gone
   if os.name != "nt" and not tr.attached:
     return None
@@ -18,12 +18,15 @@ import random
 
 #-----------------------------------------------------------------------
 class CCMillerMutator(object):
-  def __init__(self, buf, skip=5):
-    self.buf = buf
+  """ Mutator plugin: mutate(buf) returns the mutated buffer and the
+      list of changes to be written in the .diff file. """
+  name = "CMiller Mutator"
+
+  def __init__(self, skip=5):
     self.skip = 5
 
-  def mutate(self):
-    buf = bytearray(self.buf)
+  def mutate(self, buf):
+    buf = bytearray(buf)
     fuzz_factor = 10 # 0.1% of the file
     # Original:
     numwrites = random.randrange(math.ceil((float(len(buf)) / fuzz_factor))+1)
@@ -35,18 +38,21 @@ class CCMillerMutator(object):
       rn = random.randrange(len(buf))
       buf[rn] = "%c" % rbyte
       diff.append(rn)
+    diff.sort()
     return buf, diff
 
+# Class loaded by nfp_engine.py to run this mutator in-process
+MUTATOR_CLASS = CCMillerMutator
+
 #-----------------------------------------------------------------------
 def main(template, output):
-  mut = CCMillerMutator(open(template, "rb").read())
-  buf, diff = mut.mutate()
+  mut = CCMillerMutator()
+  buf, diff = mut.mutate(open(template, "rb").read())
 
   f = open(output, "wb")
   f.write(buf)
   f.close()
 
-  diff.sort()  
   f = open(output + ".diff", "wb")
   f.write("# Original file created by 'CMiller Mutator' was %s\n" % template)
   f.write("\n".join(map(str,diff))) 
@@ -12,12 +12,15 @@ import random
 
 #-----------------------------------------------------------------------
 class CCMillerMutator(object):
-  def __init__(self, buf, skip=5):
-    self.buf = buf
+  """ Mutator plugin: mutate(buf) returns the mutated buffer and the
+      list of changes to be written in the .diff file. """
+  name = "CMiller Mutator Rep"
+
+  def __init__(self, skip=5):
     self.skip = 5
 
-  def mutate(self):
-    buf = self.buf
+  def mutate(self, buf):
+    buf = str(buf)
     fuzz_factor = len(buf)/500.
     if fuzz_factor < 1:
       fuzz_factor = 1
@@ -31,18 +34,21 @@ class CCMillerMutator(object):
       c = "%c" % rbyte
       buf = buf[:rn-1] + c*rtotal + buf[rn+rtotal:]
       diff.append("%d, %d" % (rn, rtotal))
+    diff.sort()
     return buf, diff
 
+# Class loaded by nfp_engine.py to run this mutator in-process
+MUTATOR_CLASS = CCMillerMutator
+
 #-----------------------------------------------------------------------
 def main(template, output):
-  mut = CCMillerMutator(open(template, "rb").read())
-  buf, diff = mut.mutate()
+  mut = CCMillerMutator()
+  buf, diff = mut.mutate(open(template, "rb").read())
 
   f = open(output, "wb")
   f.write(buf)
   f.close()
 
-  diff.sort()  
   f = open(output + ".diff", "wb")
   f.write("# Original file created by 'CMiller Mutator Rep' was %s\n" % template)
   f.write("\n".join(diff))
@@ -12,11 +12,15 @@ import random
 
 #-----------------------------------------------------------------------
 class CSimpleReplacer:
-  def __init__(self, input):
+  """ Mutator plugin: mutate(buf) returns the mutated buffer and the
+      list of changes to be written in the .diff file. """
+  name = "Simple Replace Mutator"
+
+  def __init__(self, input=None):
     self.input = input
-  
-  def replace(self, output):
-    buf = open(self.input, "rb").read()
+
+  def mutate(self, buf):
+    buf = str(buf)
 
     # Randomly select a character to replace
     char = chr(random.randint(0, 255))
@@ -32,18 +36,27 @@ class CSimpleReplacer:
     # bytes
     size = random.randint(1, 256)
 
-    # And, finally, write the output file
     new_buf = buf[:place] + char*size + buf[place+size:]
+    return new_buf, ["%d,%d" % (place, size)]
+
+  def replace(self, output):
+    buf = open(self.input, "rb").read()
+    new_buf, diff = self.mutate(buf)
+
+    # And, finally, write the output file
     f = open(output, "wb")
     f.write(new_buf)
     f.close()
 
     # ...and the .diff file too
     f = open(output + ".diff", "wb")
-    f.write("# Original file created by 'Simple Replace Mutator' was %s\n" % self.input)
-    f.write("%d,%d" % (place, size))
+    f.write("# Original file created by '%s' was %s\n" % (self.name, self.input))
+    f.write("\n".join(diff))
     f.close()
 
+# Class loaded by nfp_engine.py to run this mutator in-process
+MUTATOR_CLASS = CSimpleReplacer
+
 #-----------------------------------------------------------------------
 def main(input_file, output_file):
   replacer = CSimpleReplacer(input_file)
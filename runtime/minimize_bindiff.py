@@ -2,10 +2,7 @@
 
 import os
 import sys
-import json
-import zlib
-import base64
-import shutil
+import time
 import random
 import tempfile
 import ConfigParser
@@ -14,7 +11,11 @@ from hashlib import sha1
 
 from nfp_log import log
 from nfp_queue import get_queue
+from nfp_frame import encode_crash
 from nfp_process import TimeoutCommand, RETURN_SIGNALS
+from nfp_input import CInputDelivery, DEFAULT_INPUT_MODE, DEFAULT_INPUT_PATH
+from nfp_limits import read_resource_limits, set_default_limits
+from nfp_timeout import read_timeout_calibrator
 
 try:
   from lib.interfaces import vtrace_iface, gdb_iface, asan_iface, pykd_iface
@@ -28,6 +29,8 @@ class CGenericBinaryDiffMinimizer:
   def __init__(self, cfg, section):
     self.cfg = cfg
     self.section = section
+    self.limits = None
+    self.calibrator = None
     self.read_configuration()
 
     self.diff = []
@@ -35,6 +38,7 @@ class CGenericBinaryDiffMinimizer:
     self.crash = {}
     
     self.last_crash = None
+    self.input = None
 
   def read_diff(self, diff):
     with open(diff, "rb") as f:
@@ -108,7 +112,7 @@ class CGenericBinaryDiffMinimizer:
       # Default timeout is 90 seconds
       self.timeout = 90
     
-    if self.timeout.lower() != "auto":
+    if str(self.timeout).lower() != "auto":
       self.timeout = int(self.timeout)
 
     try:
@@ -182,6 +186,40 @@ class CGenericBinaryDiffMinimizer:
       # one were nfp_engine.py is running
       self.local_files = False
 
+    try:
+      self.input_mode = parser.get(self.section, 'input-mode')
+    except:
+      self.input_mode = DEFAULT_INPUT_MODE
+
+    try:
+      self.input_path = parser.get(self.section, 'input-path')
+    except:
+      self.input_path = DEFAULT_INPUT_PATH
+
+    self.limits = read_resource_limits(parser, self.section, self.limits)
+    set_default_limits(self.limits)
+
+    # Shared with the generic fuzzer when using the same debugger
+    if self.iface is None:
+      name = "%s:plain" % self.section
+    else:
+      name = "%s:%s" % (self.section, self.iface.__name__.split(".")[-1])
+    self.calibrator = read_timeout_calibrator(parser, self.section, self.cfg,
+                                              name, self.timeout, self.calibrator)
+
+  def get_input(self):
+    """ Return the delivery of the test cases, created again if its
+        configuration changed. """
+    if self.input is not None:
+      if self.input.mode == self.input_mode and \
+         self.input.extension == self.extension and \
+         self.input.path == self.input_path:
+        return self.input
+      self.input.close()
+
+    self.input = CInputDelivery(self.input_mode, self.extension, self.input_path)
+    return self.input
+
   def minimize(self, template, crash, diff, outdir):
     self.read_diff(diff)
     self.read_template(template)
@@ -195,17 +233,52 @@ class CGenericBinaryDiffMinimizer:
     else:
       start_at = 0
 
-    self.do_try(outdir, start_at)
+    try:
+      self.do_try(outdir, start_at)
+    finally:
+      self.close()
+
+  def close(self):
+    if self.input is not None:
+      self.input.close()
+    if self.limits is not None:
+      self.limits.close()
+    if self.calibrator is not None:
+      self.calibrator.close()
 
   def execute_command(self, cmd, timeout):
+    if self.calibrator is not None:
+      timeout = self.calibrator.get_timeout()
+
+    # The test case may be our standard input, inherited by the target
+    self.get_input().redirect_stdin()
+    if self.limits is not None:
+      self.limits.reset()
+    try:
+      start = time.time()
+      ret = self.execute_command_internal(cmd, timeout)
+      elapsed = time.time() - start
+    finally:
+      self.input.restore_stdin()
+
+    if self.limits is not None and self.limits.last_outcome is not None:
+      # Killed by a resource limit, it isn't the crash being minimized
+      self.last_crash = None
+      return None
+
+    if self.calibrator is not None:
+      self.calibrator.add(elapsed, elapsed >= timeout)
+    return ret
+
+  def execute_command_internal(self, cmd, timeout):
     ret = None
     if self.debugging_interface is None:
       cmd_obj = TimeoutCommand(cmd)
-      ret = cmd_obj.run(timeout=self.timeout)
+      ret = cmd_obj.run(timeout=timeout)
       if cmd_obj.stderr is not None:
         print cmd_obj.stderr
     else:
-      self.iface.timeout = self.timeout
+      self.iface.timeout = timeout
       if not has_pykd or self.iface != pykd_iface:
         if self.iface == asan_iface:
           crash = self.iface.main(asan_symbolizer_path=self.asan_symbolizer_path, args=cmd)
@@ -214,6 +287,8 @@ class CGenericBinaryDiffMinimizer:
       else:
         # Avoid network timeouts and unnecessary delays when using pykd
         os.putenv("_NT_SYMBOL_PATH", "")
+        if self.limits is not None:
+          self.limits.warn_unsupported("pykd")
         crash = pykd_iface.main([cmd], timeout, mode=self.mode, windbg_path=self.windbg_path, exploitable_path=self.exploitable_path)
 
       if crash is not None:
@@ -234,16 +309,14 @@ class CGenericBinaryDiffMinimizer:
         filename = tempfile.mktemp()
         with open(filename, "wb") as f:
           f.write(buf)
-        d = {os.path.abspath(filename):self.last_crash}
+        job = encode_crash(self.last_crash, os.path.abspath(filename))
       else:
         # The minimizer is running in a box different to the one were
         # nfp_engine.py is running, put the whole file in the queue
-        self.last_crash["has_file"] = True
-        zbuf = base64.b64encode(zlib.compress(buf))
-        d = {zbuf:self.last_crash}
+        job = encode_crash(self.last_crash, buf=buf)
 
       log("Putting the new crash in the queue...")
-      self.crash_q.put(json.dumps(d))
+      self.crash_q.put(job)
     except:
       log("Error putting the new crash in the queue: %s" % (str(sys.exc_info()[1])))
       if self.local_files:
@@ -259,46 +332,41 @@ class CGenericBinaryDiffMinimizer:
       for pos in self.diff:
         if start_at <= iteration:
           log("Minimizing, iteration %d (Max. %d)..." % (iteration, (len(self.diff)) * len(self.diff)))
-          temp_file = tempfile.mktemp()
           buf = bytearray(self.template)
           if pos not in self.crash:
             continue
           
           buf[pos] = self.crash[pos]
-
-          with open(temp_file, "wb") as f:
-            f.write(buf)
-
-          try:
-            for key in self.env:
-              os.putenv(key, self.env[key])
-
-            if self.pre_command is not None:
-              log("Running pre-command %s" % self.pre_command)
-              os.system(self.pre_command)
-
-            cmd = "%s %s" % (self.command, temp_file)
-            ret = self.execute_command(cmd, self.timeout)
-
-            if self.post_command is not None:
-              log("Running post-command %s" % self.post_command)
-              os.system(self.post_command)
-
-            if ret in RETURN_SIGNALS or (self.signal is not None and ret == self.signal) or \
-             self.crash_file_exists():
-              log("Successfully minimized, caught signal %d (%s)!" % (ret, RETURN_SIGNALS[ret]))
-              filename = sha1(buf).hexdigest()
-              filename = os.path.join(outdir, "%s%s" % (filename, self.extension))
-              shutil.copy(temp_file, filename)
-              log("Minized test case %s written to disk." % filename)
-              minimized = True
-
-              if self.should_notify_crash():
-                # TODO: Put the crash in the queue
-                pass
-              break
-          finally:
-            os.remove(temp_file)
+          self.get_input().write(buf)
+
+          for key in self.env:
+            os.putenv(key, self.env[key])
+
+          if self.pre_command is not None:
+            log("Running pre-command %s" % self.pre_command)
+            os.system(self.pre_command)
+
+          cmd = self.get_input().get_command(self.command)
+          ret = self.execute_command(cmd, self.timeout)
+
+          if self.post_command is not None:
+            log("Running post-command %s" % self.post_command)
+            os.system(self.post_command)
+
+          if ret in RETURN_SIGNALS or (self.signal is not None and ret == self.signal) or \
+           self.crash_file_exists():
+            log("Successfully minimized, caught signal %d (%s)!" % (ret, RETURN_SIGNALS[ret]))
+            filename = sha1(buf).hexdigest()
+            filename = os.path.join(outdir, "%s%s" % (filename, self.extension))
+            with open(filename, "wb") as f:
+              f.write(buf)
+            log("Minized test case %s written to disk." % filename)
+            minimized = True
+
+            if self.should_notify_crash():
+              # TODO: Put the crash in the queue
+              pass
+            break
 
         if minimized:
           break
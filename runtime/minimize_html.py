@@ -7,7 +7,6 @@ import zlib
 import base64
 import shutil
 import random
-import tempfile
 import ConfigParser
 
 from hashlib import sha1
@@ -146,7 +145,10 @@ class CHtmlMinimizer(CGenericBinaryDiffMinimizer):
       start_at = 0
 
     log("Phase #1: HTML tags simplification")
-    self.do_try_html(outdir, start_at)
+    try:
+      self.do_try_html(outdir, start_at)
+    finally:
+      self.close()
 
     # Phase #2, CSS minimization
     # Phase #3, JavaScript minimization
@@ -175,52 +177,46 @@ class CHtmlMinimizer(CGenericBinaryDiffMinimizer):
 
     return "".join(lines), lines
 
-  def launch_target(self, temp_file, lines, outdir):
-    try:
-      crashed = False
+  def launch_target(self, lines, outdir):
+    crashed = False
 
-      for key in self.env:
-        os.putenv(key, self.env[key])
+    for key in self.env:
+      os.putenv(key, self.env[key])
 
-      self.remove_crash_path()
+    self.remove_crash_path()
 
-      if self.pre_command is not None:
-        log("Running pre-command %s" % self.pre_command)
-        os.system(self.pre_command)
+    if self.pre_command is not None:
+      log("Running pre-command %s" % self.pre_command)
+      os.system(self.pre_command)
 
-      if self.command.find("@@") == -1:
-        cmd = "%s %s" % (self.command, temp_file)
-      else:
-        cmd = self.command.replace("@@", temp_file)
-      ret = self.execute_command(cmd, self.timeout)
-
-      if self.post_command is not None:
-        log("Running post-command %s" % self.post_command)
-        os.system(self.post_command)
-
-      if ret in RETURN_SIGNALS or (self.signal is not None and ret == self.signal) or \
-         self.crash_file_exists():
-          
-        crashed = True
-        self.template = lines
-        log("Process crashed as expected...")
-        buf = "\n".join(self.template)
-        if not os.path.exists(outdir):
-          log("Directory %s does not exists, creating it..." % outdir)
-          os.mkdir(outdir)
+    cmd = self.get_input().get_command(self.command)
+    ret = self.execute_command(cmd, self.timeout)
 
-        filename = os.path.join(outdir, "last_minimized%d%s" % (os.getpid(), self.extension))
-        with open(filename, "wb") as f:
-          f.write(buf)
-        log("Last minimized test case %s written to disk." % filename)
+    if self.post_command is not None:
+      log("Running post-command %s" % self.post_command)
+      os.system(self.post_command)
 
-        if self.should_notify_crash():
-          # TODO: Write a temporary file and put an enqueue the crash
-          self.put_new_crash(buf)
+    if ret in RETURN_SIGNALS or (self.signal is not None and ret == self.signal) or \
+       self.crash_file_exists():
+        
+      crashed = True
+      self.template = lines
+      log("Process crashed as expected...")
+      buf = "\n".join(self.template)
+      if not os.path.exists(outdir):
+        log("Directory %s does not exists, creating it..." % outdir)
+        os.mkdir(outdir)
 
-      self.remove_crash_path()
-    finally:
-      os.remove(temp_file)
+      filename = os.path.join(outdir, "last_minimized%d%s" % (os.getpid(), self.extension))
+      with open(filename, "wb") as f:
+        f.write(buf)
+      log("Last minimized test case %s written to disk." % filename)
+
+      if self.should_notify_crash():
+        # TODO: Write a temporary file and put an enqueue the crash
+        self.put_new_crash(buf)
+
+    self.remove_crash_path()
     
     return crashed
 
@@ -245,17 +241,14 @@ class CHtmlMinimizer(CGenericBinaryDiffMinimizer):
         self.read_configuration()
         log("Minimizing, iteration %d..." % iteration)
         iteration += 1
-        temp_file = tempfile.mktemp(suffix=self.extension)
         lines = self.template
         buf, lines = self.get_html_buffer(lines, skip_tags)
         if buf is None:
           log("Done minimizing...")
           break
 
-        with open(temp_file, "wb") as f:
-          f.write(buf)
-
-        crashed = self.launch_target(temp_file, lines, outdir)
+        self.get_input().write(buf)
+        crashed = self.launch_target(lines, outdir)
         if not crashed:
           log("Process did not crash, skipping one tag...")
           skip_tags += 1
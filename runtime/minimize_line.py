@@ -7,7 +7,6 @@ import zlib
 import base64
 import shutil
 import random
-import tempfile
 import ConfigParser
 
 from hashlib import sha1
@@ -81,7 +80,10 @@ class CLineMinimizer(CGenericBinaryDiffMinimizer):
     else:
       start_at = 0
 
-    self.do_try(outdir, start_at)
+    try:
+      self.do_try(outdir, start_at)
+    finally:
+      self.close()
 
   def crash_file_exists(self):
     if self.crash_path is not None:
@@ -121,7 +123,6 @@ class CLineMinimizer(CGenericBinaryDiffMinimizer):
         self.read_configuration()
         log("Minimizing, iteration %d..." % iteration)
         iteration += 1
-        temp_file = tempfile.mktemp(suffix=self.extension)
         lines = self.template
 
         if current_line >= len(lines):
@@ -146,54 +147,47 @@ class CLineMinimizer(CGenericBinaryDiffMinimizer):
         lines = lines[:current_line] + lines[current_line+lines_to_rip:]
         buf = "".join(lines)
 
-        with open(temp_file, "wb") as f:
-          f.write(buf)
+        self.get_input().write(buf)
+
+        for key in self.env:
+          os.putenv(key, self.env[key])
+
+        self.remove_crash_path()
+
+        if i % self.pre_iterations == 0:
+          if self.pre_command is not None:
+            log("Running pre-command %s" % self.pre_command)
+            os.system(self.pre_command)
+
+        cmd = self.get_input().get_command(self.command)
+        ret = self.execute_command(cmd, self.timeout)
+
+        if i % self.post_iterations == 0:
+          if self.post_command is not None:
+            log("Running post-command %s" % self.post_command)
+            os.system(self.post_command)
+
+        if ret in RETURN_SIGNALS or (self.signal is not None and ret == self.signal) or \
+           self.crash_file_exists():
+          self.template = lines
+          log("Process crashed as expected...")
+          buf = "".join(self.template)
+          if not os.path.exists(outdir):
+            log("Directory %s does not exists, creating it..." % outdir)
+            os.mkdir(outdir)
+
+          filename = os.path.join(outdir, "last_minimized%d%s" % (os.getpid(), self.extension))
+          with open(filename, "wb") as f:
+            f.write(buf)
+          log("Last minimized test case %s written to disk." % filename)
+
+          if self.should_notify_crash():
+            # TODO: Write a temporary file and put an enqueue the crash
+            self.put_new_crash(buf)
+        else:
+          current_line += 1
 
-        try:
-          for key in self.env:
-            os.putenv(key, self.env[key])
-
-          self.remove_crash_path()
-
-          if i % self.pre_iterations == 0:
-            if self.pre_command is not None:
-              log("Running pre-command %s" % self.pre_command)
-              os.system(self.pre_command)
-
-          if self.command.find("@@") == -1:
-            cmd = "%s %s" % (self.command, temp_file)
-          else:
-            cmd = self.command.replace("@@", temp_file)
-          ret = self.execute_command(cmd, self.timeout)
-
-          if i % self.post_iterations == 0:
-            if self.post_command is not None:
-              log("Running post-command %s" % self.post_command)
-              os.system(self.post_command)
-
-          if ret in RETURN_SIGNALS or (self.signal is not None and ret == self.signal) or \
-             self.crash_file_exists():
-            self.template = lines
-            log("Process crashed as expected...")
-            buf = "".join(self.template)
-            if not os.path.exists(outdir):
-              log("Directory %s does not exists, creating it..." % outdir)
-              os.mkdir(outdir)
-
-            filename = os.path.join(outdir, "last_minimized%d%s" % (os.getpid(), self.extension))
-            with open(filename, "wb") as f:
-              f.write(buf)
-            log("Last minimized test case %s written to disk." % filename)
-
-            if self.should_notify_crash():
-              # TODO: Write a temporary file and put an enqueue the crash
-              self.put_new_crash(buf)
-          else:
-            current_line += 1
-
-          self.remove_crash_path()
-        finally:
-          os.remove(temp_file)
+        self.remove_crash_path()
 
       loops += 1
 
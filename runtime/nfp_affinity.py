@@ -0,0 +1,215 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Nightmare Fuzzing Project
+CPU affinity of the fuzzing processes.
+
+Every worker started by process_manager() is pinned to its own CPU (or
+set of CPUs) and the targets, debuggers and instrumentation toolkits it
+launches inherit it, instead of migrating across cores and NUMA nodes.
+Workers are placed filling one NUMA node before the next one, using the
+first hardware thread of every physical core before their SMT siblings.
+It's configured with the following environment variables:
+
+NIGHTMARE_AFFINITY          Set to 1 to pin the workers.
+NIGHTMARE_RESERVED_CPUS     CPUs never given to the workers, like 0-1,8.
+                            The engine pins itself to them, pin beanstalkd
+                            to them too (i.e., with taskset).
+NIGHTMARE_AVOID_SMT         Set to 1 to not use the SMT siblings, unless
+                            there aren't enough physical cores.
+NIGHTMARE_CPUS_PER_PROCESS  Number of CPUs of every worker, 1 by default.
+@author: joxean
+"""
+
+import os
+import glob
+
+import psutil
+
+from nfp_log import log, debug
+
+#-----------------------------------------------------------------------
+SYSFS_CPU_PATH = "/sys/devices/system/cpu"
+
+#-----------------------------------------------------------------------
+def parse_cpu_list(value):
+  """ Parse a CPU list in the kernel's format (i.e., 0-3,8,10-11). """
+  ret = []
+  for item in value.strip().split(","):
+    item = item.strip()
+    if item == "":
+      continue
+    if item.find("-") > -1:
+      start, end = item.split("-", 1)
+      ret.extend(range(int(start), int(end) + 1))
+    else:
+      ret.append(int(item))
+  return ret
+
+def format_cpu_list(cpus):
+  return ",".join(map(str, cpus))
+
+#-----------------------------------------------------------------------
+def get_affinity(pid=None):
+  """ Return the CPUs the process @pid (or this one) can run on or None
+      if it isn't supported in this platform. """
+  try:
+    return psutil.Process(pid).cpu_affinity()
+  except AttributeError:
+    return None
+
+def set_affinity(cpus, pid=None):
+  """ Pin the process @pid (or this one) to the list of CPUs @cpus.
+      Return False if it isn't supported in this platform. """
+  try:
+    psutil.Process(pid).cpu_affinity(list(cpus))
+  except AttributeError:
+    return False
+  return True
+
+#-----------------------------------------------------------------------
+def read_sysfs_value(path, default=None):
+  try:
+    with open(path, "rb") as f:
+      return f.read().strip()
+  except IOError:
+    return default
+
+#-----------------------------------------------------------------------
+class CCpu:
+  def __init__(self, cpu):
+    self.id = cpu
+    base = os.path.join(SYSFS_CPU_PATH, "cpu%d" % cpu)
+
+    self.package = int(read_sysfs_value(os.path.join(base, "topology", "physical_package_id"), 0))
+    self.core = int(read_sysfs_value(os.path.join(base, "topology", "core_id"), cpu))
+    siblings = read_sysfs_value(os.path.join(base, "topology", "thread_siblings_list"))
+    if siblings is None:
+      self.siblings = [cpu]
+    else:
+      self.siblings = parse_cpu_list(siblings)
+
+    self.node = 0
+    nodes = glob.glob(os.path.join(base, "node[0-9]*"))
+    if len(nodes) > 0:
+      self.node = int(os.path.basename(nodes[0])[4:])
+
+  def is_primary(self):
+    """ Is it the first hardware thread of its physical core? """
+    return self.id == min(self.siblings)
+
+  def get_key(self):
+    return (self.node, self.package, self.core, self.id)
+
+  def __repr__(self):
+    return "<cpu %d node %d package %d core %d>" % (self.id, self.node, self.package, self.core)
+
+#-----------------------------------------------------------------------
+class CAffinityPlanner:
+  """ Assign CPUs to the workers, @cpus_per_worker each one, without
+      using the @reserved ones and, if @avoid_smt is True and there are
+      enough physical cores, the SMT siblings. """
+  def __init__(self, reserved=None, avoid_smt=False, cpus_per_worker=1):
+    if reserved is None:
+      reserved = []
+    self.reserved = reserved
+    self.avoid_smt = avoid_smt
+    self.cpus_per_worker = max(cpus_per_worker, 1)
+
+    self.assignments = []
+
+  def get_usable_cpus(self):
+    allowed = get_affinity()
+    if allowed is None:
+      return []
+
+    usable = [cpu for cpu in allowed if cpu not in self.reserved]
+    if len(usable) == 0:
+      log("Every allowed CPU is reserved, ignoring the reserved CPUs")
+      usable = allowed
+    return [CCpu(cpu) for cpu in usable]
+
+  def plan(self, total):
+    """ Return the list of CPUs of every one of the @total workers or None
+        if the affinity can't be set in this platform. """
+    cpus = self.get_usable_cpus()
+    if len(cpus) == 0:
+      log("CPU affinity isn't supported in this platform")
+      return None
+
+    primary = sorted([cpu for cpu in cpus if cpu.is_primary()], key=CCpu.get_key)
+    siblings = sorted([cpu for cpu in cpus if not cpu.is_primary()], key=CCpu.get_key)
+
+    needed = total * self.cpus_per_worker
+    pool = primary + siblings
+    if self.avoid_smt:
+      if len(primary) >= needed:
+        pool = primary
+      else:
+        log("Only %d physical core(s) for %d CPU(s), using the SMT siblings too" % (len(primary), needed))
+
+    if needed > len(pool):
+      log("Only %d CPU(s) for %d CPU(s) requested, some of them will be shared" % (len(pool), needed))
+
+    self.assignments = []
+    for i in range(total):
+      assigned = []
+      for j in range(self.cpus_per_worker):
+        cpu = pool[(i * self.cpus_per_worker + j) % len(pool)].id
+        if cpu not in assigned:
+          assigned.append(cpu)
+      self.assignments.append(sorted(assigned))
+
+    debug("CPU plan: %s" % ", ".join([format_cpu_list(x) for x in self.assignments]))
+    # The first call only starts measuring the utilization
+    psutil.cpu_percent(percpu=True)
+    return self.assignments
+
+  def get_utilization(self):
+    """ Return a dictionary with the utilization percentage of every CPU
+        assigned to a worker since the last call. """
+    usage = psutil.cpu_percent(percpu=True)
+    ret = {}
+    for cpus in self.assignments:
+      for cpu in cpus:
+        if cpu < len(usage):
+          ret[cpu] = usage[cpu]
+    return ret
+
+  def report(self):
+    usage = self.get_utilization()
+    if len(usage) > 0:
+      line = " ".join(["%d:%d%%" % (cpu, usage[cpu]) for cpu in sorted(usage)])
+      log("Utilization of the workers' CPUs: %s" % line)
+
+#-----------------------------------------------------------------------
+def get_reserved_cpus():
+  value = os.getenv("NIGHTMARE_RESERVED_CPUS")
+  if value is None:
+    return []
+  return parse_cpu_list(value)
+
+def get_affinity_planner():
+  """ Return the planner configured in the environment or None if the
+      workers mustn't be pinned. """
+  if os.getenv("NIGHTMARE_AFFINITY") != "1":
+    return None
+
+  avoid_smt = os.getenv("NIGHTMARE_AVOID_SMT") == "1"
+  cpus_per_worker = int(os.getenv("NIGHTMARE_CPUS_PER_PROCESS", 1))
+  return CAffinityPlanner(get_reserved_cpus(), avoid_smt, cpus_per_worker)
+
+def pin_to_reserved_cpus():
+  """ Pin this process (i.e., the engine) to the reserved CPUs, if any,
+      so it doesn't compete with the workers. """
+  if os.getenv("NIGHTMARE_AFFINITY") != "1":
+    return
+
+  reserved = get_reserved_cpus()
+  allowed = get_affinity()
+  if allowed is None:
+    return
+
+  reserved = [cpu for cpu in reserved if cpu in allowed]
+  if len(reserved) > 0 and set_affinity(reserved):
+    log("Pinned to the reserved CPU(s) %s" % format_cpu_list(reserved))
@@ -0,0 +1,202 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Nightmare Fuzzing Project
+In-memory index of the crash hashes already stored in the database.
+
+It's used to reject duplicated crashes for projects configured to ignore
+duplicates without querying the database. Every crash hash is tested
+first against a Bloom filter and, only if it may be there, against the
+exact per project set of hashes. Hashes not in the index are checked in
+the database, as they may have been stored by another process, so only
+new crashes ever touch the database.
+
+Crash workers store crashes concurrently, so checking a hash and adding
+it after storing the crash isn't enough: a hash is reserved, atomically,
+before storing the crash and it's added or released after.
+@author: joxean
+"""
+
+import sys
+import math
+import time
+
+from hashlib import sha1
+from threading import Lock
+
+from nfp_log import log, debug
+
+#-----------------------------------------------------------------------
+# Crash hashes shorter than this are not considered for duplicates
+MIN_CRASH_HASH_LENGTH = 30
+# Number of seconds after which the projects' ignore_duplicates flags
+# are read again from the database.
+PROJECTS_REFRESH_INTERVAL = 30
+
+#-----------------------------------------------------------------------
+class CBloomFilter:
+  def __init__(self, capacity=10000, error_rate=0.001):
+    self.capacity = max(capacity, 1)
+    self.error_rate = error_rate
+    self.size = int(math.ceil(-self.capacity * math.log(error_rate) / (math.log(2) ** 2)))
+    self.hashes = max(int(round(self.size * math.log(2) / self.capacity)), 1)
+    self.bits = bytearray((self.size + 7) / 8)
+    self.count = 0
+
+  def get_positions(self, key):
+    # Double hashing: g_i(x) = h1(x) + i*h2(x)
+    digest = sha1(key).hexdigest()
+    h1 = int(digest[:16], 16)
+    h2 = int(digest[16:32], 16) | 1
+    for i in xrange(self.hashes):
+      yield (h1 + i * h2) % self.size
+
+  def add(self, key):
+    for pos in self.get_positions(key):
+      self.bits[pos >> 3] |= 1 << (pos & 7)
+    self.count += 1
+
+  def __contains__(self, key):
+    for pos in self.get_positions(key):
+      if not self.bits[pos >> 3] & (1 << (pos & 7)):
+        return False
+    return True
+
+  def is_full(self):
+    return self.count >= self.capacity
+
+#-----------------------------------------------------------------------
+class CCrashHashIndex:
+  def __init__(self, db):
+    self.db = db
+    self.lock = Lock()
+    # project_id -> set of crash hashes
+    self.hashes = {}
+    # project_id -> set of crash hashes reserved and not stored yet
+    self.pending = {}
+    # project_id -> ignore_duplicates flag
+    self.ignore_duplicates = {}
+    self.bloom = CBloomFilter()
+    self.last_refresh = 0
+
+  def get_key(self, project_id, crash_hash):
+    return "%s:%s" % (project_id, crash_hash)
+
+  def load(self):
+    """ Warm the index with all the crash hashes in the database. """
+    log("Loading crash hashes index...")
+    self.refresh_projects()
+
+    what = "project_id, crash_hash"
+    where = "crash_hash is not null and length(crash_hash) >= $length"
+    vars = {"length":MIN_CRASH_HASH_LENGTH}
+    res = self.db.select("crashes", what=what, where=where, vars=vars)
+
+    self.lock.acquire()
+    try:
+      self.hashes = {}
+      for row in res:
+        self.hashes.setdefault(row.project_id, set()).add(row.crash_hash)
+
+      total = sum(map(len, self.hashes.values()))
+      self.bloom = CBloomFilter(capacity=max(total * 2, 10000))
+      for project_id in self.hashes:
+        for crash_hash in self.hashes[project_id]:
+          self.bloom.add(self.get_key(project_id, crash_hash))
+    finally:
+      self.lock.release()
+
+    log("Total of %d crash hash(es) loaded" % total)
+
+  def refresh_projects(self):
+    res = self.db.select("projects", what="project_id, ignore_duplicates")
+    flags = {}
+    for row in res:
+      flags[row.project_id] = row.ignore_duplicates == 1
+    self.ignore_duplicates = flags
+    self.last_refresh = time.time()
+
+  def should_ignore_duplicates(self, project_id):
+    if time.time() - self.last_refresh > PROJECTS_REFRESH_INTERVAL or \
+       project_id not in self.ignore_duplicates:
+      self.refresh_projects()
+    return self.ignore_duplicates.get(project_id, False)
+
+  def crash_exists_in_db(self, project_id, crash_hash):
+    what = "1"
+    vars = {"project_id":project_id, "crash_hash":crash_hash}
+    where = "project_id = $project_id and crash_hash = $crash_hash "
+    res = self.db.select("crashes", what=what, where=where, vars=vars, limit=1)
+    return len(list(res)) > 0
+
+  def add(self, project_id, crash_hash):
+    if crash_hash is None or len(crash_hash) < MIN_CRASH_HASH_LENGTH:
+      return
+
+    self.lock.acquire()
+    try:
+      self.pending.get(project_id, set()).discard(crash_hash)
+      hashes = self.hashes.setdefault(project_id, set())
+      if crash_hash in hashes:
+        return
+      hashes.add(crash_hash)
+
+      if self.bloom.is_full():
+        # Rebuild a bigger filter from the exact sets
+        total = sum(map(len, self.hashes.values()))
+        debug("Growing crash hashes Bloom filter to %d element(s)" % (total * 2))
+        self.bloom = CBloomFilter(capacity=total * 2)
+        for tmp_id in self.hashes:
+          for tmp_hash in self.hashes[tmp_id]:
+            self.bloom.add(self.get_key(tmp_id, tmp_hash))
+      else:
+        self.bloom.add(self.get_key(project_id, crash_hash))
+    finally:
+      self.lock.release()
+
+  def contains(self, project_id, crash_hash):
+    """ Must be called with the lock held. """
+    if self.get_key(project_id, crash_hash) not in self.bloom:
+      return False
+    return crash_hash in self.hashes.get(project_id, ())
+
+  def reserve(self, project_id, crash_hash):
+    """ Return True if the crash must be stored, reserving its hash, or
+        False if it's a duplicate. The caller must add() the hash after
+        storing the crash or release() it if it couldn't. """
+    if crash_hash is None or len(crash_hash) < MIN_CRASH_HASH_LENGTH:
+      return True
+
+    if not self.should_ignore_duplicates(project_id):
+      return True
+
+    self.lock.acquire()
+    try:
+      # Reserved by another worker means it's being stored right now
+      pending = self.pending.setdefault(project_id, set())
+      if crash_hash in pending or self.contains(project_id, crash_hash):
+        return False
+      pending.add(crash_hash)
+    finally:
+      self.lock.release()
+
+    # Not seen by this process, but it may have been stored by another
+    # engine process.
+    try:
+      exists = self.crash_exists_in_db(project_id, crash_hash)
+    except:
+      self.release(project_id, crash_hash)
+      raise
+
+    if exists:
+      self.add(project_id, crash_hash)
+      return False
+    return True
+
+  def release(self, project_id, crash_hash):
+    """ Release the hash reserved for a crash that couldn't be stored. """
+    self.lock.acquire()
+    try:
+      self.pending.get(project_id, set()).discard(crash_hash)
+    finally:
+      self.lock.release()
@@ -0,0 +1,84 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Nightmare Fuzzing Project
+Adaptive depth of the samples tubes.
+
+Instead of always filling a tube up to the project's maximum_samples, the
+rate at which the fuzzers consume (delete) jobs from the tube is measured
+with an exponentially weighted moving average and the tube is only
+filled with the samples needed to cover @seconds seconds of consumption.
+The project's maximum_samples is used as a hard cap.
+@author: joxean
+"""
+
+import math
+import time
+
+from nfp_log import log, debug
+
+#-----------------------------------------------------------------------
+# Number of seconds of consumption to keep in the tubes
+DEFAULT_DEPTH_SECONDS = 30
+# Minimum number of jobs to keep in a tube
+DEFAULT_MIN_DEPTH = 10
+# Weight of the new measures in the moving average
+RATE_ALPHA = 0.3
+# Minimum number of seconds between measures of the same tube
+MIN_MEASURE_INTERVAL = 1
+
+#-----------------------------------------------------------------------
+class CTubeRate:
+  def __init__(self):
+    self.deletes = None
+    self.last_measure = 0
+    self.rate = None
+    self.target = None
+
+#-----------------------------------------------------------------------
+class CQueueDepth:
+  def __init__(self, seconds=DEFAULT_DEPTH_SECONDS, minimum=DEFAULT_MIN_DEPTH):
+    self.seconds = seconds
+    self.minimum = minimum
+    # tube name -> CTubeRate
+    self.tubes = {}
+
+  def measure(self, tube, stats):
+    """ Update the drain rate of @tube with its beanstalk statistics. """
+    now = time.time()
+    rate = self.tubes.setdefault(tube, CTubeRate())
+    elapsed = now - rate.last_measure
+    if rate.deletes is not None and elapsed < MIN_MEASURE_INTERVAL:
+      return rate
+
+    deletes = stats["cmd-delete"]
+    if rate.deletes is not None and deletes >= rate.deletes:
+      current = (deletes - rate.deletes) / elapsed
+      if rate.rate is None:
+        rate.rate = current
+      else:
+        rate.rate = RATE_ALPHA * current + (1 - RATE_ALPHA) * rate.rate
+
+    # A lower value means the beanstalk server was restarted
+    rate.deletes = deletes
+    rate.last_measure = now
+    return rate
+
+  def get_target(self, tube, stats, maximum):
+    """ Return the number of jobs that should be in @tube, never more
+        than @maximum. """
+    if self.seconds <= 0:
+      return maximum
+
+    rate = self.measure(tube, stats)
+    if rate.rate is None:
+      # Nothing measured yet, don't starve the fuzzers
+      target = maximum
+    else:
+      target = int(math.ceil(rate.rate * self.seconds))
+      target = min(max(target, self.minimum), maximum)
+
+    if target != rate.target:
+      debug("Target depth of tube %s is %d job(s)" % (tube, target))
+      rate.target = target
+    return target
@@ -7,24 +7,64 @@ This is the generator of samples based on the configure project engines.
 """
 
 import os
+import re
 import sys
+import stat
 import time
+import errno
 import json
-import zlib
-import base64
 import random
 import shutil
+import signal
 import tempfile
 
 from hashlib import sha1
-from threading import Lock
-from multiprocessing import Process
+from threading import Lock, Thread, Event
+from multiprocessing import Process, cpu_count
 
 from nfp_db import webpy_connect_db as connect_db, init_web_db
-from nfp_queue import get_queue
-from nfp_process import process_manager
+from nfp_queue import get_queue, new_queue, queue_pool
+from nfp_queue_local import DEFAULT_TTR
+from nfp_shards import CShardedEngine
+from nfp_affinity import pin_to_reserved_cpus
+from nfp_mutators import CMutatorsLoader, mutate_file, replace_config_vars, \
+                         run_mutator_commands
+from nfp_templates import CTemplatesCache, WEIGHTING_UNIFORM
+from nfp_statistics import CStatisticsAggregator, DEFAULT_FLUSH_SAMPLES, \
+                           DEFAULT_FLUSH_INTERVAL
+from nfp_crash_index import CCrashHashIndex
+from nfp_scheduler import CProjectScheduler
+from nfp_depth import CQueueDepth, DEFAULT_DEPTH_SECONDS, DEFAULT_MIN_DEPTH
+from nfp_frame import encode_sample, encode_seeded_sample, decode_crash, \
+                      encode_local_sample, \
+                      decode_deletes, COMPRESSION_ZLIB, \
+                      DEFAULT_COMPRESS_THRESHOLD
 from nfp_log import log as nfplog, debug
 
+#-----------------------------------------------------------------------
+# Default maximum number of samples generated and enqueued per batch.
+# It can be changed with the SAMPLES_BATCH_SIZE configuration value.
+DEFAULT_BATCH_SIZE = 20
+
+# Default number of threads storing crashes. It can be changed with the
+# CRASH_WORKERS configuration value.
+DEFAULT_CRASH_WORKERS = 2
+
+# Number of seconds after which crash workers read again the list of
+# enabled projects' tubes.
+TUBES_REFRESH_INTERVAL = 10
+
+# Temporary files older than this number of seconds are considered left
+# behind by dead fuzzers and removed. It can be changed with the
+# TEMPORARY_FILES_TTL configuration value, 0 disables it.
+DEFAULT_TEMPORARY_FILES_TTL = 3600
+# Maximum number of delete jobs reserved at once by the delete worker
+DELETE_RESERVE_BATCH = 16
+# Number of seconds between sweeps of the temporary directory
+SWEEP_INTERVAL = 300
+# Names of the files created by tempfile.mktemp()
+TEMPORARY_FILE_RE = re.compile(r"^tmp[a-zA-Z0-9_]{6}(\.diff)?$")
+
 #-----------------------------------------------------------------------
 log_lock = Lock()
 def log(msg):
@@ -35,183 +75,104 @@ def log(msg):
     log_lock.release()
 
 #-----------------------------------------------------------------------
-class CSamplesGenerator:
-  def __init__(self):
-    self.db = init_web_db()
-    self.db.printing = False
-    self.read_config()
-    
-    self.queue_lock = Lock()
-
-  def read_config(self):
-    log("Reading configuration from database...")
-    self.config = {}
-    res = self.db.select("config", what="name, value")
-    for row in res:
-      self.config[row.name] = row.value
-      log("Configuration value %s is %s" % (row.name, row.value))
-
-    # Create the corresponding directory if it doesn't exists
-    if not os.path.exists(self.config["SAMPLES_PATH"]):
-      os.makedirs(self.config["SAMPLES_PATH"])
+def remove_sample_files(temp_file):
+  log("Removing temporary file %s" % temp_file)
+  try:
+    os.remove(temp_file)
+  except:
+    pass
 
-    # In Linux, it's recommended to use /dev/shm for speed improvements
-    if not "TEMPORARY_PATH" in self.config:
-      if os.path.exists("/dev/shm"):
-        try:
-          os.mkdir("/dev/shm/nfp")
-        except:
-          if os.path.exists("/dev/shm/nfp"):
-            self.config["TEMPORARY_PATH"]  = "/dev/shm/nfp"
-      self.config["TEMPORARY_PATH"] = None
-    
-    if self.config["TEMPORARY_PATH"] is not None:
-      if not os.path.exists(self.config["TEMPORARY_PATH"]):
-        os.mkdir(self.config["TEMPORARY_PATH"])
+  if os.path.exists("%s.diff" % temp_file):
+    log("Removing temporary diff file %s" % temp_file)
+    os.remove("%s.diff" % temp_file)
 
-  def get_project_engines(self):
-    res = self.db.query(""" select p.name project_name,
-                                   subfolder,
-                                   tube_prefix,
-                                   command,
-                                   maximum_samples,
-                                   p.project_id project_id,
-                                   me.mutation_engine_id mutation_engine_id,
-                                   me.name mutation_generator
-                              from projects p,
-                                   project_engines pe,
-                                   mutation_engines me
-                             where p.project_id = pe.project_id
-                               and me.mutation_engine_id = pe.mutation_engine_id
-                               and p.enabled = 1
-                               and ifnull((select iteration
-                                      from statistics s
-                                     where project_id = p.project_id
-                                       and mutation_engine_id = -1), 0) < p.maximum_iteration
-                             order by rand()""")
-    return res
+#-----------------------------------------------------------------------
+class CCrashWorker(Thread):
+  """ Thread storing in the database the crashes found by the fuzzers.
+      Every worker has its own database and queue connections and
+      watches the crash tubes of all the enabled projects, so a total of
+      N workers store, at most, N crashes concurrently without blocking
+      the samples generator. """
+  def __init__(self, config, crash_index, statistics, scheduler):
+    Thread.__init__(self)
+    self.daemon = True
+    self.config = config
+    self.crash_index = crash_index
+    self.statistics = statistics
+    self.scheduler = scheduler
+
+    self.db = None
+    self.q = None
+    # Dictionary of crash tube -> project_id
+    self.tubes = {}
+    self.last_refresh = 0
+    self.stop_event = Event()
+
+  def stop(self):
+    self.stop_event.set()
+
+  def refresh_tubes(self):
+    what = "project_id, tube_prefix"
+    res = self.db.select("projects", what=what, where="enabled = 1")
+    tubes = {}
+    for row in res:
+      tubes["%s-crash" % row.tube_prefix] = row.project_id
 
-  def read_random_file(self, folder):
-    basepath = os.path.join(self.config["TEMPLATES_PATH"], folder)
-    files = os.listdir(basepath)
-    filename = random.choice(files)
-    return os.path.join(basepath, filename)
+    self.tubes = tubes
+    self.last_refresh = time.time()
+    if len(tubes) == 0:
+      return
 
-  def get_command(self, cmd, filename, subfolder):
-    cmd = cmd.replace("%INPUT%", '"%s"' % filename)
-    temp_file = tempfile.mktemp(dir=self.config["TEMPORARY_PATH"])
-    cmd = cmd.replace("%OUTPUT%", temp_file)
-    cmd = cmd.replace("%FOLDER%", subfolder)
-    for key in self.config:
-      value = "%" + key + "%"
-      cmd = cmd.replace(value, self.config[key])
-    return cmd, temp_file
+    if self.q is None:
+      self.q = new_queue(tubes.keys()[0], watch=True)
 
-  def create_sample(self, pe):
-    subfolder = pe.subfolder
-    tube_prefix = pe.tube_prefix
-    command = pe.command
-    project_id = pe.project_id
-    mutation_engine_id = pe.mutation_engine_id
+    for tube in set(tubes) - self.q.watched:
+      self.q.watch(tube)
+    for tube in self.q.watched - set(tubes):
+      self.q.ignore(tube)
 
-    filename = self.read_random_file(subfolder)
-    debug("Random template file %s" % filename)
-    cmd, temp_file = self.get_command(command, filename, subfolder)
-    log("Generating mutated file %s" % temp_file)
-    debug("*** Command: %s" % cmd)
-    os.system(cmd)
+  def run(self):
+    self.db = init_web_db()
+    self.db.printing = False
 
-    self.queue_lock.acquire()
-    try:
-      log("Putting it in queue and updating statistics...")
-      buf = file(temp_file, "rb").read()
-      q = get_queue(watch=False, name="%s-samples" % tube_prefix)
-      json_buf = json.dumps([base64.b64encode(buf), temp_file])
-      q.put(json_buf)
-      self.update_statistics(project_id, mutation_engine_id)
-      self.update_iteration(project_id)
-    except:
-      log("Error putting job in queue: %s" % str(sys.exc_info()[1]))
-      log("Removing temporary file %s" % temp_file)
+    while not self.stop_event.is_set():
       try:
-        os.remove(temp_file)
-      except:
-        pass
+        if time.time() - self.last_refresh > TUBES_REFRESH_INTERVAL:
+          self.refresh_tubes()
 
-      if os.path.exists("%s.diff" % temp_file):
-        log("Removing temporary diff file %s" % temp_file)
-        os.remove("%s.diff" % temp_file)
-    finally:
-      self.queue_lock.release()
+        if self.q is None or len(self.tubes) == 0:
+          self.stop_event.wait(1)
+          continue
 
-  def update_iteration(self, project_id):
-    what = "statistic_id, iteration iter_value"
-    vars = {"project_id":project_id}
-    where = "project_id = $project_id and mutation_engine_id = -1"
-    res = self.db.select("statistics", what=what, where=where, vars=vars)
-    res = list(res)
-    with self.db.transaction():
-      if len(res) == 0:
-        print "insert"
-        self.db.insert("statistics", project_id=project_id,
-                       mutation_engine_id=-1, total=0, iteration=0)
-      else:
-        row = res[0]
-        vars = {"id":row.statistic_id}
-        where = "statistic_id = $id"
-        iter_value = row.iter_value
-        if row.iter_value is None:
-          iter_value = 0
-        total = self.db.update("statistics", iteration=iter_value+1, where=where, vars=vars)
-
-  def update_statistics(self, project_id, mutation_engine_id):
-    sql = "select statistic_id, total, iteration from statistics where project_id = %s and mutation_engine_id = %s"
-    what = "statistic_id, total, iteration"
-    vars = {"project_id":project_id, "mutation_engine_id":mutation_engine_id}
-    where = "project_id = $project_id and mutation_engine_id = $mutation_engine_id"
-    res = self.db.select("statistics", what=what, where=where, vars=vars)
-    res = list(res)
-    with self.db.transaction():
-      if len(res) == 0:
-        self.db.insert("statistics", project_id=project_id,
-                       mutation_engine_id=mutation_engine_id, total=1)
-      else:
-        row = res[0]
-        vars = {"id":row.statistic_id}
-        where = "statistic_id = $id"
-        total = self.db.update("statistics", total=row.total+1, iteration=row.iteration+1, where=where, vars=vars)
+        job = self.q.reserve(timeout=1)
+        if job is not None:
+          self.process_job(job)
+      except:
+        log("Error in crash worker: %s" % str(sys.exc_info()[1]))
+        self.stop_event.wait(1)
 
-  def queue_is_full(self, prefix, maximum):
-    tube_name = "%s-samples" % prefix
-    q = get_queue(watch=True, name=tube_name)
-    value = q.stats_tube(tube_name)["current-jobs-ready"]
-    debug("Total of %d job(s) in queue" % value)
-    return value > maximum-1
+    if self.q is not None:
+      self.q.close()
 
-  def get_pending_elements(self, prefix, maximum):
-    tube_name = "%s-samples" % prefix
-    q = get_queue(watch=True, name=tube_name)
-    value = q.stats_tube(tube_name)["current-jobs-ready"]
-    debug("Total of %d job(s) in queue" % value)
-    return maximum-value
-
-  def remove_obsolete_files(self):
-    q = get_queue(watch=True, name="delete")
-    while q.stats_tube("delete")["current-jobs-ready"] > 0:
-      self.find_crashes()
-      job = q.reserve()
-      if job.body.find(".") > -1 or job.body.find("/") > -1:
-        raise Exception("Invalid filename %s" % job.body)
-      sample_file = os.path.join(self.config["TEMPORARY_PATH"], job.body)
-      log("Deleting sample file %s" % sample_file)
+  def process_job(self, job):
+    tube = job.stats()["tube"]
+    if tube not in self.tubes:
+      # The project was disabled or its tube prefix changed
+      job.release()
+      self.last_refresh = 0
+      return
 
-      try:
-        os.remove(sample_file)
-        if os.path.exists(sample_file + ".diff"):
-          os.remove(sample_file + ".diff")
-      except:
-        log("Error removing temporary file: %s" % str(sys.exc_info()[1]))
+    try:
+      project_id = self.tubes[tube]
+      temp_file, crash_data, buf, diff = decode_crash(job.body)
+      if self.insert_crash(project_id, temp_file, crash_data, buf, diff):
+        self.scheduler.crash_found(project_id)
+      else:
+        self.scheduler.wake()
       job.delete()
+    except:
+      log("Error storing crash from tube %s, burying job %d: %s" % (tube, job.jid, str(sys.exc_info()[1])))
+      job.bury()
 
   def calculate_crash_hash(self, data):
     crash_hash = []
@@ -237,82 +198,65 @@ class CSamplesGenerator:
 
     return "".join(crash_hash)
 
-  def should_ignore_duplicates(self, project_id):
-    what = "1"
-    vars = {"project_id":project_id}
-    where = "project_id = $project_id and ignore_duplicates = 1"
-    res = self.db.select("projects", what=what, where=where, vars=vars)
-    res = list(res)
-    return len(res) > 0
-
-  def crash_exists(self, project_id, crash_hash):
-    what = "1"
-    vars = {"project_id":project_id, "crash_hash":crash_hash}
-    where = "project_id = $project_id and crash_hash = $crash_hash "
-    where += " and crash_hash is not null and crash_hash != ''"
-    where += " and length(crash_hash) >= 30"
-    res = self.db.select("crashes", what=what, where=where, vars=vars)
-    res = list(res)
-    return len(res) > 0
-
   def should_store_crash(self, project_id, crash_hash):
-    if self.should_ignore_duplicates(project_id) and \
-       self.crash_exists(project_id, crash_hash):
-      return False
-    return True
+    # Reserves the hash, other workers see the crash as a duplicate
+    return self.crash_index.reserve(project_id, crash_hash)
 
-  def insert_crash(self, project_id, temp_file, data):
-    has_file = "has_file" in data
+  def insert_crash(self, project_id, temp_file, data, buf=None, diff=None):
     crash_path = os.path.join(self.config["SAMPLES_PATH"], "crashes")
-    if not os.path.exists(temp_file) and not has_file:
-      log("Test case file %s does not exists!!!!" % temp_file)
-      return False
-    elif has_file:
-      # There is no file path but, rather, a whole zlib compressed file
-      # encoded in base64 so, create a temporary file and write to it
-      # the decoded base64 and decompressed zlib stream of data.
-      buf = temp_file
+    if buf is not None:
+      # There is no file path but, rather, the whole file was sent in the
+      # job so, create a temporary file and write it.
       temp_file = tempfile.mktemp(dir=self.config["TEMPORARY_PATH"])
 
       try:
         with open(temp_file, "wb") as f:
-          f.write(zlib.decompress(base64.b64decode(buf)))
+          f.write(buf)
+        if diff is not None:
+          with open(temp_file + ".diff", "wb") as f:
+            f.write("\n".join(diff))
       except:
-        os.remove(temp_file)
+        remove_sample_files(temp_file)
         raise
+    elif not os.path.exists(temp_file):
+      log("Test case file %s does not exists!!!!" % temp_file)
+      return False
 
-    buf = open(temp_file, "rb").read()
-    file_hash = sha1(buf).hexdigest()
-    new_path = os.path.join(crash_path, file_hash)
+    crash_hash = self.calculate_crash_hash(data)
+    if not self.should_store_crash(project_id, crash_hash):
+      log("Ignoring and removing already existing crash with hash %s" % crash_hash)
+      remove_sample_files(temp_file)
+      self.reset_iteration(project_id)
+      return False
 
-    sample_id = self.db.insert("samples", sample_hash=file_hash)
+    try:
+      buf = open(temp_file, "rb").read()
+      file_hash = sha1(buf).hexdigest()
+      new_path = os.path.join(crash_path, file_hash)
 
-    what = "count(*) cnt"
-    vars = {"id":project_id}
-    where = "project_id=$id"
-    res = self.db.select("statistics", what=what, where=where, vars=vars)
-    row = res[0]
-    total = row.cnt
+      sample_id = self.db.insert("samples", sample_hash=file_hash)
 
-    crash_hash = self.calculate_crash_hash(data)
-    store_crash = self.should_store_crash(project_id, crash_hash)
+      what = "count(*) cnt"
+      vars = {"id":project_id}
+      where = "project_id=$id"
+      res = self.db.select("statistics", what=what, where=where, vars=vars)
+      row = res[0]
+      total = row.cnt
 
-    if store_crash:
       log("Saving test file %s" % new_path)
       shutil.move(temp_file, new_path)
 
       if os.path.exists(temp_file + ".diff"):
         shutil.move(temp_file + ".diff", new_path + ".diff")
 
-    with self.db.transaction():
-      log("Inserting crash $PC 0x%08x Signal %s Exploitability %s Hash %s" % (data["pc"], data["signal"], data["exploitable"], crash_hash))
-      if data["disasm"] is not None:
-        disasm = "%08x %s" % (data["disasm"][0], data["disasm"][1])
-      else:
-        disasm = "None"
+      with self.db.transaction():
+        log("Inserting crash $PC 0x%08x Signal %s Exploitability %s Hash %s" % (data["pc"], data["signal"], data["exploitable"], crash_hash))
+        if data["disasm"] is not None:
+          disasm = "%08x %s" % (data["disasm"][0], data["disasm"][1])
+        else:
+          disasm = "None"
 
-      additional_info = json.dumps(data["additional"])
-      if store_crash:
+        additional_info = json.dumps(data["additional"])
         self.db.insert("crashes", project_id=project_id, sample_id=sample_id,
                        program_counter=data["pc"], crash_signal=data["signal"],
                        exploitability=data["exploitable"],
@@ -320,81 +264,459 @@ class CSamplesGenerator:
                        additional = str(additional_info),
                        crash_hash = crash_hash)
         log("Crash stored")
-      else:
-        log("Ignoring and removing already existing crash with hash %s" % crash_hash)
-        os.remove(temp_file)
+    except:
+      # Other workers would reject this crash forever as a duplicate
+      self.crash_index.release(project_id, crash_hash)
+      raise
 
-      self.reset_iteration(project_id)
+    self.crash_index.add(project_id, crash_hash)
+    self.reset_iteration(project_id)
+    return True
 
   def reset_iteration(self, project_id):
-    vars = {"project_id":project_id}
-    where = "project_id = $project_id and mutation_engine_id = -1"
-    self.db.update("statistics", iteration=0, where=where, vars=vars)
+    # The iteration counter is reset with the next statistics flush
+    self.statistics.reset_iteration(project_id)
 
-  def find_crashes(self):
-    what = "project_id, tube_prefix"
-    res = self.db.select("projects", what=what, where="enabled = 1")
+#-----------------------------------------------------------------------
+def get_temporary_path(config):
+  path = config["TEMPORARY_PATH"]
+  if path is None:
+    path = tempfile.gettempdir()
+  return path
+
+#-----------------------------------------------------------------------
+class CDeleteWorker(Thread):
+  """ Thread removing the files of the samples not causing a crash as
+      soon as the fuzzers put them in the delete tube and sweeping the
+      orphan temporary files. Every delete job wakes up the generator, as
+      the tube of some project has room for more samples. """
+  def __init__(self, config, temporary_ttl, scheduler):
+    Thread.__init__(self)
+    self.daemon = True
+    self.config = config
+    self.temporary_ttl = temporary_ttl
+    self.scheduler = scheduler
+
+    self.last_sweep = 0
+    self.stop_event = Event()
+
+  def stop(self):
+    self.stop_event.set()
+
+  def run(self):
+    q = None
+    while not self.stop_event.is_set():
+      try:
+        if q is None:
+          q = new_queue("delete", watch=True)
+
+        jobs = q.reserve_many(DELETE_RESERVE_BATCH, timeout=1)
+        if len(jobs) > 0:
+          for job in jobs:
+            self.remove_samples(decode_deletes(job.body))
+          q.delete_many(jobs)
+          self.scheduler.wake()
+
+        self.sweep_if_needed()
+      except:
+        log("Error in delete worker: %s" % str(sys.exc_info()[1]))
+        self.stop_event.wait(1)
+
+    if q is not None:
+      q.close()
+
+  def remove_samples(self, names):
+    path = get_temporary_path(self.config)
+    for name in names:
+      if name.find(".") > -1 or name.find("/") > -1:
+        log("Invalid filename %s, ignoring" % repr(name))
+        continue
+
+      sample_file = os.path.join(path, name)
+      for filename in [sample_file, sample_file + ".diff"]:
+        try:
+          os.remove(filename)
+        except OSError, e:
+          if e.errno != errno.ENOENT:
+            log("Error removing temporary file: %s" % str(e))
+    debug("Removed %d sample file(s)" % len(names))
+
+  def sweep_temporary_files(self):
+    """ Remove the samples and .diff files left behind by fuzzers that
+        died before putting the delete job. """
+    self.last_sweep = time.time()
+    path = get_temporary_path(self.config)
+    limit = time.time() - self.temporary_ttl
+
+    removed = 0
+    for name in os.listdir(path):
+      if not TEMPORARY_FILE_RE.match(name):
+        continue
+
+      filename = os.path.join(path, name)
+      try:
+        st = os.lstat(filename)
+        if stat.S_ISREG(st.st_mode) and st.st_mtime < limit:
+          os.remove(filename)
+          removed += 1
+      except OSError:
+        continue
+
+    if removed > 0:
+      log("Removed %d orphan temporary file(s) from %s" % (removed, path))
+
+  def sweep_if_needed(self):
+    if self.temporary_ttl > 0 and time.time() - self.last_sweep > SWEEP_INTERVAL:
+      self.sweep_temporary_files()
+
+#-----------------------------------------------------------------------
+class CSamplesGenerator:
+  """ Samples generator. When @assignment (a dictionary of project_id ->
+      shard_id) is given, it only creates samples for the projects of
+      the shard @shard_id and doesn't store crashes nor remove files, as
+      another process does it. """
+  def __init__(self, assignment=None, shard_id=None):
+    self.sharded = assignment is not None
+    self.db = init_web_db()
+    self.db.printing = False
+    self.read_config()
     
+    self.queue_lock = Lock()
+    self.mutators = CMutatorsLoader(self.config)
+    self.seeds = random.Random()
+
+    weighting = self.config.get("TEMPLATES_WEIGHTING", WEIGHTING_UNIFORM)
+    self.templates = CTemplatesCache(self.config["TEMPLATES_PATH"], weighting)
+
+    flush_samples = self.get_config_int("STATISTICS_FLUSH_SAMPLES", DEFAULT_FLUSH_SAMPLES)
+    flush_interval = self.get_config_int("STATISTICS_FLUSH_INTERVAL", DEFAULT_FLUSH_INTERVAL)
+    self.statistics = CStatisticsAggregator(self.db, flush_samples, flush_interval)
+
+    self.crash_index = CCrashHashIndex(self.db)
+    if not self.sharded:
+      self.crash_index.load()
+
+    get_projects = None
+    if self.sharded:
+      get_projects = lambda: set([project_id for project_id, shard in assignment.items() if shard == shard_id])
+    self.scheduler = CProjectScheduler(self.db, get_projects=get_projects)
+
+    depth_seconds = self.get_config_int("QUEUE_DEPTH_SECONDS", DEFAULT_DEPTH_SECONDS)
+    min_depth = self.get_config_int("QUEUE_MIN_DEPTH", DEFAULT_MIN_DEPTH)
+    self.depths = CQueueDepth(depth_seconds, min_depth)
+    self.last_depths = {}
+    self.workers = []
+
+  def read_config(self):
+    log("Reading configuration from database...")
+    self.config = {}
+    res = self.db.select("config", what="name, value")
     for row in res:
-      tube_name = "%s-crash" % row.tube_prefix
-      q = get_queue(watch=True, name=tube_name)
-      while q.stats_tube(tube_name)["current-jobs-ready"] > 0:
-        job = q.reserve()
-        crash_info = json.loads(job.body)
-        temp_file = crash_info.keys()[0]
-        crash_data = crash_info.values()[0]
-        self.insert_crash(row.project_id, temp_file, crash_data)
-        job.delete()
+      self.config[row.name] = row.value
+      log("Configuration value %s is %s" % (row.name, row.value))
+
+    # Create the corresponding directory if it doesn't exists
+    if not os.path.exists(self.config["SAMPLES_PATH"]):
+      os.makedirs(self.config["SAMPLES_PATH"])
+
+    # In Linux, it's recommended to use /dev/shm for speed improvements
+    if not "TEMPORARY_PATH" in self.config:
+      self.config["TEMPORARY_PATH"] = None
+      if os.path.exists("/dev/shm"):
+        try:
+          os.mkdir("/dev/shm/nfp")
+        except:
+          pass
+        if os.path.exists("/dev/shm/nfp"):
+          self.config["TEMPORARY_PATH"]  = "/dev/shm/nfp"
+    
+    if self.config["TEMPORARY_PATH"] is not None:
+      if not os.path.exists(self.config["TEMPORARY_PATH"]):
+        os.mkdir(self.config["TEMPORARY_PATH"])
+
+    # Maximum number of samples to create and enqueue at once
+    self.batch_size = self.get_config_int("SAMPLES_BATCH_SIZE", DEFAULT_BATCH_SIZE)
+    # Compression of the jobs put in the samples tubes
+    self.compression = self.config.get("JOBS_COMPRESSION", COMPRESSION_ZLIB)
+    self.compress_threshold = self.get_config_int("JOBS_COMPRESS_THRESHOLD",
+                                                  DEFAULT_COMPRESS_THRESHOLD)
+    # Time to run of the samples jobs of the projects without their own
+    self.job_ttr = self.get_config_int("JOBS_TTR", DEFAULT_TTR)
+    # Put only the path of the sample files in the samples tubes, for
+    # fuzzers running in this same box. With a TEMPORARY_PATH in a tmpfs
+    # (i.e., /dev/shm) samples are written once in memory and the targets
+    # read them from there.
+    self.local_samples = self.get_config_int("LOCAL_SAMPLES", 0) == 1
+    # Put only (template hash, mutator, seed) in the samples tubes for
+    # in-process mutators and let the fuzzers create the samples.
+    self.seeded_samples = self.get_config_int("SEEDED_SAMPLES", 0) == 1
+    # Orphan temporary files are removed after this number of seconds.
+    # Unless explicitly configured, don't touch the system's temporary
+    # directory, it's shared with other programs.
+    self.temporary_ttl = self.get_config_int("TEMPORARY_FILES_TTL",
+                                             DEFAULT_TEMPORARY_FILES_TTL)
+    if "TEMPORARY_FILES_TTL" not in self.config and \
+       os.path.realpath(get_temporary_path(self.config)) == os.path.realpath(tempfile.gettempdir()):
+      self.temporary_ttl = 0
+
+    # Maximum number of external mutators running at the same time
+    self.mutator_processes = self.get_config_int("MUTATOR_PROCESSES", cpu_count())
+    # Maximum number of crashes stored concurrently
+    self.total_crash_workers = self.get_config_int("CRASH_WORKERS", DEFAULT_CRASH_WORKERS)
+
+  def get_config_int(self, name, default):
+    try:
+      return int(self.config[name])
+    except (KeyError, TypeError, ValueError):
+      return default
+
+  def read_random_file(self, folder):
+    return self.templates.choose(folder)
+
+  def get_command(self, cmd, filename, subfolder):
+    cmd = cmd.replace("%INPUT%", '"%s"' % filename)
+    temp_file = tempfile.mktemp(dir=self.config["TEMPORARY_PATH"])
+    cmd = cmd.replace("%OUTPUT%", temp_file)
+    cmd = cmd.replace("%FOLDER%", subfolder)
+    cmd = replace_config_vars(cmd, self.config)
+    return cmd, temp_file
+
+  def mutate_samples(self, pe, total):
+    """ Create @total mutated samples for the project engine @pe. Python
+        mutators are called in-process, external commands are all run
+        from a single shell. Returns a list of (buffer, temporary file)
+        where the buffer is None if it must be read from disk. """
+    ret = []
+    cmds = []
+    external = []
+    mutator = self.mutators.get_mutator(pe.command)
+    for i in range(total):
+      filename = self.read_random_file(pe.subfolder)
+      debug("Random template file %s" % filename)
+      if mutator is not None:
+        temp_file = tempfile.mktemp(dir=self.config["TEMPORARY_PATH"])
+        log("Generating mutated file %s" % temp_file)
+        try:
+          ret.append([mutate_file(mutator, filename, temp_file), temp_file])
+        except:
+          log("Error running mutator: %s" % str(sys.exc_info()[1]))
+          remove_sample_files(temp_file)
+      else:
+        cmd, temp_file = self.get_command(pe.command, filename, pe.subfolder)
+        log("Generating mutated file %s" % temp_file)
+        debug("*** Command: %s" % cmd)
+        cmds.append(cmd)
+        external.append([None, temp_file])
+
+    if len(cmds) > 0:
+      failed = run_mutator_commands(cmds, self.mutator_processes)
+      for i, sample in enumerate(external):
+        if i in failed:
+          # Already logged, skip only this sample
+          remove_sample_files(sample[1])
+        else:
+          ret.append(sample)
+
+    return ret
+
+  def can_seed_samples(self, pe):
+    return self.seeded_samples and \
+           self.mutators.get_mutator(pe.command) is not None
+
+  def get_job_ttr(self, pe):
+    if pe.job_ttr is not None and int(pe.job_ttr) > 0:
+      return int(pe.job_ttr)
+    return self.job_ttr
+
+  def seed_samples(self, pe, total):
+    """ Create @total seeded jobs for the project engine @pe. Nothing is
+        written to disk, the fuzzers create the samples themselves. """
+    ret = []
+    index = self.templates.get_index(pe.subfolder)
+    mutator = os.path.basename(self.mutators.get_mutator_path(pe.command))
+    for i in range(total):
+      filename = index.choose()
+      seed = self.seeds.getrandbits(63)
+      debug("Seeded sample %d from template %s" % (seed, filename))
+      template_hash = index.get_hash(filename)
+      ret.append(encode_seeded_sample(template_hash, pe.subfolder, mutator,
+                                      seed, self.get_job_ttr(pe)))
+    return ret
+
+  def put_samples(self, q, samples, ttr):
+    jobs = []
+    temp_files = []
+    for buf, temp_file in samples:
+      try:
+        if self.local_samples:
+          if not os.path.exists(temp_file):
+            raise Exception("The mutator didn't create the file")
+          jobs.append(encode_local_sample(temp_file, ttr))
+        else:
+          if buf is None:
+            buf = file(temp_file, "rb").read()
+          jobs.append(encode_sample(buf, temp_file, self.compression,
+                                    self.compress_threshold, ttr))
+        temp_files.append(temp_file)
+      except:
+        log("Error reading sample %s: %s" % (temp_file, str(sys.exc_info()[1])))
+        remove_sample_files(temp_file)
+
+    if self.put_jobs(q, jobs, ttr) == 0:
+      for temp_file in temp_files:
+        remove_sample_files(temp_file)
+      return 0
+    return len(jobs)
+
+  def put_jobs(self, q, jobs, ttr):
+    if len(jobs) == 0:
+      return 0
+
+    try:
+      return len(q.put_many(jobs, ttr))
+    except:
+      log("Error putting jobs in queue: %s" % str(sys.exc_info()[1]))
+      return 0
+
+  def create_samples(self, pe, total=1):
+    seeded = self.can_seed_samples(pe)
+    if seeded:
+      samples = self.seed_samples(pe, total)
+    else:
+      samples = self.mutate_samples(pe, total)
+
+    self.queue_lock.acquire()
+    try:
+      log("Putting %d sample(s) in queue and updating statistics..." % len(samples))
+      q = get_queue(watch=False, name="%s-samples" % pe.tube_prefix)
+      ttr = self.get_job_ttr(pe)
+      if seeded:
+        queued = self.put_jobs(q, samples, ttr)
+      else:
+        queued = self.put_samples(q, samples, ttr)
+
+      if queued > 0:
+        self.statistics.add(pe.project_id, pe.mutation_engine_id, queued)
+    finally:
+      self.queue_lock.release()
+
+    return queued
+
+  def get_missing_samples(self, pe):
+    """ Return the number of jobs missing in the samples tube of the
+        project engine @pe to reach its adaptive target depth. """
+    tube_name = "%s-samples" % pe.tube_prefix
+    q = get_queue(watch=True, name=tube_name)
+    stats = q.stats_tube(tube_name)
+    value = stats["current-jobs-ready"]
+    target = self.depths.get_target(tube_name, stats, pe.maximum_samples)
+    if self.last_depths.get(pe.project_id) != target:
+      self.last_depths[pe.project_id] = target
+      self.statistics.set_queue_depth(pe.project_id, target)
+    debug("Total of %d job(s) in queue, target %d" % (value, target))
+    return target-value
+
+  def start_workers(self):
+    log("Starting %d crash worker(s) and the delete worker..." % self.total_crash_workers)
+    for i in range(self.total_crash_workers):
+      worker = CCrashWorker(self.config, self.crash_index, self.statistics,
+                            self.scheduler)
+      worker.start()
+      self.workers.append(worker)
+
+    worker = CDeleteWorker(self.config, self.temporary_ttl, self.scheduler)
+    worker.start()
+    self.workers.append(worker)
+
+  def stop_workers(self):
+    for worker in self.workers:
+      worker.stop()
+    for worker in self.workers:
+      worker.join(5)
+    self.workers = []
 
   def generate(self):
     log("Starting generator...")
+    if not self.sharded:
+      self.start_workers()
+
+    while 1:
+      # The batch is already adapted to the number of jobs the tube is
+      # missing and to the project's share.
+      batch = self.scheduler.next_batch(self.get_missing_samples, self.batch_size)
+      if batch is None:
+        self.statistics.flush_if_needed()
+        self.scheduler.wait()
+        continue
+
+      pe, total = batch
+      line = "Creating %d sample(s) for %s from folder %s for tube %s mutator %s"
+      log(line % (total, pe.project_name, pe.subfolder, pe.tube_prefix, pe.mutation_generator))
+      try:
+        queued = self.create_samples(pe, total)
+      except:
+        log("Error creating sample: %s" % str(sys.exc_info()[1]))
+        raise
+
+      self.scheduler.add_samples(pe.project_id, queued)
+      self.statistics.flush_if_needed()
+      if queued == 0:
+        self.scheduler.wait()
+
+  def ingest(self):
+    """ Only store crashes and remove obsolete files, the samples are
+        created by other processes. """
+    log("Starting crash ingestion...")
+    self.start_workers()
     while 1:
-      debug("Finding crashes...")
-      self.find_crashes()
-      debug("Checking files to remove...")
-      self.remove_obsolete_files()
-      debug("Reading project engines...")
-      project_engines = self.get_project_engines()
-      created = False
-
-      for pe in project_engines:
-        tube_prefix = pe.tube_prefix
-        maximum = pe.maximum_samples
-        if not self.queue_is_full(tube_prefix, maximum):
-          for i in range(self.get_pending_elements(tube_prefix, maximum)):
-            if self.queue_is_full(tube_prefix, maximum):
-              break
-
-            line = "Creating sample for %s from folder %s for tube %s mutator %s"
-            log(line % (pe.project_name, pe.subfolder, pe.tube_prefix, pe.mutation_generator))
-            try:
-              self.create_sample(pe)
-              created = True
-            except:
-              log("Error creating sample: %s" % str(sys.exc_info()[1]))
-              raise
-            #break
-
-      if not created:
-        time.sleep(0.1)
+      time.sleep(1)
+      self.statistics.flush_if_needed()
+
+  def shutdown(self):
+    log("Stopping workers...")
+    self.stop_workers()
+    log("Flushing statistics...")
+    self.statistics.flush()
+
+#-----------------------------------------------------------------------
+def sigterm_handler(signum, frame):
+  raise SystemExit("Terminated")
 
 #-----------------------------------------------------------------------
-def do_generate():
+def do_generate(assignment=None, shard_id=None, ingest=False):
+  signal.signal(signal.SIGTERM, sigterm_handler)
+  gen = None
   try:
-    gen = CSamplesGenerator()
-    gen.generate()
-  except KeyboardInterrupt:
-    log("Aborted")
-  except:
-    print "Error:", sys.exc_info()[1]
-    # Uncomment it for debugging purposes, not for the release
-    raise
+    try:
+      gen = CSamplesGenerator(assignment, shard_id)
+      if ingest:
+        gen.ingest()
+      else:
+        gen.generate()
+    except (KeyboardInterrupt, SystemExit):
+      log("Aborted")
+    except:
+      print "Error:", sys.exc_info()[1]
+      # Uncomment it for debugging purposes, not for the release
+      raise
+  finally:
+    if gen is not None:
+      gen.shutdown()
+    queue_pool.close_all()
+
+#-----------------------------------------------------------------------
+def do_ingest():
+  do_generate(ingest=True)
 
 #-----------------------------------------------------------------------
 def main():
+  # Keep the engine out of the fuzzers' CPUs
+  pin_to_reserved_cpus()
+
   procs = os.getenv("NIGHTMARE_PROCESSES")
   if procs is not None:
-    process_manager(int(procs), do_generate, [])
+    engine = CShardedEngine(int(procs), do_generate, do_ingest)
+    engine.run()
   else:
     do_generate()
 
@@ -0,0 +1,217 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Nightmare Fuzzing Project
+Fork server driver.
+
+The target is started once with the libfork_server.so shim preloaded
+(see fuzzers/extensions/fork_server.cpp). The shim stops it right before
+main and forks a new child every time it's asked to. The children read
+the sample from the same input given in the command line (or from the
+standard input, shared with the fork server), so the caller must write
+every new sample in it before calling run().
+@author: joxean
+"""
+
+import os
+import time
+import fcntl
+import errno
+import shlex
+import select
+import signal
+import struct
+import subprocess
+
+from nfp_log import log, debug
+from nfp_process import RETURN_SIGNALS
+from nfp_limits import get_default_limits
+
+#-----------------------------------------------------------------------
+# File descriptors used by the shim, the control fd and the next one for
+# the status.
+FORKSRV_FD = 198
+FORKSRV_HELLO = 0x4E465053
+
+# Maximum number of seconds to wait for the fork server to start or to
+# fork a new child.
+START_TIMEOUT = 10
+FORK_TIMEOUT = 5
+
+# Return codes of the signals considered a crash. Timed out children are
+# killed with SIGKILL, not in the list.
+CRASH_RETURN_CODES = [code for code, name in RETURN_SIGNALS.items()
+                      if code < 256 and name != "SIGTERM"]
+
+#-----------------------------------------------------------------------
+class CForkServerError(Exception):
+  pass
+
+class CForkServerStartError(CForkServerError):
+  """ The target couldn't start the fork server. """
+  pass
+
+#-----------------------------------------------------------------------
+class CForkServer:
+  """ Fork server for the command line @command, with @library being the
+      path to libfork_server.so. If given, @stdin is the file descriptor
+      used as the standard input of the target and its children. The
+      resource @limits, by default the ones of this process, are applied
+      to the fork server and inherited by the children. """
+  def __init__(self, command, library, stdin=None, limits=None):
+    self.command = command
+    self.library = os.path.abspath(library)
+    self.stdin = stdin
+    if limits is None:
+      limits = get_default_limits()
+    self.limits = limits
+    # The resource limit hit by the last child, if any
+    self.outcome = None
+    self.process = None
+    self.ctl_fd = None
+    self.st_fd = None
+
+  def is_running(self):
+    return self.process is not None and self.process.poll() is None
+
+  def start(self):
+    if not os.path.exists(self.library):
+      raise CForkServerStartError("Fork server library %s not found" % self.library)
+
+    ctl_r, ctl_w = os.pipe()
+    st_r, st_w = os.pipe()
+    # Our ends must not be inherited by the fork server (nor by any other
+    # process we start) or it will never see EOF when we die.
+    for fd in [ctl_w, st_r]:
+      fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+
+    def setup_fds():
+      os.dup2(ctl_r, FORKSRV_FD)
+      os.dup2(st_w, FORKSRV_FD + 1)
+      # Only FORKSRV_FD and FORKSRV_FD + 1 are left open in the target
+      for fd in [ctl_r, ctl_w, st_r, st_w]:
+        if fd not in [FORKSRV_FD, FORKSRV_FD + 1]:
+          os.close(fd)
+      if self.limits is not None:
+        self.limits.apply()
+
+    env = dict(os.environ)
+    preload = env.get("LD_PRELOAD")
+    if preload:
+      env["LD_PRELOAD"] = "%s:%s" % (self.library, preload)
+    else:
+      env["LD_PRELOAD"] = self.library
+
+    debug("Starting fork server for %s" % self.command)
+    devnull = open(os.devnull, "r+b")
+    stdin = self.stdin
+    if stdin is None:
+      stdin = devnull
+    try:
+      # No shell, it would be the one running the fork server
+      self.process = subprocess.Popen(shlex.split(self.command), env=env,
+                                      stdin=stdin, stdout=devnull,
+                                      stderr=devnull, preexec_fn=setup_fds)
+    finally:
+      devnull.close()
+      os.close(ctl_r)
+      os.close(st_w)
+
+    self.ctl_fd = ctl_w
+    self.st_fd = st_r
+    try:
+      hello = self.read_value(START_TIMEOUT)
+    except CForkServerError:
+      self.stop()
+      raise CForkServerStartError("The target didn't start the fork server, is it dynamically linked with glibc?")
+
+    if hello != FORKSRV_HELLO:
+      self.stop()
+      raise CForkServerStartError("Invalid fork server hello 0x%08x" % hello)
+    log("Fork server started with pid %d" % self.process.pid)
+
+  def stop(self):
+    for fd in [self.ctl_fd, self.st_fd]:
+      if fd is not None:
+        os.close(fd)
+    self.ctl_fd = None
+    self.st_fd = None
+
+    if self.process is not None:
+      try:
+        if self.process.poll() is None:
+          self.process.kill()
+        self.process.wait()
+      except OSError:
+        pass
+      self.process = None
+
+  def read_value(self, timeout):
+    """ Read a 4 bytes value from the status fd waiting, at most, @timeout
+        seconds or forever if it's None. """
+    buf = ""
+    deadline = None
+    if timeout is not None:
+      deadline = time.time() + timeout
+
+    while len(buf) < 4:
+      wait = None
+      if deadline is not None:
+        wait = max(deadline - time.time(), 0)
+      try:
+        ready = select.select([self.st_fd], [], [], wait)[0]
+      except select.error, e:
+        if e.args[0] == errno.EINTR:
+          continue
+        raise
+
+      if len(ready) == 0:
+        raise CForkServerError("Timeout reading from the fork server")
+
+      tmp = os.read(self.st_fd, 4 - len(buf))
+      if tmp == "":
+        raise CForkServerError("The fork server died")
+      buf += tmp
+    return struct.unpack("=I", buf)[0]
+
+  def run(self, timeout):
+    """ Run a new child and wait, at most, @timeout seconds for it. Return
+        the tuple (return code, timed out). The return code follows the
+        TimeoutCommand convention: 128 + signal for killed children. """
+    if self.limits is not None:
+      # Before starting it, it may create the cgroup
+      self.limits.prepare()
+    if not self.is_running():
+      self.start()
+
+    try:
+      os.write(self.ctl_fd, struct.pack("=I", 0))
+    except OSError, e:
+      raise CForkServerError("Error writing to the fork server: %s" % str(e))
+
+    pid = self.read_value(FORK_TIMEOUT)
+    timed_out = False
+    try:
+      status = self.read_value(timeout)
+    except CForkServerError:
+      if not self.is_running():
+        raise
+      timed_out = True
+      try:
+        os.kill(pid, signal.SIGKILL)
+      except OSError:
+        pass
+      status = self.read_value(FORK_TIMEOUT)
+
+    status = struct.unpack("=i", struct.pack("=I", status))[0]
+    if os.WIFSIGNALED(status):
+      ret = 128 + os.WTERMSIG(status)
+    else:
+      ret = os.WEXITSTATUS(status)
+
+    if self.limits is not None:
+      self.outcome = self.limits.check(ret, timed_out)
+    return ret, timed_out
+
+  def is_crash(self, ret):
+    return ret in CRASH_RETURN_CODES
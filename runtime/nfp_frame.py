@@ -0,0 +1,226 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Nightmare Fuzzing Project
+Binary envelope for the jobs put in the samples and crash tubes.
+
+Jobs used to be JSON documents with the whole sample encoded in base64,
+inflating every job by, at least, 33%. A framed job is:
+
+  magic (4 bytes) | version (1) | flags (1) | header size (4, big endian)
+  | JSON header | raw payload
+
+The payload is compressed with zlib (or lz4, if requested and available)
+only when it's bigger than a threshold and compressing actually saves
+space. Decoding falls back to the old JSON formats, so old clients and
+engines keep working during an upgrade.
+@author: joxean
+"""
+
+import json
+import zlib
+import base64
+import struct
+
+try:
+  import lz4.block as lz4_block
+  has_lz4 = True
+except ImportError:
+  has_lz4 = False
+
+#-----------------------------------------------------------------------
+FRAME_MAGIC = "NFPJ"
+FRAME_VERSION = 1
+FRAME_STRUCT = struct.Struct(">4sBBI")
+
+# Flags
+FLAG_ZLIB = 1
+FLAG_LZ4 = 2
+
+# Supported compression modes
+COMPRESSION_NONE = "none"
+COMPRESSION_ZLIB = "zlib"
+COMPRESSION_LZ4 = "lz4"
+
+# Payloads smaller than this number of bytes are never compressed
+DEFAULT_COMPRESS_THRESHOLD = 4096
+
+#-----------------------------------------------------------------------
+class CFrameError(Exception):
+  pass
+
+#-----------------------------------------------------------------------
+def compress(payload, compression, threshold):
+  if compression == COMPRESSION_NONE or len(payload) < threshold:
+    return payload, 0
+
+  if compression == COMPRESSION_LZ4 and has_lz4:
+    buf, flag = lz4_block.compress(payload), FLAG_LZ4
+  else:
+    # Favour speed, samples are compressed once and read once
+    buf, flag = zlib.compress(payload, 1), FLAG_ZLIB
+
+  if len(buf) >= len(payload):
+    return payload, 0
+  return buf, flag
+
+#-----------------------------------------------------------------------
+def decompress(payload, flags):
+  if flags & FLAG_LZ4:
+    if not has_lz4:
+      raise CFrameError("Job is lz4 compressed but lz4 is not available")
+    return lz4_block.decompress(payload)
+  elif flags & FLAG_ZLIB:
+    return zlib.decompress(payload)
+  return payload
+
+#-----------------------------------------------------------------------
+def is_frame(body):
+  return body[:len(FRAME_MAGIC)] == FRAME_MAGIC
+
+#-----------------------------------------------------------------------
+def encode_frame(header, payload="", compression=COMPRESSION_ZLIB,
+                 threshold=DEFAULT_COMPRESS_THRESHOLD):
+  payload, flags = compress(str(payload), compression, threshold)
+  json_header = json.dumps(header)
+  prefix = FRAME_STRUCT.pack(FRAME_MAGIC, FRAME_VERSION, flags, len(json_header))
+  return "".join([prefix, json_header, payload])
+
+#-----------------------------------------------------------------------
+def decode_frame(body):
+  """ Return the tuple (header, payload) of the framed job @body. """
+  if len(body) < FRAME_STRUCT.size:
+    raise CFrameError("Truncated job")
+
+  magic, version, flags, header_size = FRAME_STRUCT.unpack_from(body)
+  if magic != FRAME_MAGIC:
+    raise CFrameError("Invalid job magic %s" % repr(magic))
+  if version > FRAME_VERSION:
+    raise CFrameError("Unsupported job version %d" % version)
+
+  start = FRAME_STRUCT.size
+  end = start + header_size
+  if len(body) < end:
+    raise CFrameError("Truncated job header")
+
+  header = json.loads(body[start:end])
+  return header, decompress(body[end:], flags)
+
+#-----------------------------------------------------------------------
+def decode_header(body):
+  """ Return only the header of a job, without decompressing the payload.
+      Jobs in the old JSON formats have no header. """
+  if not is_frame(body) or len(body) < FRAME_STRUCT.size:
+    return {}
+
+  header_size = FRAME_STRUCT.unpack_from(body)[3]
+  start = FRAME_STRUCT.size
+  return json.loads(body[start:start+header_size])
+
+#-----------------------------------------------------------------------
+def encode_sample(buf, temp_file, compression=COMPRESSION_ZLIB,
+                  threshold=DEFAULT_COMPRESS_THRESHOLD, ttr=None):
+  """ Encode a samples job. The time to run @ttr, if given, tells the
+      fuzzer how often it must touch the job. """
+  header = {"temp_file":temp_file}
+  if ttr is not None:
+    header["ttr"] = ttr
+  return encode_frame(header, buf, compression, threshold)
+
+#-----------------------------------------------------------------------
+def encode_local_sample(temp_file, ttr=None):
+  """ Encode a sample for fuzzers running in the same box as the engine:
+      only the path of the sample file is sent and the fuzzer uses that
+      very same file. """
+  header = {"temp_file":temp_file, "local":True}
+  if ttr is not None:
+    header["ttr"] = ttr
+  return encode_frame(header, "", COMPRESSION_NONE)
+
+#-----------------------------------------------------------------------
+def is_local_sample(header):
+  return header.get("local", False)
+
+#-----------------------------------------------------------------------
+def encode_seeded_sample(template_hash, folder, mutator, seed, ttr=None):
+  """ Encode a sample the fuzzer must create itself by mutating, with the
+      mutator @mutator and the random seed @seed, the template whose SHA1
+      hash is @template_hash from the templates' subfolder @folder. """
+  header = {"template":template_hash, "folder":folder, "mutator":mutator,
+            "seed":seed}
+  if ttr is not None:
+    header["ttr"] = ttr
+  return encode_frame(header, "", COMPRESSION_NONE)
+
+#-----------------------------------------------------------------------
+def is_seeded_sample(header):
+  return "seed" in header
+
+#-----------------------------------------------------------------------
+def decode_sample_job(body):
+  """ Return the tuple (header, buffer) of a samples job, either framed
+      or in the old JSON format. """
+  if is_frame(body):
+    return decode_frame(body)
+
+  # Old format: [base64 buffer, temporary file]
+  buf, temp_file = json.loads(body)
+  return {"temp_file":temp_file}, base64.b64decode(buf)
+
+#-----------------------------------------------------------------------
+def decode_sample(body):
+  """ Return the tuple (buffer, temporary file) of a samples job. """
+  header, payload = decode_sample_job(body)
+  if is_seeded_sample(header):
+    raise CFrameError("Seeded samples must be created with CSeededSamples")
+  if is_local_sample(header):
+    payload = file(header["temp_file"], "rb").read()
+  return payload, header["temp_file"]
+
+#-----------------------------------------------------------------------
+def encode_crash(crash_info, temp_file=None, buf=None, diff=None,
+                 compression=COMPRESSION_ZLIB,
+                 threshold=DEFAULT_COMPRESS_THRESHOLD):
+  """ Encode a crash job. When the engine doesn't run in the same box,
+      @buf must contain the whole test case file and @diff, optionally,
+      the lines of its .diff file. """
+  header = {"temp_file":temp_file, "crash":crash_info, "has_file":buf is not None}
+  if diff is not None:
+    header["diff"] = diff
+  if buf is None:
+    buf = ""
+  return encode_frame(header, buf, compression, threshold)
+
+#-----------------------------------------------------------------------
+def decode_crash(body):
+  """ Return the tuple (temporary file, crash info, buffer, diff) of a
+      crash job. The buffer is None if the file must be read from disk
+      and the diff is None if it wasn't sent in the job. """
+  if is_frame(body):
+    header, payload = decode_frame(body)
+    if not header.get("has_file"):
+      payload = None
+    return header["temp_file"], header["crash"], payload, header.get("diff")
+
+  # Old format: {temporary file:crash info} or, if "has_file" is in the
+  # crash info, {base64 zlib compressed file:crash info}
+  crash = json.loads(body)
+  key = crash.keys()[0]
+  crash_info = crash[key]
+  if "has_file" in crash_info:
+    return None, crash_info, zlib.decompress(base64.b64decode(key)), None
+  return key, crash_info, None, None
+
+#-----------------------------------------------------------------------
+def encode_deletes(names):
+  """ Encode a job for the delete tube with the list of sample files'
+      basenames @names. """
+  return json.dumps(names)
+
+#-----------------------------------------------------------------------
+def decode_deletes(body):
+  """ Return the list of basenames to remove of a delete tube job. """
+  if body.startswith("["):
+    return json.loads(body)
+  # Old format: just one basename
+  return [body]
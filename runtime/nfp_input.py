@@ -0,0 +1,247 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Nightmare Fuzzing Project
+Delivery of the test cases to the targets.
+
+Every worker writes its test cases always in the same place instead of
+creating and removing a new temporary file per execution. Supported
+modes:
+
+ * file:  A per-worker file in a tmpfs directory (/dev/shm by default),
+          rewritten for every test case. The file keeps the configured
+          extension, so it's the only mode valid for targets guessing the
+          format by the file name.
+ * memfd: An anonymous memory file, the target reads it from the path
+          /proc/<worker pid>/fd/<fd>. Falls back to the file mode where
+          memfd_create() isn't supported.
+ * stdin: The test case is the target's standard input. Instead of a pipe
+          (fed by a thread and limited by the pipe's buffer) the target's
+          stdin is the memfd (or file) itself, rewound before every run,
+          so it works with debuggers and forked children too.
+
+Samples written by an engine running in this same box (LOCAL_SAMPLES) are
+hard linked as the per-worker file instead of copied, when it's in the
+same filesystem, so the target reads the engine's file itself.
+
+In the command line, @@ is replaced by the path of the test case (or by
+/dev/stdin in the stdin mode) and, without it, the path is appended.
+@author: joxean
+"""
+
+import os
+import sys
+import errno
+import tempfile
+import platform
+
+from nfp_log import log, debug
+
+#-----------------------------------------------------------------------
+INPUT_MODES = ["file", "memfd", "stdin"]
+DEFAULT_INPUT_MODE = "file"
+
+# Directory of the per-worker files when none is configured
+if os.path.isdir("/dev/shm"):
+  DEFAULT_INPUT_PATH = "/dev/shm"
+else:
+  DEFAULT_INPUT_PATH = tempfile.gettempdir()
+
+MFD_CLOEXEC = 1
+# Used only with a glibc older than 2.27 (no memfd_create wrapper)
+MEMFD_CREATE_SYSCALLS = {"x86_64":319, "i386":356, "i686":356,
+                         "aarch64":279, "armv7l":385}
+
+try:
+  import ctypes
+  libc = ctypes.CDLL(None, use_errno=True)
+  has_memfd = sys.platform.startswith("linux")
+except:
+  has_memfd = False
+
+#-----------------------------------------------------------------------
+def memfd_create(name):
+  """ Return a new memfd or None if they aren't supported. """
+  global has_memfd
+  if not has_memfd:
+    return None
+
+  try:
+    fd = libc.memfd_create(name, MFD_CLOEXEC)
+  except AttributeError:
+    syscall = MEMFD_CREATE_SYSCALLS.get(platform.machine())
+    if syscall is None:
+      has_memfd = False
+      return None
+    fd = libc.syscall(syscall, name, MFD_CLOEXEC)
+
+  if fd < 0:
+    if ctypes.get_errno() in [errno.ENOSYS, errno.EPERM]:
+      # Old kernel or forbidden by seccomp, don't try again
+      has_memfd = False
+    return None
+  return fd
+
+#-----------------------------------------------------------------------
+def build_command(command, filename):
+  """ Return the command line to run @command with the test case
+      @filename, None meaning the standard input. """
+  if filename is None:
+    return command.replace("@@", "/dev/stdin")
+  if command.find("@@") > -1:
+    return command.replace("@@", filename)
+  return "%s %s" % (command, filename)
+
+#-----------------------------------------------------------------------
+class CInputDelivery:
+  """ Deliver test cases to the targets using the mode @mode, one of
+      INPUT_MODES. The @extension and @path are only used by the per
+      worker files. """
+  def __init__(self, mode=DEFAULT_INPUT_MODE, extension="", path=None):
+    if mode not in INPUT_MODES:
+      raise Exception("Invalid input mode %s, valid modes: %s" % (mode, ", ".join(INPUT_MODES)))
+
+    self.mode = mode
+    self.extension = extension
+    if path is None:
+      path = DEFAULT_INPUT_PATH
+    self.path = path
+
+    self.fd = None
+    self.filename = None
+    self.saved_stdin = None
+    # Is the per-worker file a hard link to somebody else's file?
+    self.linked = False
+
+  def open(self):
+    if self.fd is not None:
+      return self.fd
+
+    if self.mode in ["memfd", "stdin"]:
+      self.fd = memfd_create("nightmare-input")
+      if self.fd is not None:
+        debug("Delivering test cases in the memfd %d" % self.fd)
+        return self.fd
+      log("memfd_create() isn't supported, delivering test cases in a file")
+
+    self.fd, self.filename = tempfile.mkstemp(prefix="nfp-input-",
+                                              suffix=self.extension,
+                                              dir=self.path)
+    debug("Delivering test cases in the file %s" % self.filename)
+    return self.fd
+
+  def close(self):
+    self.restore_stdin()
+    if self.fd is not None:
+      os.close(self.fd)
+      self.fd = None
+
+    if self.filename is not None:
+      try:
+        os.remove(self.filename)
+      except OSError:
+        pass
+      self.filename = None
+    self.linked = False
+
+  def replace_file(self, source=None):
+    """ Atomically replace the per-worker file with a hard link to the
+        file @source or, if it's None, with a new empty file. """
+    directory = os.path.dirname(self.filename)
+    if source is None:
+      fd, tmp = tempfile.mkstemp(prefix="nfp-input-", suffix=self.extension,
+                                 dir=directory)
+    else:
+      tmp = tempfile.mktemp(prefix="nfp-input-", suffix=self.extension,
+                            dir=directory)
+      os.link(source, tmp)
+      fd = os.open(tmp, os.O_RDONLY)
+
+    try:
+      os.rename(tmp, self.filename)
+    except OSError:
+      os.close(fd)
+      os.remove(tmp)
+      raise
+
+    os.close(self.fd)
+    self.fd = fd
+    self.linked = source is not None
+
+  def link(self, filename):
+    """ Make the file @filename the current test case without copying
+        it. Return False if it can't be linked and must be written. """
+    self.open()
+    if self.mode == "stdin" or self.filename is None:
+      return False
+
+    try:
+      self.replace_file(filename)
+    except OSError:
+      # I.e., in another filesystem
+      return False
+    return True
+
+  def write(self, buf):
+    """ Replace the current test case with @buf. """
+    fd = self.open()
+    if self.linked or \
+       (self.filename is not None and os.fstat(fd).st_nlink == 0):
+      # Never write in a linked file, it isn't ours, nor in a file that
+      # was replaced by a forked process sharing this delivery.
+      self.replace_file()
+      fd = self.fd
+    os.lseek(fd, 0, os.SEEK_SET)
+    total = 0
+    while total < len(buf):
+      total += os.write(fd, buf[total:])
+    # Truncate after writing, tmpfs pages are reused instead of freed
+    os.ftruncate(fd, len(buf))
+    os.lseek(fd, 0, os.SEEK_SET)
+
+  def get_path(self):
+    """ Return the path the target must read or None if the test case
+        is its standard input. """
+    fd = self.open()
+    if self.mode == "stdin":
+      return None
+    elif self.filename is not None:
+      return self.filename
+    return "/proc/%d/fd/%d" % (os.getpid(), fd)
+
+  def get_command(self, command):
+    return build_command(command, self.get_path())
+
+  def get_stdin(self):
+    """ Return the file descriptor to use as the target's standard input,
+        rewound, or None if it isn't used. """
+    if self.mode != "stdin":
+      return None
+    fd = self.open()
+    os.lseek(fd, 0, os.SEEK_SET)
+    return fd
+
+  def redirect_stdin(self):
+    """ Make the test case our standard input, inherited by the targets
+        launched by any debugging interface, until restore_stdin(). """
+    fd = self.get_stdin()
+    if fd is None or self.saved_stdin is not None:
+      return
+
+    try:
+      self.saved_stdin = os.dup(0)
+    except OSError:
+      # There was no standard input
+      self.saved_stdin = -1
+    os.dup2(fd, 0)
+
+  def restore_stdin(self):
+    if self.saved_stdin is None:
+      return
+
+    if self.saved_stdin == -1:
+      os.close(0)
+    else:
+      os.dup2(self.saved_stdin, 0)
+      os.close(self.saved_stdin)
+    self.saved_stdin = None
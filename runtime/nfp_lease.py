@@ -0,0 +1,159 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Nightmare Fuzzing Project
+Leases of reserved jobs.
+
+A reserved job must be deleted before its time to run (TTR) expires,
+otherwise the queue server hands it out again to another fuzzer and the
+same sample runs twice, sometimes storing the same crash twice. Slow
+targets (debugger launch retries, crash analysis, etc...) can easily take
+longer than the TTR, so while a job is leased a background thread touches
+it every time a fraction of its TTR passes.
+@author: joxean
+"""
+
+import sys
+import time
+
+from threading import Thread, Lock, Event
+
+from nfp_log import log, debug
+from nfp_queue_local import DEFAULT_TTR
+
+#-----------------------------------------------------------------------
+# Leased jobs are touched every time this fraction of their TTR passes
+TOUCH_FRACTION = 1/3.
+# Minimum number of seconds between touches of the same job
+MIN_TOUCH_INTERVAL = 0.5
+# Number of seconds between reports of the leases' statistics
+REPORT_INTERVAL = 300
+
+#-----------------------------------------------------------------------
+class CLease:
+  def __init__(self, job, ttr):
+    self.job = job
+    self.ttr = ttr
+    self.last_touch = time.time()
+    self.expired = False
+
+  def get_interval(self):
+    return max(self.ttr * TOUCH_FRACTION, MIN_TOUCH_INTERVAL)
+
+  def get_next_touch(self):
+    return self.last_touch + self.get_interval()
+
+#-----------------------------------------------------------------------
+class CLeaseManager(Thread):
+  """ Keep alive the jobs reserved with the CQueueConnection @q. Jobs
+      whose TTR is unknown are considered to have @default_ttr seconds. """
+  def __init__(self, q, default_ttr=DEFAULT_TTR):
+    Thread.__init__(self)
+    self.daemon = True
+    self.q = q
+    self.default_ttr = default_ttr
+
+    self.lock = Lock()
+    self.leases = {}
+    self.changed = Event()
+    self.stop_event = Event()
+
+    # Statistics
+    self.total_leases = 0
+    self.total_touches = 0
+    self.total_expired = 0
+    self.last_report = time.time()
+
+  def stop(self):
+    self.stop_event.set()
+    self.changed.set()
+
+  def acquire(self, job, ttr=None):
+    """ Start the lease of the reserved @job. """
+    if ttr is None:
+      ttr = self.default_ttr
+
+    self.lock.acquire()
+    try:
+      self.leases[job.jid] = CLease(job, ttr)
+      self.total_leases += 1
+    finally:
+      self.lock.release()
+    self.changed.set()
+
+  def release(self, job):
+    """ Stop touching @job. Return False if the lease expired before, so
+        the job was probably handed out to another fuzzer. """
+    self.lock.acquire()
+    try:
+      lease = self.leases.pop(job.jid, None)
+    finally:
+      self.lock.release()
+    return lease is not None and not lease.expired
+
+  def get_due_leases(self):
+    """ Return the tuple (leases to touch now, seconds to wait until the
+        next one must be touched). """
+    now = time.time()
+    due = []
+    wait = None
+    self.lock.acquire()
+    try:
+      for lease in self.leases.values():
+        if lease.expired:
+          continue
+
+        next_touch = lease.get_next_touch()
+        if next_touch <= now:
+          due.append(lease)
+          next_touch = now + lease.get_interval()
+
+        if wait is None or next_touch - now < wait:
+          wait = next_touch - now
+    finally:
+      self.lock.release()
+    return due, wait
+
+  def touch(self, leases):
+    lost = set(self.q.touch_many([lease.job for lease in leases]))
+    now = time.time()
+    self.lock.acquire()
+    try:
+      for lease in leases:
+        if self.leases.get(lease.job.jid) is not lease:
+          # Released meanwhile, it was probably deleted
+          continue
+
+        if lease.job.jid in lost:
+          lease.expired = True
+          self.total_expired += 1
+          log("Lease of job %d expired, it may run in another fuzzer" % lease.job.jid)
+        else:
+          lease.last_touch = now
+          self.total_touches += 1
+    finally:
+      self.lock.release()
+
+  def report_if_needed(self):
+    if time.time() - self.last_report < REPORT_INTERVAL:
+      return
+
+    self.last_report = time.time()
+    if self.total_leases > 0:
+      log("Job leases: %d leased, %d touch(es), %d expired" % (self.total_leases,
+          self.total_touches, self.total_expired))
+
+  def run(self):
+    while not self.stop_event.is_set():
+      # Clear it before looking at the leases, so no new lease is missed
+      self.changed.clear()
+      try:
+        due, wait = self.get_due_leases()
+        if len(due) > 0:
+          self.touch(due)
+        self.report_if_needed()
+      except:
+        log("Error touching jobs: %s" % str(sys.exc_info()[1]))
+        wait = 1
+
+      self.changed.wait(wait)
@@ -0,0 +1,314 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Nightmare Fuzzing Project
+Per execution resource limits of the targets.
+
+The limits are applied to every target launched with TimeoutCommand (so
+the ASAN and GDB interfaces and the coverage tools too), by the fork
+server or, in Linux, by the vtrace interface (to the already started
+target, with prlimit). They aren't supported by the pykd interface, a
+message is logged once when they're configured with it:
+
+ * Resource limits, inherited by the target: address space, CPU seconds,
+   file size and open files.
+ * Optionally, a cgroup v2 per worker with memory and CPU limits. The
+   given cgroup-path must be a cgroup v2 directory delegated to the user
+   running the fuzzers, with the memory and cpu controllers available.
+
+A target hitting a limit is reported as its own outcome (OOM, CPU time or
+file size) instead of a crash or a generic SIGTERM. The address space
+limit breaks ASAN and the binary instrumentation toolkits, as they reserve
+huge memory regions, use the cgroup memory limit with them.
+@author: joxean
+"""
+
+import os
+import sys
+import signal
+
+from nfp_log import log, debug
+
+try:
+  import resource
+  has_rlimits = True
+except ImportError:
+  # Windows
+  has_rlimits = False
+
+try:
+  import ctypes
+  libc = ctypes.CDLL(None, use_errno=True)
+  libc_prlimit = libc.prlimit
+  has_prlimit = sys.platform.startswith("linux")
+except:
+  # Not Linux or glibc older than 2.13
+  has_prlimit = False
+
+#-----------------------------------------------------------------------
+if has_prlimit:
+  class rlimit(ctypes.Structure):
+    _fields_ = [("rlim_cur", ctypes.c_ulong),
+                ("rlim_max", ctypes.c_ulong)]
+
+#-----------------------------------------------------------------------
+MB = 1024 * 1024
+# Period, in microseconds, of the cgroup's CPU limit
+CGROUP_CPU_PERIOD = 100000
+
+# Outcomes of the targets hitting a limit
+LIMIT_OOM = "OOM"
+LIMIT_CPU = "CPU time"
+LIMIT_FILE_SIZE = "file size"
+
+# Signals sent by the kernel when a resource limit is exceeded
+LIMIT_SIGNALS = {}
+if has_rlimits:
+  LIMIT_SIGNALS[128 + signal.SIGXCPU] = LIMIT_CPU
+  LIMIT_SIGNALS[128 + signal.SIGXFSZ] = LIMIT_FILE_SIZE
+  # The CPU hard limit is one second after the soft one
+  LIMIT_SIGNALS[128 + signal.SIGKILL] = LIMIT_CPU
+
+#-----------------------------------------------------------------------
+class CResourceLimits:
+  """ Resource limits of the targets launched by one worker. Memory and
+      file sizes are given in megabytes, @cpu in seconds and @cgroup_cpu
+      in percentage of one CPU. """
+  def __init__(self, memory=None, cpu=None, file_size=None, open_files=None,
+               cgroup_path=None, cgroup_memory=None, cgroup_cpu=None):
+    self.memory = memory
+    self.cpu = cpu
+    self.file_size = file_size
+    self.open_files = open_files
+    self.cgroup_path = cgroup_path
+    self.cgroup_memory = cgroup_memory
+    self.cgroup_cpu = cgroup_cpu
+
+    self.rlimits = []
+    if has_rlimits:
+      if memory is not None:
+        self.rlimits.append((resource.RLIMIT_AS, memory * MB, memory * MB))
+      if cpu is not None:
+        self.rlimits.append((resource.RLIMIT_CPU, cpu, cpu + 1))
+      if file_size is not None:
+        self.rlimits.append((resource.RLIMIT_FSIZE, file_size * MB, file_size * MB))
+      if open_files is not None:
+        self.rlimits.append((resource.RLIMIT_NOFILE, open_files, open_files))
+    elif memory or cpu or file_size or open_files:
+      log("Resource limits aren't supported in this platform, ignoring them")
+
+    # Created the first time a target is launched
+    self.cgroup = None
+    self.cgroup_failed = False
+    self.oom_kills = 0
+
+    self.last_outcome = None
+    self.hits = {}
+    # Interfaces already told the limits aren't applied
+    self.unsupported = set()
+
+  def get_settings(self):
+    return (self.memory, self.cpu, self.file_size, self.open_files,
+            self.cgroup_path, self.cgroup_memory, self.cgroup_cpu)
+
+  def uses_cgroup(self):
+    return self.cgroup_path is not None and \
+           (self.cgroup_memory is not None or self.cgroup_cpu is not None)
+
+  def write_cgroup_file(self, name, value, path=None):
+    if path is None:
+      path = self.cgroup
+    with open(os.path.join(path, name), "wb") as f:
+      f.write(value)
+
+  def create_cgroup(self):
+    """ Create the cgroup of this worker. Return False if it can't be
+        used, logging why only the first time. """
+    if self.cgroup is not None:
+      return True
+    if self.cgroup_failed:
+      return False
+
+    path = os.path.join(self.cgroup_path, "nightmare-%d" % os.getpid())
+    try:
+      if not os.path.exists(os.path.join(self.cgroup_path, "cgroup.controllers")):
+        raise OSError("%s isn't a cgroup v2 directory" % self.cgroup_path)
+
+      controllers = []
+      if self.cgroup_memory is not None:
+        controllers.append("+memory")
+      if self.cgroup_cpu is not None:
+        controllers.append("+cpu")
+      try:
+        self.write_cgroup_file("cgroup.subtree_control", " ".join(controllers), self.cgroup_path)
+      except IOError:
+        # Already enabled by whoever delegated it, hopefully
+        pass
+
+      if not os.path.isdir(path):
+        os.mkdir(path)
+
+      for name in ["memory.max", "cpu.max"]:
+        controller = "+" + name.split(".")[0]
+        if controller in controllers and not os.path.exists(os.path.join(path, name)):
+          os.rmdir(path)
+          raise OSError("The %s controller isn't enabled in %s" % (controller[1:], self.cgroup_path))
+
+      if self.cgroup_memory is not None:
+        self.write_cgroup_file("memory.max", str(self.cgroup_memory * MB), path)
+        if os.path.exists(os.path.join(path, "memory.swap.max")):
+          # Don't let the targets swap instead of being killed
+          self.write_cgroup_file("memory.swap.max", "0", path)
+
+      if self.cgroup_cpu is not None:
+        quota = max(int(CGROUP_CPU_PERIOD * self.cgroup_cpu / 100.), 1000)
+        self.write_cgroup_file("cpu.max", "%d %d" % (quota, CGROUP_CPU_PERIOD), path)
+    except (IOError, OSError):
+      log("Cannot use the cgroup %s, only the resource limits will be applied: %s" % (path, str(sys.exc_info()[1])))
+      self.cgroup_failed = True
+      return False
+
+    debug("Targets will run in the cgroup %s" % path)
+    self.cgroup = path
+    return True
+
+  def remove_cgroup(self):
+    if self.cgroup is not None:
+      try:
+        os.rmdir(self.cgroup)
+      except OSError:
+        # Some target is still alive
+        pass
+      self.cgroup = None
+
+  def get_oom_kills(self):
+    with open(os.path.join(self.cgroup, "memory.events"), "rb") as f:
+      for line in f.readlines():
+        if line.startswith("oom_kill "):
+          return int(line.split()[1])
+    return 0
+
+  def reset(self):
+    self.last_outcome = None
+
+  def prepare(self):
+    """ Called before launching a target, in the parent. """
+    self.reset()
+    if self.uses_cgroup() and self.create_cgroup() and self.cgroup_memory is not None:
+      self.oom_kills = self.get_oom_kills()
+
+  def apply(self):
+    """ Called in the target's process before the exec. Nothing can be
+        logged here, errors are silently ignored. """
+    for limit, soft, hard in self.rlimits:
+      try:
+        resource.setrlimit(limit, (soft, hard))
+      except (ValueError, resource.error):
+        pass
+
+    if self.cgroup is not None:
+      try:
+        # Writing 0 moves the writer itself
+        self.write_cgroup_file("cgroup.procs", "0")
+      except IOError:
+        pass
+
+  def apply_to(self, pid):
+    """ Called in the parent with the process @pid already started (i.e.,
+        stopped by a debugger after the exec). Return False if the
+        resource limits can't be applied this way in this platform. """
+    if len(self.rlimits) > 0:
+      if not has_prlimit:
+        return False
+      for limit, soft, hard in self.rlimits:
+        value = rlimit(soft, hard)
+        if libc_prlimit(pid, limit, ctypes.byref(value), None) != 0:
+          debug("Cannot set the resource limit %d of the process %d: %s" % \
+                (limit, pid, os.strerror(ctypes.get_errno())))
+
+    if self.cgroup is not None:
+      try:
+        self.write_cgroup_file("cgroup.procs", str(pid))
+      except IOError:
+        debug("Cannot move the process %d to the cgroup %s" % (pid, self.cgroup))
+    return True
+
+  def warn_unsupported(self, name):
+    """ Log, only once, that the limits aren't applied to the targets
+        launched by the interface @name. """
+    if name not in self.unsupported:
+      self.unsupported.add(name)
+      log("Resource limits aren't applied to the targets launched by %s, ignoring them" % name)
+
+  def check(self, ret, killed=False):
+    """ Called after the target with the return code @ret finished, with
+        @killed being True if we killed it (i.e., after a timeout). Return
+        the limit it hit or None. """
+    outcome = None
+    if self.cgroup is not None and self.cgroup_memory is not None:
+      try:
+        if self.get_oom_kills() > self.oom_kills:
+          outcome = LIMIT_OOM
+      except IOError:
+        pass
+
+    if outcome is None and not killed and ret in LIMIT_SIGNALS:
+      outcome = LIMIT_SIGNALS[ret]
+      if outcome == LIMIT_CPU and self.cpu is None:
+        # Killed by someone else
+        outcome = None
+      elif outcome == LIMIT_FILE_SIZE and self.file_size is None:
+        outcome = None
+
+    self.last_outcome = outcome
+    if outcome is not None:
+      self.hits[outcome] = self.hits.get(outcome, 0) + 1
+      log("Target hit the %s limit (%d time(s) so far)" % (outcome, self.hits[outcome]))
+    return outcome
+
+  def close(self):
+    self.remove_cgroup()
+
+#-----------------------------------------------------------------------
+def read_resource_limits(parser, section, current=None):
+  """ Read the resource limits of the section @section of the config
+      parser @parser. The @current limits are returned if they didn't
+      change, so their cgroup is reused. Return None if there are none. """
+  values = []
+  for name in ["limit-memory", "limit-cpu", "limit-file-size",
+               "limit-open-files"]:
+    try:
+      values.append(parser.getint(section, name))
+    except:
+      values.append(None)
+
+  try:
+    values.append(parser.get(section, 'cgroup-path'))
+  except:
+    values.append(None)
+
+  for name in ["cgroup-memory", "cgroup-cpu"]:
+    try:
+      values.append(parser.getint(section, name))
+    except:
+      values.append(None)
+
+  if current is not None:
+    if current.get_settings() == tuple(values):
+      return current
+    current.close()
+
+  if values.count(None) == len(values):
+    return None
+  return CResourceLimits(*values)
+
+#-----------------------------------------------------------------------
+# Limits applied by default to every target launched in this process
+default_limits = None
+
+def set_default_limits(limits):
+  global default_limits
+  default_limits = limits
+
+def get_default_limits():
+  return default_limits
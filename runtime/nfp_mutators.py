@@ -0,0 +1,195 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Nightmare Fuzzing Project
+In-process mutators support.
+
+Mutators written in Python may expose a module level MUTATOR_CLASS. The
+class is instantiated without arguments and must implement the method
+mutate(buf) returning a tuple (mutated buffer, diff) where diff is the
+list of changes to write in the .diff file (or None). The class may also
+define the attribute 'name' used in the .diff file header.
+
+Mutation engines whose command is a Python script exposing such a class
+and following the form "<script.py> %INPUT% %OUTPUT%" are loaded only
+once and called in-process. Any other command (radamsa, zzuf, wrappers
+creating multiple samples, etc...) is executed as an external command.
+@author: joxean
+"""
+
+import os
+import re
+import sys
+import imp
+import shlex
+import random
+import subprocess
+
+from nfp_log import log, debug
+from nfp_templates import CTemplatesCache
+
+#-----------------------------------------------------------------------
+MUTATOR_COMMAND_RE = re.compile(r'^\s*(?:python\s+)?"?([^"\s]+\.py)"?\s+%INPUT%\s+%OUTPUT%\s*$')
+SHELL_CHARS_RE = re.compile(r'[|&;<>()$`*?~]')
+
+#-----------------------------------------------------------------------
+def replace_config_vars(cmd, config):
+  for key in config:
+    value = "%" + key + "%"
+    if config[key] is not None:
+      cmd = cmd.replace(value, config[key])
+  return cmd
+
+#-----------------------------------------------------------------------
+def start_command(cmd):
+  """ Start the command @cmd. Return None if it can't be started, i.e.,
+      it doesn't exist or it has unbalanced quotes (a template's file
+      name with quotes in it). """
+  try:
+    if os.name == "nt":
+      return subprocess.Popen(cmd)
+    elif SHELL_CHARS_RE.search(cmd):
+      return subprocess.Popen(cmd, shell=True)
+    return subprocess.Popen(shlex.split(cmd))
+  except (OSError, ValueError):
+    log("Error running mutator command %s: %s" % (cmd, str(sys.exc_info()[1])))
+    return None
+
+#-----------------------------------------------------------------------
+def run_mutator_commands(cmds, max_procs):
+  """ Run the external mutators' commands @cmds, at most @max_procs at
+      the same time, and wait for all of them. A shell is only used for
+      commands using shell features (pipes, redirections, etc...). Return
+      the list of indexes of the commands that couldn't be started. """
+  running = []
+  failed = []
+  for i, cmd in enumerate(cmds):
+    if len(running) >= max(max_procs, 1):
+      running.pop(0).wait()
+    p = start_command(cmd)
+    if p is not None:
+      running.append(p)
+    else:
+      failed.append(i)
+
+  for p in running:
+    p.wait()
+  return failed
+
+#-----------------------------------------------------------------------
+def load_mutator_module(path):
+  mutators_dir = os.path.dirname(os.path.abspath(path))
+  if mutators_dir not in sys.path:
+    # Some mutators import other mutators
+    sys.path.append(mutators_dir)
+
+  name = os.path.splitext(os.path.basename(path))[0]
+  return imp.load_source("nfp_mutator_%s" % name, path)
+
+#-----------------------------------------------------------------------
+class CMutatorsLoader:
+  def __init__(self, config):
+    self.config = config
+    self.mutators = {}
+
+  def get_mutator_path(self, command):
+    """ Return the path of the Python script run by the mutation engine's
+        command @command or None if it isn't a Python mutator. """
+    match = MUTATOR_COMMAND_RE.match(command)
+    if not match:
+      return None
+
+    path = replace_config_vars(match.group(1), self.config)
+    if not os.path.isfile(path):
+      return None
+    return path
+
+  def load(self, command):
+    path = self.get_mutator_path(command)
+    if path is None:
+      return None
+
+    try:
+      module = load_mutator_module(path)
+    except:
+      log("Error loading mutator %s: %s" % (path, str(sys.exc_info()[1])))
+      return None
+
+    mutator_class = getattr(module, "MUTATOR_CLASS", None)
+    if mutator_class is None:
+      return None
+
+    log("Loaded in-process mutator %s" % path)
+    return mutator_class()
+
+  def get_mutator(self, command):
+    """ Return an in-process mutator for the mutation engine's command
+        @command or None if it must be executed as an external command. """
+    if command not in self.mutators:
+      self.mutators[command] = self.load(command)
+    return self.mutators[command]
+
+#-----------------------------------------------------------------------
+def get_mutator_name(mutator):
+  return getattr(mutator, "name", mutator.__class__.__name__)
+
+#-----------------------------------------------------------------------
+def mutate_seeded(mutator, buf, seed):
+  """ Mutate @buf with the global random generator seeded with @seed, so
+      the very same sample can be created again in another box. """
+  state = random.getstate()
+  random.seed(seed)
+  try:
+    buf, diff = mutator.mutate(buf)
+  finally:
+    random.setstate(state)
+  return str(buf), diff
+
+#-----------------------------------------------------------------------
+def mutate_file(mutator, template, output):
+  """ Mutate the @template file writing the result to @output and the
+      corresponding .diff file, if any. Returns the mutated buffer. """
+  buf, diff = mutator.mutate(open(template, "rb").read())
+  buf = str(buf)
+  with open(output, "wb") as f:
+    f.write(buf)
+
+  if diff is not None:
+    name = get_mutator_name(mutator)
+    with open(output + ".diff", "wb") as f:
+      f.write("# Original file created by '%s' was %s\n" % (name, template))
+      f.write("\n".join(map(str, diff)))
+
+  debug("Mutated file %s created in-process" % output)
+  return buf
+
+#-----------------------------------------------------------------------
+class CSeededSamples:
+  """ Create locally the samples of seeded jobs from a copy of the
+      templates directory and the mutators directory. """
+  def __init__(self, templates_path, mutators_path):
+    self.templates = CTemplatesCache(templates_path)
+    self.mutators_path = mutators_path
+    self.mutators = {}
+
+  def get_mutator(self, name):
+    if name not in self.mutators:
+      path = os.path.join(self.mutators_path, os.path.basename(name))
+      module = load_mutator_module(path)
+      self.mutators[name] = module.MUTATOR_CLASS()
+    return self.mutators[name]
+
+  def create(self, header):
+    """ Return the tuple (buffer, diff lines) of the seeded sample
+        described in the job's @header. """
+    index = self.templates.get_index(header["folder"])
+    filename = index.find_hash(header["template"])
+    if filename is None:
+      raise Exception("Template %s not found in %s" % (header["template"], index.path))
+
+    mutator = self.get_mutator(header["mutator"])
+    buf, diff = mutate_seeded(mutator, open(filename, "rb").read(), header["seed"])
+    if diff is not None:
+      line = "# Original file created by '%s' was %s"
+      diff = [line % (get_mutator_name(mutator), filename)] + map(str, diff)
+    return buf, diff
@@ -8,13 +8,24 @@ Nightmare Fuzzing Project
 import os
 import sys
 import time
+import errno
 import psutil
+import select
+import signal
 import threading
 import subprocess
 
+try:
+  import fcntl
+except ImportError:
+  # Windows, there is no SIGCHLD
+  pass
+
 from multiprocessing import Process, cpu_count
 
 from nfp_log import log, debug
+from nfp_limits import get_default_limits
+from nfp_affinity import get_affinity_planner, set_affinity, format_cpu_list
 
 #-----------------------------------------------------------------------
 # Dict of return codes to signals that we're interested on.
@@ -35,39 +46,369 @@ RETURN_SIGNALS[0xC0000096] = "PRIVILEGED_INSTRUCTION"
 RETURN_SIGNALS[0xC00000FD] = "STACK_OVERFLOW"
 
 #-----------------------------------------------------------------------
-def process_manager(total_procs, target, args, wait_time=0.2):
-  """ Always maintain a total of @total_procs running @target and
-     waiting for each thread to finish @wait_time second(s). """
-  procs = []
-  debug("Maximum number of processes in pool is %d" % total_procs)
-  try:
-    while 1:
-      if len(procs) < total_procs:
-        debug("Starting process %d" % (len(procs)+1))
-        p = Process(target=target, args=args)
-        p.start()
-        procs.append(p)
-        debug("Total of %d process(es) started" % len(procs))
+# Delay before restarting a child dying too soon, doubled every time it
+# dies again too soon up to MAX_RESTART_DELAY seconds.
+MIN_RESTART_DELAY = 0.5
+MAX_RESTART_DELAY = 60
+# Children running for more than this number of seconds are considered
+# stable and restarted immediately.
+STABLE_TIME = 30
+# Number of seconds to wait for the children to finish after SIGTERM
+STOP_TIMEOUT = 10
+# Number of seconds between reports of the children's statistics
+REPORT_INTERVAL = 300
+
+#-----------------------------------------------------------------------
+def supervised_child(target, args, cpus=None):
+  # Don't inherit the supervisor's signal handlers
+  if hasattr(signal, "SIGCHLD"):
+    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.set_wakeup_fd(-1)
+
+  # Inherited by the targets launched by this child
+  if cpus is not None:
+    set_affinity(cpus)
+  target(*args)
+
+#-----------------------------------------------------------------------
+class CChild:
+  def __init__(self, index):
+    self.index = index
+    self.process = None
+    self.started = 0
+    self.restarts = 0
+    self.failures = 0
+    self.next_start = 0
+    self.exitcode = None
+    self.cpus = None
+
+  def get_uptime(self):
+    if self.process is None:
+      return 0
+    return time.time() - self.started
+
+#-----------------------------------------------------------------------
+class CProcessSupervisor:
+  """ Keep @total_procs processes running @target(*@args). Instead of
+      polling every child, the supervisor sleeps until a SIGCHLD arrives
+      (through a self-pipe) or until a child must be restarted. Children
+      dying too soon are restarted with an exponential backoff. If given,
+      the CAffinityPlanner @planner assigns the CPUs of every child.
+      Subclasses may run a different target per child overriding
+      get_child_target() and do periodic work in tick(). """
+  def __init__(self, total_procs, target, args, poll_time=1, planner=None):
+    self.total_procs = total_procs
+    self.target = target
+    self.args = args
+    # Only used where there is no SIGCHLD (i.e., Windows)
+    self.poll_time = poll_time
+    self.planner = planner
+
+    self.children = [CChild(i) for i in range(total_procs)]
+    if planner is not None:
+      assignments = planner.plan(total_procs)
+      if assignments is None:
+        self.planner = None
       else:
-        i = 0
-        for p in list(procs):
-          p.join(wait_time)
-          if not p.is_alive():
-            debug("Process finished, deleting and starting a new one...")
-            del procs[i]
-            continue
-          i += 1
-  except KeyboardInterrupt:
+        for child, cpus in zip(self.children, assignments):
+          child.cpus = cpus
+    self.stopping = False
+    self.pipe = None
+    self.last_report = time.time()
+
+  def sigchld_handler(self, signum, frame):
+    # Nothing to do, the signal's wake up fd interrupts the select
     pass
 
+  def sigterm_handler(self, signum, frame):
+    self.stopping = True
+
+  def install_handlers(self):
+    if not hasattr(signal, "SIGCHLD"):
+      return
+
+    self.pipe = os.pipe()
+    for fd in self.pipe:
+      flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+      fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+    signal.set_wakeup_fd(self.pipe[1])
+    signal.signal(signal.SIGCHLD, self.sigchld_handler)
+    signal.signal(signal.SIGTERM, self.sigterm_handler)
+
+  def uninstall_handlers(self):
+    if self.pipe is None:
+      return
+
+    signal.set_wakeup_fd(-1)
+    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    for fd in self.pipe:
+      os.close(fd)
+    self.pipe = None
+
+  def get_child_target(self, child):
+    """ Return the tuple (target, args) run by @child. """
+    return self.target, self.args
+
+  def get_child_name(self, child):
+    return "child %d" % child.index
+
+  def tick(self):
+    """ Called in every iteration of the supervisor's loop. Return the
+        maximum number of seconds until it must be called again or None. """
+    return None
+
+  def start_child(self, child):
+    target, args = self.get_child_target(child)
+    p = Process(target=supervised_child, args=(target, args, child.cpus))
+    p.start()
+    if child.process is not None:
+      child.restarts += 1
+    child.process = p
+    child.started = time.time()
+    child.exitcode = None
+    if child.cpus is not None:
+      debug("Started process %d for %s in CPU(s) %s" % (p.pid, self.get_child_name(child), format_cpu_list(child.cpus)))
+    else:
+      debug("Started process %d for %s" % (p.pid, self.get_child_name(child)))
+
+  def reap(self):
+    """ Check which children died and schedule their restart. """
+    now = time.time()
+    for child in self.children:
+      if child.process is None or child.exitcode is not None:
+        continue
+      if child.process.is_alive():
+        continue
+
+      child.exitcode = child.process.exitcode
+      if now - child.started < STABLE_TIME:
+        child.failures += 1
+      else:
+        child.failures = 0
+
+      delay = 0
+      if child.failures > 0:
+        delay = min(MIN_RESTART_DELAY * 2 ** (child.failures - 1), MAX_RESTART_DELAY)
+      child.next_start = now + delay
+      log("Process %d for %s finished with exit code %s after %d second(s), restarting in %.1f second(s)" % \
+          (child.process.pid, self.get_child_name(child), str(child.exitcode), now - child.started, delay))
+
+  def start_pending(self):
+    """ Start the children whose time to restart has come and return the
+        number of seconds until the next one must be started. """
+    now = time.time()
+    wait = None
+    for child in self.children:
+      if child.process is not None and child.exitcode is None:
+        continue
+      if child.next_start <= now:
+        self.start_child(child)
+      elif wait is None or child.next_start - now < wait:
+        wait = child.next_start - now
+    return wait
+
+  def wait(self, timeout):
+    """ Sleep until a signal arrives or @timeout seconds pass. """
+    if self.pipe is None:
+      if timeout is None or timeout > self.poll_time:
+        timeout = self.poll_time
+      time.sleep(timeout)
+      return
+
+    try:
+      select.select([self.pipe[0]], [], [], timeout)
+    except select.error, e:
+      if e.args[0] != errno.EINTR:
+        raise
+
+    # Drain the wake up bytes written by the signals
+    try:
+      while os.read(self.pipe[0], 4096):
+        pass
+    except OSError, e:
+      if e.errno != errno.EAGAIN:
+        raise
+
+  def get_stats(self):
+    """ Return a list of dictionaries with the pid, restarts and uptime
+        of every child. """
+    ret = []
+    for child in self.children:
+      pid = None
+      if child.process is not None and child.exitcode is None:
+        pid = child.process.pid
+      ret.append({"index":child.index, "name":self.get_child_name(child), "pid":pid, "restarts":child.restarts,
+                  "uptime":int(child.get_uptime()) if pid is not None else 0,
+                  "exitcode":child.exitcode, "cpus":child.cpus})
+    return ret
+
+  def report_if_needed(self):
+    if time.time() - self.last_report < REPORT_INTERVAL:
+      return
+
+    self.last_report = time.time()
+    for stats in self.get_stats():
+      debug("Process for %(name)s: pid %(pid)s, %(restarts)d restart(s), up for %(uptime)d second(s)" % stats)
+    restarts = sum([child.restarts for child in self.children])
+    log("Total of %d process(es) running, %d restart(s)" % (len(self.children), restarts))
+    if self.planner is not None:
+      self.planner.report()
+
+  def stop(self):
+    """ Ask the children to finish with SIGTERM and kill the ones still
+        running after STOP_TIMEOUT seconds. """
+    procs = [child.process for child in self.children
+             if child.process is not None and child.process.is_alive()]
+    log("Stopping %d process(es)..." % len(procs))
+    for p in procs:
+      p.terminate()
+
+    deadline = time.time() + STOP_TIMEOUT
+    for p in procs:
+      p.join(max(deadline - time.time(), 0))
+      if p.is_alive():
+        log("Process %d didn't finish, killing it" % p.pid)
+        if hasattr(signal, "SIGKILL"):
+          os.kill(p.pid, signal.SIGKILL)
+        p.join()
+
+  def run(self):
+    debug("Maximum number of processes in pool is %d" % self.total_procs)
+    self.install_handlers()
+    try:
+      try:
+        while not self.stopping:
+          self.reap()
+          wait = self.start_pending()
+          self.report_if_needed()
+          waits = [x for x in [wait, self.tick(), REPORT_INTERVAL] if x is not None]
+          self.wait(max(min(waits), 0))
+      except KeyboardInterrupt:
+        pass
+    finally:
+      self.uninstall_handlers()
+      self.stop()
+
+#-----------------------------------------------------------------------
+def process_manager(total_procs, target, args, wait_time=1):
+  """ Always maintain a total of @total_procs running @target. The time
+      @wait_time is only used to poll the children where there is no
+      SIGCHLD. The children are pinned to their own CPUs if it's
+      configured in the environment (see nfp_affinity.py). """
+  supervisor = CProcessSupervisor(total_procs, target, args, wait_time,
+                                  get_affinity_planner())
+  supervisor.run()
+
+#-----------------------------------------------------------------------
+# pidfd_open(2) syscall number, the same in every Linux architecture
+# since 5.3.
+PIDFD_OPEN_SYSCALL = 434
+
+# "auto" timeouts: the CPU usage of the target is sampled every
+# CPU_SAMPLE_INTERVAL seconds and, when the last CPU_SAMPLES samples
+# average at most IDLE_CPU_PERCENT or more than half of them are 0, it's
+# considered finished and killed.
+CPU_SAMPLE_INTERVAL = 0.1
+CPU_SAMPLES = 20
+IDLE_CPU_PERCENT = 5
+
+# Without pidfds, the process' status is polled with a delay starting at
+# MIN_POLL_DELAY and doubling up to MAX_POLL_DELAY seconds.
+MIN_POLL_DELAY = 0.001
+MAX_POLL_DELAY = 0.05
+
+# Maximum number of bytes of output kept
+MAX_OUTPUT_SIZE = 8192
+
+try:
+  import ctypes
+  libc = ctypes.CDLL(None, use_errno=True)
+  libc_syscall = libc.syscall
+  has_pidfd = sys.platform.startswith("linux")
+except:
+  has_pidfd = False
+
+#-----------------------------------------------------------------------
+def open_pidfd(pid):
+  """ Return a file descriptor that becomes readable when the process
+      @pid finishes, or None if pidfds aren't supported. """
+  global has_pidfd
+  if not has_pidfd:
+    return None
+
+  fd = libc_syscall(PIDFD_OPEN_SYSCALL, pid, 0)
+  if fd < 0:
+    if ctypes.get_errno() in [errno.ENOSYS, errno.EPERM]:
+      # Old kernel or forbidden by seccomp, don't try again
+      has_pidfd = False
+    return None
+  return fd
+
+#-----------------------------------------------------------------------
+class CCpuSampler:
+  """ Measure the CPU usage of the process @pid by reading its
+      /proc/<pid>/stat once per sample or, where there is no /proc, with
+      psutil. """
+  def __init__(self, pid):
+    self.pid = pid
+    self.stat_path = "/proc/%d/stat" % pid
+    self.use_proc = os.path.exists(self.stat_path)
+    if self.use_proc:
+      self.ticks = float(os.sysconf("SC_CLK_TCK"))
+    else:
+      self.proc = psutil.Process(pid)
+    self.last_time = time.time()
+    self.last_cpu = self.get_cpu_time()
+    self.samples = []
+
+  def get_cpu_time(self):
+    """ Return the user and system CPU seconds used by the process. """
+    if self.use_proc:
+      f = open(self.stat_path, "rb")
+      try:
+        data = f.read()
+      finally:
+        f.close()
+      # The command name may have spaces, the fields start after it
+      fields = data[data.rfind(")")+2:].split()
+      return (int(fields[11]) + int(fields[12])) / self.ticks
+
+    times = self.proc.cpu_times()
+    return times.user + times.system
+
+  def sample(self):
+    now = time.time()
+    cpu = self.get_cpu_time()
+    elapsed = max(now - self.last_time, 0.001)
+    self.samples.append(int((cpu - self.last_cpu) * 100 / elapsed))
+    self.samples = self.samples[-CPU_SAMPLES:]
+    self.last_time = now
+    self.last_cpu = cpu
+
+  def is_idle(self):
+    if len(self.samples) < CPU_SAMPLES:
+      return False
+    return sum(self.samples) <= IDLE_CPU_PERCENT * CPU_SAMPLES or \
+           self.samples.count(0) > CPU_SAMPLES / 2
+
 #-----------------------------------------------------------------------
 class TimeoutCommand(object):
   """ Execute a command specified by @cmd and wait until a maximum of
       @timeout seconds. If the timeout is reached, the process is then
-      killed. """
-  def __init__(self, cmd):
+      killed. In Unix no threads are created: the target's exit, its
+      output, the timeout and the CPU sampling are all handled from a
+      single select() loop. The resource @limits, by default the ones of
+      this process, are applied to the target. """
+  def __init__(self, cmd, limits=None):
     self.cmd = cmd
     self.process = None
+    if limits is None:
+      limits = get_default_limits()
+    self.limits = limits
+    # The resource limit hit by the target, if any
+    self.outcome = None
     
     self.stderr = None
     self.stdout = None
@@ -77,6 +418,7 @@ class TimeoutCommand(object):
     self.thread = None
     self.pid = None
     self.cpu_killed = False
+    self.timed_out = False
 
   def check_cpu(self):
     while True:
@@ -109,7 +451,152 @@ class TimeoutCommand(object):
     self.process.kill()
     self.process.wait()
 
+  def get_return_code(self):
+    ret = self.process.returncode
+
+    # A negative return code means a signal was received and the return
+    # code is -1 * SIGNAL. Return the expected Unix return code.
+    if ret is not None and ret < 0:
+      if os.name == "nt":
+        ret = ret & 0xFFFFFFFF
+      else:
+        ret = abs(ret) + 128
+    return ret
+
   def run(self, timeout=60, get_output=False):
+    if os.name == "nt":
+      return self.run_threaded(timeout, get_output)
+
+    auto = str(timeout).lower() == "auto"
+    if auto:
+      timeout = self.default_timeout
+    deadline = time.time() + float(timeout)
+
+    pipe = None
+    if get_output:
+      pipe = subprocess.PIPE
+
+    preexec_fn = None
+    if self.limits is not None:
+      self.limits.prepare()
+      preexec_fn = self.limits.apply
+
+    self.process = subprocess.Popen("exec %s" % self.cmd, shell=True,
+                                    stdout=pipe, stderr=pipe,
+                                    preexec_fn=preexec_fn)
+    self.pid = self.process.pid
+
+    outputs = {}
+    if get_output:
+      outputs[self.process.stdout.fileno()] = []
+      outputs[self.process.stderr.fileno()] = []
+
+    pidfd = open_pidfd(self.pid)
+    sampler = None
+    if auto:
+      try:
+        sampler = CCpuSampler(self.pid)
+      except (IOError, OSError, psutil.NoSuchProcess):
+        # Already finished
+        pass
+
+    try:
+      self.wait_process(timeout, deadline, pidfd, sampler, outputs)
+    finally:
+      if pidfd is not None:
+        os.close(pidfd)
+
+    if get_output:
+      self.stdout = "".join(outputs[self.process.stdout.fileno()])
+      self.stderr = "".join(outputs[self.process.stderr.fileno()])
+      self.process.stdout.close()
+      self.process.stderr.close()
+
+    ret = self.get_return_code()
+    if self.limits is not None:
+      self.outcome = self.limits.check(ret, self.timed_out or self.cpu_killed)
+    return ret
+
+  def read_outputs(self, fds, open_fds, outputs):
+    """ Read the output available in the pipes @fds, keeping at most
+        MAX_OUTPUT_SIZE bytes of each one. """
+    for fd in fds:
+      buf = os.read(fd, 65536)
+      if buf == "":
+        open_fds.remove(fd)
+        continue
+
+      size = sum(map(len, outputs[fd]))
+      if size < MAX_OUTPUT_SIZE:
+        outputs[fd].append(buf[:MAX_OUTPUT_SIZE - size])
+
+  def wait_process(self, timeout, deadline, pidfd, sampler, outputs):
+    """ Wait for the process to finish, reading its output (if @outputs
+        has any pipe), sampling its CPU usage (if there is a @sampler) and
+        killing it after the @deadline. """
+    open_fds = set(outputs)
+    next_sample = time.time() + CPU_SAMPLE_INTERVAL
+    poll_delay = MIN_POLL_DELAY
+    while self.process.poll() is None:
+      now = time.time()
+      if now >= deadline:
+        log('Terminating process after timeout (%s)' % str(timeout))
+        self.timed_out = True
+        try:
+          self.do_kill()
+        except:
+          log("Error killing process: %s" % str(sys.exc_info()[1]))
+        break
+
+      if sampler is not None and now >= next_sample:
+        next_sample = now + CPU_SAMPLE_INTERVAL
+        try:
+          sampler.sample()
+        except (IOError, OSError, psutil.NoSuchProcess):
+          # Finished in the meantime
+          sampler = None
+          continue
+
+        if sampler.is_idle():
+          log("CPU at 0%, killing")
+          self.cpu_killed = True
+          self.do_kill()
+          break
+
+      wait = deadline - now
+      if sampler is not None:
+        wait = min(wait, max(next_sample - now, 0))
+
+      fds = list(open_fds)
+      if pidfd is not None:
+        fds.append(pidfd)
+      else:
+        wait = min(wait, poll_delay)
+        poll_delay = min(poll_delay * 2, MAX_POLL_DELAY)
+
+      try:
+        if len(fds) > 0:
+          ready = select.select(fds, [], [], wait)[0]
+        else:
+          time.sleep(wait)
+          ready = []
+      except select.error, e:
+        if e.args[0] != errno.EINTR:
+          raise
+        continue
+
+      self.read_outputs([fd for fd in ready if fd != pidfd], open_fds, outputs)
+
+    self.process.wait()
+
+    # Read what is left in the pipes
+    while len(open_fds) > 0:
+      ready = select.select(list(open_fds), [], [], 0)[0]
+      if len(ready) == 0:
+        break
+      self.read_outputs(ready, open_fds, outputs)
+
+  def run_threaded(self, timeout=60, get_output=False):
     def target():
       debug('Thread started')
       if os.name == "nt":
@@ -153,16 +640,7 @@ class TimeoutCommand(object):
       thread.join()
 
     self.process.wait()
-    ret = self.process.returncode
-
-    # A negative return code means a signal was received and the return
-    # code is -1 * SIGNAL. Return the expected Unix return code.
-    if ret is not None and ret < 0:
-      if os.name == "nt":
-        ret = ret & 0xFFFFFFFF
-      else:
-        ret = abs(ret) + 128
-    return ret
+    return self.get_return_code()
 
 #-----------------------------------------------------------------------
 def do_nothing():
@@ -5,15 +5,362 @@ Nightmare Fuzzing Project
 @author: joxean
 """
 
-import beanstalkc
+import os
+import sys
+import time
+import thread
+
+from threading import Lock, RLock
+
+import config
 
 from config import QUEUE_HOST, QUEUE_PORT
+from nfp_log import log, debug
+from nfp_queue_local import connect_local, connect_memory, \
+                            LOCAL_SOCKET_ERRORS, DEFAULT_SOCKET, \
+                            DEFAULT_AUTHKEY, DEFAULT_TTR
+
+try:
+  import beanstalkc
+  has_beanstalkc = True
+except ImportError:
+  has_beanstalkc = False
 
 #-----------------------------------------------------------------------
-def get_queue(name, watch=False):
-  q = beanstalkc.Connection(host=QUEUE_HOST, port=QUEUE_PORT)
-  if watch:
-    q.watch(name)
+# Connections idle for more than this number of seconds are checked
+# before handing them out again.
+HEALTH_CHECK_INTERVAL = 30
+
+# Number of times an operation is retried after reconnecting.
+MAX_RETRIES = 3
+
+# Maximum number of commands written to beanstalkd before reading their
+# replies. Bigger batches are split so neither side blocks with its
+# socket buffers full.
+PIPELINE_SIZE = 64
+
+# Supported queue backends, selected with QUEUE_BACKEND in config.py
+BACKEND_BEANSTALK = "beanstalk"
+BACKEND_LOCAL = "local"
+BACKEND_MEMORY = "memory"
+
+QUEUE_BACKEND = getattr(config, "QUEUE_BACKEND", BACKEND_BEANSTALK)
+
+# Errors meaning the connection to the queue server was lost
+SOCKET_ERRORS = LOCAL_SOCKET_ERRORS
+if has_beanstalkc:
+  SOCKET_ERRORS += (beanstalkc.SocketError, )
+
+#-----------------------------------------------------------------------
+def connect_backend():
+  """ Return a new connection, with the beanstalkc.Connection interface,
+      to the configured queue backend. """
+  if QUEUE_BACKEND == BACKEND_BEANSTALK:
+    if not has_beanstalkc:
+      raise Exception("The beanstalk queue backend requires the beanstalkc module")
+    return beanstalkc.Connection(host=QUEUE_HOST, port=QUEUE_PORT)
+  elif QUEUE_BACKEND == BACKEND_LOCAL:
+    address = getattr(config, "QUEUE_SOCKET", DEFAULT_SOCKET)
+    authkey = getattr(config, "QUEUE_AUTHKEY", DEFAULT_AUTHKEY)
+    return connect_local(address, authkey)
+  elif QUEUE_BACKEND == BACKEND_MEMORY:
+    return connect_memory()
+  raise Exception("Unknown queue backend %s" % repr(QUEUE_BACKEND))
+
+#-----------------------------------------------------------------------
+def pipeline(conn, commands):
+  """ Write the beanstalk @commands to the beanstalkc connection @conn
+      without waiting for each reply and return the list of replies as
+      tuples (status, arguments, body). Replies with errors are returned
+      too, otherwise the remaining replies would be left unread. """
+  ret = []
+  for i in range(0, len(commands), PIPELINE_SIZE):
+    chunk = commands[i:i+PIPELINE_SIZE]
+    beanstalkc.SocketError.wrap(conn._socket.sendall, "".join(chunk))
+    for command in chunk:
+      status, results = conn._read_response()
+      body = None
+      if status in ["RESERVED", "OK"]:
+        body = conn._read_body(int(results[-1]))
+      ret.append((status, results, body))
+  return ret
+
+#-----------------------------------------------------------------------
+def pipelined_put(conn, bodies, ttr):
+  commands = []
+  for body in bodies:
+    if not isinstance(body, str):
+      raise ValueError("Job body must be a str instance")
+    commands.append("put %d 0 %d %d\r\n%s\r\n" % (beanstalkc.DEFAULT_PRIORITY, ttr, len(body), body))
+
+  ret = []
+  for status, results, body in pipeline(conn, commands):
+    if status != "INSERTED":
+      raise beanstalkc.CommandFailed("put", status, results)
+    ret.append(int(results[0]))
+  return ret
+
+#-----------------------------------------------------------------------
+def pipelined_reserve(conn, total, timeout):
+  # Only the first command waits for jobs, the others get whatever is
+  # already ready in the watched tubes.
+  if timeout is None:
+    commands = ["reserve\r\n"]
   else:
-    q.use(name)
-  return q
+    commands = ["reserve-with-timeout %d\r\n" % timeout]
+  commands += ["reserve-with-timeout 0\r\n"] * (total - 1)
+
+  ret = []
+  for status, results, body in pipeline(conn, commands):
+    if status == "RESERVED":
+      ret.append(beanstalkc.Job(conn, int(results[0]), body, True))
+  return ret
+
+#-----------------------------------------------------------------------
+def pipelined_delete(conn, jids):
+  commands = ["delete %d\r\n" % jid for jid in jids]
+  replies = pipeline(conn, commands)
+  return len([x for x in replies if x[0] == "DELETED"])
+
+#-----------------------------------------------------------------------
+def pipelined_touch(conn, jids):
+  commands = ["touch %d\r\n" % jid for jid in jids]
+  replies = pipeline(conn, commands)
+  return [jid for jid, reply in zip(jids, replies) if reply[0] != "TOUCHED"]
+
+#-----------------------------------------------------------------------
+def pipelined_stats_tubes(conn, names):
+  commands = ["stats-tube %s\r\n" % name for name in names]
+  ret = {}
+  for name, (status, results, body) in zip(names, pipeline(conn, commands)):
+    if status == "OK":
+      ret[name] = conn._parse_yaml(body)
+  return ret
+
+#-----------------------------------------------------------------------
+class CQueueConnection(object):
+  """ Long lived connection to the queue server bound to the tube @name.
+      If the connection is broken it transparently reconnects, restores
+      the used or watched tubes and retries the operation. """
+  def __init__(self, name, watch=False):
+    self.name = name
+    self.watcher = watch
+    self.watched = set()
+    if watch:
+      self.watched.add(name)
+    self.conn = None
+    self.last_used = 0
+    self.lock = RLock()
+    self.connect()
+
+  def connect(self):
+    self.conn = connect_backend()
+    if self.watcher:
+      for tube in self.watched:
+        self.conn.watch(tube)
+      if "default" not in self.watched:
+        self.conn.ignore("default")
+    else:
+      self.conn.use(self.name)
+    self.last_used = time.time()
+
+  def watch(self, name):
+    self.watched.add(name)
+    return self.call("watch", name)
+
+  def ignore(self, name):
+    """ Stop watching the tube @name. The last watched tube can't be
+        ignored, in that case it returns False. """
+    if len(self.watched) == 1 and name in self.watched:
+      return False
+    self.watched.discard(name)
+    self.call("ignore", name)
+    return True
+
+  def close(self):
+    try:
+      if self.conn is not None:
+        self.conn.close()
+    except:
+      pass
+    self.conn = None
+
+  def reconnect(self):
+    debug("Reconnecting to tube %s" % self.name)
+    self.close()
+    self.connect()
+
+  def is_healthy(self):
+    if self.conn is None:
+      return False
+
+    if time.time() - self.last_used < HEALTH_CHECK_INTERVAL:
+      return True
+
+    try:
+      self.conn.using()
+      self.last_used = time.time()
+      return True
+    except SOCKET_ERRORS:
+      return False
+
+  def call(self, method, *args, **kwargs):
+    return self.run(lambda conn: getattr(conn, method)(*args, **kwargs))
+
+  def run(self, func):
+    """ Call @func with the backend connection, reconnecting and retrying
+        if the connection was lost. The connection is locked meanwhile, as
+        the jobs leases are touched from another thread. """
+    self.lock.acquire()
+    try:
+      for i in range(MAX_RETRIES):
+        try:
+          if self.conn is None:
+            self.connect()
+          ret = func(self.conn)
+          self.last_used = time.time()
+          return ret
+        except SOCKET_ERRORS:
+          log("Connection to tube %s lost: %s" % (self.name, str(sys.exc_info()[1])))
+          self.close()
+          if i == MAX_RETRIES - 1:
+            raise
+          time.sleep(i * 0.5)
+    finally:
+      self.lock.release()
+
+  def is_pipelined(self, conn):
+    return has_beanstalkc and isinstance(conn, beanstalkc.Connection)
+
+  def put_many(self, bodies, ttr=DEFAULT_TTR):
+    """ Put all the jobs @bodies in the used tube with a single round trip
+        per PIPELINE_SIZE jobs and return the list of job identifiers. If
+        the connection is lost in the middle, the current chunk is put
+        again, so a few jobs may be duplicated. """
+    ret = []
+    for i in range(0, len(bodies), PIPELINE_SIZE):
+      chunk = bodies[i:i+PIPELINE_SIZE]
+      def put_chunk(conn):
+        if self.is_pipelined(conn):
+          return pipelined_put(conn, chunk, ttr)
+        return conn.put_many(chunk, ttr)
+      ret.extend(self.run(put_chunk))
+    return ret
+
+  def bind_job(self, job):
+    """ Make the commands of @job (delete, release, touch, etc...) go
+        through this connection instead of the backend one, so they are
+        locked and retried like any other command. """
+    if job is not None:
+      job.conn = self
+    return job
+
+  def reserve(self, timeout=None):
+    return self.bind_job(self.call("reserve", timeout))
+
+  def reserve_many(self, total, timeout=None):
+    """ Reserve up to @total jobs from the watched tubes, waiting at most
+        @timeout seconds (or forever, if None) only for the first one.
+        Return the list of reserved jobs, which may be empty. """
+    def reserve_jobs(conn):
+      if self.is_pipelined(conn):
+        return pipelined_reserve(conn, total, timeout)
+      return conn.reserve_many(total, timeout)
+    return map(self.bind_job, self.run(reserve_jobs))
+
+  def delete_many(self, jobs):
+    """ Delete the reserved @jobs and return how many were deleted. Jobs
+        that don't exist anymore are ignored. """
+    jids = [job.jid for job in jobs]
+    def delete_jobs(conn):
+      if self.is_pipelined(conn):
+        return pipelined_delete(conn, jids)
+      return conn.delete_many(jids)
+    return self.run(delete_jobs)
+
+  def touch_many(self, jobs):
+    """ Restart the time to run of the reserved @jobs. Return the list of
+        identifiers of the jobs that aren't reserved anymore by us. """
+    jids = [job.jid for job in jobs]
+    def touch_jobs(conn):
+      if self.is_pipelined(conn):
+        return pipelined_touch(conn, jids)
+      return conn.touch_many(jids)
+    return self.run(touch_jobs)
+
+  def stats_tubes(self, names):
+    """ Return a dictionary with the statistics of each existing tube in
+        @names. """
+    def get_stats(conn):
+      if self.is_pipelined(conn):
+        return pipelined_stats_tubes(conn, names)
+      return conn.stats_tubes(names)
+    return self.run(get_stats)
+
+  def __getattr__(self, name):
+    # Forward everything else (put, reserve, stats_tube, tubes, etc...)
+    # to the underlying backend connection, reconnecting if needed.
+    if name.startswith("_"):
+      raise AttributeError(name)
+    return lambda *args, **kwargs: self.call(name, *args, **kwargs)
+
+#-----------------------------------------------------------------------
+class CQueuePool(object):
+  """ Registry of per-tube connections. Connections are never shared
+      between processes nor between threads as beanstalkc connections
+      aren't thread safe. """
+  def __init__(self):
+    self.lock = Lock()
+    self.connections = {}
+
+  def get(self, name, watch=False):
+    key = (os.getpid(), thread.get_ident(), name, bool(watch))
+    self.lock.acquire()
+    try:
+      q = self.connections.get(key)
+      if q is None:
+        debug("Opening new connection for tube %s" % name)
+        q = CQueueConnection(name, watch)
+        self.connections[key] = q
+      elif not q.is_healthy():
+        q.reconnect()
+      return q
+    finally:
+      self.lock.release()
+
+  def discard(self, name, watch=False):
+    key = (os.getpid(), thread.get_ident(), name, bool(watch))
+    self.lock.acquire()
+    try:
+      q = self.connections.pop(key, None)
+    finally:
+      self.lock.release()
+
+    if q is not None:
+      q.close()
+
+  def close_all(self):
+    self.lock.acquire()
+    try:
+      pid = os.getpid()
+      for key in list(self.connections):
+        if key[0] == pid:
+          self.connections.pop(key).close()
+        else:
+          # Connections inherited from the parent process, just forget
+          # them without closing the parent's socket.
+          del self.connections[key]
+    finally:
+      self.lock.release()
+
+queue_pool = CQueuePool()
+
+#-----------------------------------------------------------------------
+def get_queue(name, watch=False):
+  return queue_pool.get(name, watch)
+
+#-----------------------------------------------------------------------
+def new_queue(name, watch=False):
+  """ Return a new, not pooled, connection. Use it when the connection
+      must not be shared with any other user in the same thread. """
+  return CQueueConnection(name, watch)
@@ -0,0 +1,684 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Nightmare Fuzzing Project
+Local queue backends with the same interface as beanstalkc.
+
+CMemoryBroker implements the subset of the beanstalk semantics used by
+Nightmare: tubes, ready, reserved, delayed and buried jobs, priorities,
+time to run (TTR), the statistics of each tube and the NOT_FOUND errors
+for unknown jobs and tubes. It can be used:
+
+ * In-process ("memory" backend), for benchmarks and tests without a
+   beanstalk server.
+ * Shared by all the processes of one box ("local" backend), serving it
+   from a broker process listening in a Unix socket. Run it with:
+
+   $ python nfp_queue_local.py [socket path]
+
+The "local" backend uses a minimal protocol: every request is one message
+with the marshal'ed method name and arguments answered with one message,
+framed and authenticated by multiprocessing.connection (in C), handled by
+one broker thread per client. There is no text parsing nor YAML statistics
+like in beanstalkd and no pickling nor proxy objects like with the
+multiprocessing managers. Measure it with:
+
+   $ python nfp_queue_local.py -b [socket path]
+
+@author: joxean
+"""
+
+import os
+import sys
+import time
+import errno
+import heapq
+import socket
+import marshal
+
+from collections import deque
+from threading import Thread, Lock, Condition
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Listener, Client
+
+from nfp_log import log, debug
+
+try:
+  from beanstalkc import CommandFailed, DEFAULT_PRIORITY
+except ImportError:
+  DEFAULT_PRIORITY = 2 ** 31
+
+  class CommandFailed(Exception):
+    """ The same error raised by beanstalkc for failed commands. """
+    pass
+
+#-----------------------------------------------------------------------
+DEFAULT_SOCKET = "/tmp/nightmare-queue.sock"
+DEFAULT_AUTHKEY = "nightmare"
+DEFAULT_TTR = 120
+
+# Errors meaning the connection to the broker process was lost
+LOCAL_SOCKET_ERRORS = (socket.error, EOFError, IOError, AuthenticationError)
+
+# Methods of the broker callable through the Unix socket
+BROKER_METHODS = set(["create_tube", "put", "put_many", "reserve",
+                      "reserve_many", "delete", "delete_many", "release",
+                      "bury", "touch", "touch_many", "stats_job",
+                      "list_tubes", "stats_tube", "stats_tubes"])
+
+# Exceptions raised again in the clients, any other is an Exception
+REMOTE_ERRORS = {"KeyError":KeyError, "ValueError":ValueError,
+                 "CommandFailed":CommandFailed}
+
+#-----------------------------------------------------------------------
+class CTubeStats:
+  def __init__(self):
+    # priority -> deque of ready job ids, and heap of the priorities with
+    # ready jobs. Lower priorities go first.
+    self.ready = {}
+    self.priorities = []
+    self.total_ready = 0
+    self.reserved = 0
+    self.delayed = 0
+    self.buried = 0
+    self.total_jobs = 0
+    self.deletes = 0
+
+  def add_ready(self, jid, priority, first=False):
+    jids = self.ready.get(priority)
+    if jids is None:
+      jids = deque()
+      self.ready[priority] = jids
+      heapq.heappush(self.priorities, priority)
+
+    if first:
+      jids.appendleft(jid)
+    else:
+      jids.append(jid)
+    self.total_ready += 1
+
+  def pop_ready(self):
+    """ Return the first ready job id or None if there is none. """
+    if len(self.priorities) == 0:
+      return None
+
+    priority = self.priorities[0]
+    jids = self.ready[priority]
+    jid = jids.popleft()
+    self.total_ready -= 1
+    if len(jids) == 0:
+      self.remove_priority(priority)
+    return jid
+
+  def remove_ready(self, jid, priority):
+    jids = self.ready[priority]
+    jids.remove(jid)
+    self.total_ready -= 1
+    if len(jids) == 0:
+      self.remove_priority(priority)
+
+  def remove_priority(self, priority):
+    del self.ready[priority]
+    self.priorities.remove(priority)
+    heapq.heapify(self.priorities)
+
+#-----------------------------------------------------------------------
+class CMemoryBroker:
+  """ Thread safe beanstalk-like broker. Jobs are identified by an integer
+      and reserving returns the tuple (job id, body). """
+  def __init__(self):
+    self.condition = Condition(Lock())
+    self.last_id = 0
+    # tube name -> CTubeStats
+    self.tubes = {}
+    # job id -> [tube, body, state, TTR, reservation or delay deadline,
+    #            priority]
+    self.jobs = {}
+    # Heaps of (reservation deadline, job id) and (delay deadline, job id)
+    self.deadlines = []
+    self.delays = []
+
+  def get_tube(self, name):
+    tube = self.tubes.get(name)
+    if tube is None:
+      tube = CTubeStats()
+      self.tubes[name] = tube
+    return tube
+
+  def create_tube(self, name):
+    """ Tubes exist after being used or watched, like in beanstalkd. """
+    self.condition.acquire()
+    try:
+      self.get_tube(name)
+    finally:
+      self.condition.release()
+
+  def make_ready(self, jid, job, first=False):
+    job[2] = "ready"
+    job[4] = None
+    self.tubes[job[0]].add_ready(jid, job[5], first)
+
+  def make_delayed(self, jid, job, delay):
+    job[2] = "delayed"
+    job[4] = time.time() + delay
+    heapq.heappush(self.delays, (job[4], jid))
+    self.tubes[job[0]].delayed += 1
+
+  def put(self, tube_name, body, ttr=DEFAULT_TTR, priority=DEFAULT_PRIORITY, delay=0):
+    self.condition.acquire()
+    try:
+      self.last_id += 1
+      jid = self.last_id
+      job = [tube_name, body, None, ttr, None, priority]
+      self.jobs[jid] = job
+      tube = self.get_tube(tube_name)
+      tube.total_jobs += 1
+      if delay > 0:
+        self.make_delayed(jid, job, delay)
+      else:
+        self.make_ready(jid, job)
+        self.condition.notify_all()
+      return jid
+    finally:
+      self.condition.release()
+
+  def put_many(self, tube_name, bodies, ttr=DEFAULT_TTR):
+    return [self.put(tube_name, body, ttr) for body in bodies]
+
+  def expire_reservations(self):
+    # Put back in their tubes the jobs whose TTR or delay expired. Entries
+    # of jobs already deleted, released, buried or touched are discarded.
+    now = time.time()
+    while len(self.deadlines) > 0 and self.deadlines[0][0] < now:
+      deadline, jid = heapq.heappop(self.deadlines)
+      job = self.jobs.get(jid)
+      if job is None or job[2] != "reserved" or job[4] != deadline:
+        continue
+
+      # Before the other jobs with the same priority, as it was first
+      self.tubes[job[0]].reserved -= 1
+      self.make_ready(jid, job, first=True)
+
+    while len(self.delays) > 0 and self.delays[0][0] <= now:
+      deadline, jid = heapq.heappop(self.delays)
+      job = self.jobs.get(jid)
+      if job is None or job[2] != "delayed" or job[4] != deadline:
+        continue
+
+      self.tubes[job[0]].delayed -= 1
+      self.make_ready(jid, job)
+
+  def try_reserve(self, tube_names):
+    for name in tube_names:
+      tube = self.tubes.get(name)
+      if tube is None:
+        continue
+
+      jid = tube.pop_ready()
+      if jid is not None:
+        job = self.jobs[jid]
+        job[2] = "reserved"
+        job[4] = time.time() + job[3]
+        heapq.heappush(self.deadlines, (job[4], jid))
+        tube.reserved += 1
+        return jid, job[1]
+    return None
+
+  def get_wait(self, deadline):
+    """ Seconds to wait for new jobs: until @deadline (if it isn't None)
+        and never more than one second, to check expired reservations, nor
+        than the time to the next delayed job. """
+    wait = 1
+    if deadline is not None:
+      wait = min(deadline - time.time(), wait)
+    if len(self.delays) > 0:
+      wait = min(self.delays[0][0] - time.time(), wait)
+    return max(wait, 0.01)
+
+  def reserve(self, tube_names, timeout=None):
+    """ Reserve a job from any of the tubes @tube_names waiting, at most,
+        @timeout seconds or forever if it's None. """
+    deadline = None
+    if timeout is not None:
+      deadline = time.time() + timeout
+
+    self.condition.acquire()
+    try:
+      while 1:
+        self.expire_reservations()
+        ret = self.try_reserve(tube_names)
+        if ret is not None:
+          return ret
+
+        if deadline is not None and deadline - time.time() <= 0:
+          return None
+        self.condition.wait(self.get_wait(deadline))
+    finally:
+      self.condition.release()
+
+  def reserve_many(self, tube_names, total, timeout=None):
+    """ Reserve up to @total jobs, waiting only for the first one. """
+    ret = []
+    first = self.reserve(tube_names, timeout)
+    if first is None:
+      return ret
+    ret.append(first)
+
+    self.condition.acquire()
+    try:
+      while len(ret) < total:
+        job = self.try_reserve(tube_names)
+        if job is None:
+          break
+        ret.append(job)
+    finally:
+      self.condition.release()
+    return ret
+
+  def get_job(self, jid, command, reserved=False):
+    """ Return the job @jid, which must be reserved if @reserved is True,
+        or raise the same error as beanstalkc for the @command. """
+    self.expire_reservations()
+    job = self.jobs.get(jid)
+    if job is None or (reserved and job[2] != "reserved"):
+      raise CommandFailed(command, "NOT_FOUND", [])
+    return job
+
+  def delete(self, jid):
+    self.condition.acquire()
+    try:
+      job = self.get_job(jid, "delete")
+      tube = self.tubes[job[0]]
+      if job[2] == "reserved":
+        tube.reserved -= 1
+      elif job[2] == "buried":
+        tube.buried -= 1
+      elif job[2] == "delayed":
+        tube.delayed -= 1
+      else:
+        tube.remove_ready(jid, job[5])
+      tube.deletes += 1
+      del self.jobs[jid]
+    finally:
+      self.condition.release()
+
+  def delete_many(self, jids):
+    deleted = 0
+    for jid in jids:
+      try:
+        self.delete(jid)
+        deleted += 1
+      except CommandFailed:
+        pass
+    return deleted
+
+  def release(self, jid, priority=None, delay=0):
+    """ Put the reserved job @jid back in its tube, with the new @priority
+        (if not None) and after @delay seconds. """
+    self.condition.acquire()
+    try:
+      job = self.get_job(jid, "release", reserved=True)
+      self.tubes[job[0]].reserved -= 1
+      if priority is not None:
+        job[5] = priority
+      if delay > 0:
+        self.make_delayed(jid, job, delay)
+      else:
+        self.make_ready(jid, job)
+        self.condition.notify_all()
+    finally:
+      self.condition.release()
+
+  def bury(self, jid, priority=None):
+    self.condition.acquire()
+    try:
+      job = self.get_job(jid, "bury", reserved=True)
+      job[2] = "buried"
+      job[4] = None
+      if priority is not None:
+        job[5] = priority
+      tube = self.tubes[job[0]]
+      tube.reserved -= 1
+      tube.buried += 1
+    finally:
+      self.condition.release()
+
+  def touch(self, jid):
+    self.condition.acquire()
+    try:
+      job = self.get_job(jid, "touch", reserved=True)
+      job[4] = time.time() + job[3]
+      heapq.heappush(self.deadlines, (job[4], jid))
+    finally:
+      self.condition.release()
+
+  def touch_many(self, jids):
+    """ Return the list of jobs that couldn't be touched. """
+    lost = []
+    self.condition.acquire()
+    try:
+      self.expire_reservations()
+      for jid in jids:
+        job = self.jobs.get(jid)
+        if job is None or job[2] != "reserved":
+          lost.append(jid)
+        else:
+          job[4] = time.time() + job[3]
+          heapq.heappush(self.deadlines, (job[4], jid))
+    finally:
+      self.condition.release()
+    return lost
+
+  def stats_job(self, jid):
+    self.condition.acquire()
+    try:
+      job = self.get_job(jid, "stats-job")
+      ret = {"id":jid, "tube":job[0], "state":job[2], "ttr":job[3],
+             "pri":job[5]}
+      if job[4] is not None:
+        ret["time-left"] = max(int(job[4] - time.time()), 0)
+      return ret
+    finally:
+      self.condition.release()
+
+  def list_tubes(self):
+    self.condition.acquire()
+    try:
+      return ["default"] + [name for name in self.tubes if name != "default"]
+    finally:
+      self.condition.release()
+
+  def stats_tube(self, name):
+    self.condition.acquire()
+    try:
+      tube = self.tubes.get(name)
+      if tube is None:
+        # The same error raised by beanstalkc
+        raise CommandFailed("stats-tube", "NOT_FOUND", [])
+      self.expire_reservations()
+      return {"name":name,
+              "current-jobs-ready":tube.total_ready,
+              "current-jobs-reserved":tube.reserved,
+              "current-jobs-delayed":tube.delayed,
+              "current-jobs-buried":tube.buried,
+              "total-jobs":tube.total_jobs,
+              "cmd-delete":tube.deletes}
+    finally:
+      self.condition.release()
+
+  def stats_tubes(self, names):
+    ret = {}
+    for name in names:
+      try:
+        ret[name] = self.stats_tube(name)
+      except CommandFailed:
+        pass
+    return ret
+
+#-----------------------------------------------------------------------
+class CLocalJob(object):
+  """ Job reserved with the connection @conn, like beanstalkc.Job. """
+  def __init__(self, conn, jid, body, reserved=True):
+    self.conn = conn
+    self.jid = jid
+    self.body = body
+    self.reserved = reserved
+
+  def delete(self):
+    self.conn.delete(self.jid)
+    self.reserved = False
+
+  def release(self, priority=None, delay=0):
+    if self.reserved:
+      self.conn.release(self.jid, priority, delay)
+      self.reserved = False
+
+  def bury(self, priority=None):
+    if self.reserved:
+      self.conn.bury(self.jid, priority)
+      self.reserved = False
+
+  def touch(self):
+    if self.reserved:
+      self.conn.touch(self.jid)
+
+  def stats(self):
+    return self.conn.stats_job(self.jid)
+
+#-----------------------------------------------------------------------
+class CLocalConnection(object):
+  """ Connection to a CMemoryBroker (or a CBrokerClient talking to one)
+      implementing the subset of the beanstalkc.Connection interface used
+      by Nightmare. """
+  def __init__(self, broker):
+    self.broker = broker
+    self.used = "default"
+    self.watched = ["default"]
+
+  def use(self, name):
+    self.broker.create_tube(name)
+    self.used = name
+    return name
+
+  def using(self):
+    return self.used
+
+  def watch(self, name):
+    if name not in self.watched:
+      self.broker.create_tube(name)
+      self.watched.append(name)
+    return len(self.watched)
+
+  def ignore(self, name):
+    if name in self.watched and len(self.watched) > 1:
+      self.watched.remove(name)
+    return len(self.watched)
+
+  def watching(self):
+    return list(self.watched)
+
+  def put(self, body, priority=DEFAULT_PRIORITY, delay=0, ttr=DEFAULT_TTR):
+    if not isinstance(body, str):
+      raise ValueError("Job body must be a str instance")
+    return self.broker.put(self.used, body, ttr, priority, delay)
+
+  def reserve(self, timeout=None):
+    ret = self.broker.reserve(self.watched, timeout)
+    if ret is None:
+      return None
+    jid, body = ret
+    return CLocalJob(self, jid, body)
+
+  def delete(self, jid):
+    self.broker.delete(jid)
+
+  def release(self, jid, priority=None, delay=0):
+    """ Unlike beanstalkc, a None @priority keeps the job's priority. """
+    self.broker.release(jid, priority, delay)
+
+  def bury(self, jid, priority=None):
+    self.broker.bury(jid, priority)
+
+  def touch(self, jid):
+    self.broker.touch(jid)
+
+  def stats_job(self, jid):
+    return self.broker.stats_job(jid)
+
+  def put_many(self, bodies, ttr=DEFAULT_TTR):
+    for body in bodies:
+      if not isinstance(body, str):
+        raise ValueError("Job body must be a str instance")
+    return self.broker.put_many(self.used, bodies, ttr)
+
+  def reserve_many(self, total, timeout=None):
+    ret = self.broker.reserve_many(self.watched, total, timeout)
+    return [CLocalJob(self, jid, body) for jid, body in ret]
+
+  def delete_many(self, jids):
+    return self.broker.delete_many(jids)
+
+  def touch_many(self, jids):
+    return self.broker.touch_many(jids)
+
+  def tubes(self):
+    return self.broker.list_tubes()
+
+  def stats_tube(self, name):
+    return self.broker.stats_tube(name)
+
+  def stats_tubes(self, names):
+    return self.broker.stats_tubes(names)
+
+  def close(self):
+    if isinstance(self.broker, CBrokerClient):
+      self.broker.close()
+
+#-----------------------------------------------------------------------
+# Broker used by the "memory" backend, shared by all the threads of this
+# process.
+memory_broker = CMemoryBroker()
+
+def connect_memory():
+  return CLocalConnection(memory_broker)
+
+#-----------------------------------------------------------------------
+class CBrokerClient(object):
+  """ Client of the broker process listening in the Unix socket
+      @address, with the same methods as CMemoryBroker. """
+  def __init__(self, address=DEFAULT_SOCKET, authkey=DEFAULT_AUTHKEY):
+    self.conn = Client(address, "AF_UNIX", authkey=authkey)
+    # Connections aren't shared between threads, just in case
+    self.lock = Lock()
+
+  def call(self, method, *args):
+    self.lock.acquire()
+    try:
+      self.conn.send_bytes(marshal.dumps((method, args)))
+      ok, result = marshal.loads(self.conn.recv_bytes())
+    finally:
+      self.lock.release()
+
+    if not ok:
+      name, args = result
+      raise REMOTE_ERRORS.get(name, Exception)(*args)
+    return result
+
+  def __getattr__(self, name):
+    if name not in BROKER_METHODS:
+      raise AttributeError(name)
+    return lambda *args: self.call(name, *args)
+
+  def close(self):
+    self.conn.close()
+
+def connect_local(address=DEFAULT_SOCKET, authkey=DEFAULT_AUTHKEY):
+  """ Connect to the broker process listening in the Unix socket
+      @address. """
+  return CLocalConnection(CBrokerClient(address, authkey))
+
+#-----------------------------------------------------------------------
+def serve_client(broker, conn):
+  """ Serve the requests of one client, in its own thread. """
+  try:
+    while 1:
+      try:
+        method, args = marshal.loads(conn.recv_bytes())
+      except LOCAL_SOCKET_ERRORS:
+        break
+
+      try:
+        if method not in BROKER_METHODS:
+          raise ValueError("Unknown queue broker method %s" % repr(method))
+        reply = marshal.dumps((True, getattr(broker, method)(*args)))
+      except Exception, e:
+        try:
+          reply = marshal.dumps((False, (e.__class__.__name__, e.args)))
+        except ValueError:
+          reply = marshal.dumps((False, ("Exception", (str(e), ))))
+
+      try:
+        conn.send_bytes(reply)
+      except LOCAL_SOCKET_ERRORS:
+        break
+  finally:
+    conn.close()
+
+def serve(address=DEFAULT_SOCKET, authkey=DEFAULT_AUTHKEY):
+  try:
+    os.remove(address)
+  except OSError, e:
+    if e.errno != errno.ENOENT:
+      raise
+
+  broker = CMemoryBroker()
+  listener = Listener(address, "AF_UNIX", authkey=authkey)
+  log("Local queue broker listening in %s" % address)
+  try:
+    while 1:
+      try:
+        conn = listener.accept()
+      except (AuthenticationError, EOFError, IOError):
+        log("Rejected queue client: %s" % str(sys.exc_info()[1]))
+        continue
+
+      t = Thread(target=serve_client, args=(broker, conn))
+      t.daemon = True
+      t.start()
+  finally:
+    # It also removes the socket file
+    listener.close()
+
+#-----------------------------------------------------------------------
+def benchmark(conn, total=20000, size=512):
+  """ Measure put, reserve and delete of @total jobs of @size bytes with
+      the queue connection @conn, one by one and in batches. """
+  body = "A" * size
+  conn.use("nfp-benchmark")
+  conn.watch("nfp-benchmark")
+  conn.ignore("default")
+
+  t = time.time()
+  for i in xrange(total):
+    conn.put(body)
+  elapsed = time.time() - t
+  print "put:           %8d jobs/s" % (total / elapsed)
+
+  t = time.time()
+  for i in xrange(total):
+    conn.reserve(0).delete()
+  elapsed = time.time() - t
+  print "reserve+delete:%8d jobs/s" % (total / elapsed)
+
+  t = time.time()
+  for i in xrange(0, total, 100):
+    conn.put_many([body] * 100)
+  for i in xrange(0, total, 100):
+    conn.delete_many([job.jid for job in conn.reserve_many(100, 0)])
+  elapsed = time.time() - t
+  print "batches of 100:%8d jobs/s (put, reserve and delete)" % (total / elapsed)
+
+  t = time.time()
+  for i in xrange(total):
+    conn.stats_tube("nfp-benchmark")
+  elapsed = time.time() - t
+  print "stats_tube:    %8d calls/s" % (total / elapsed)
+
+#-----------------------------------------------------------------------
+def usage():
+  print "Usage:", sys.argv[0], "[-b] [<socket path>]"
+  print
+  print "Without -b, start the broker. With -b, benchmark the broker already"
+  print "listening in the given socket path."
+
+if __name__ == "__main__":
+  args = sys.argv[1:]
+  if len(args) > 0 and args[0] == "-b":
+    if len(args) > 2:
+      usage()
+    else:
+      benchmark(connect_local(*args[1:]))
+  elif len(args) > 1:
+    usage()
+  else:
+    serve(*args)
@@ -0,0 +1,283 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Nightmare Fuzzing Project
+Weighted fair scheduler of the projects to create samples for.
+
+The enabled project engines are cached and only read again from the
+database every REFRESH_INTERVAL seconds or when something changes (i.e.,
+a crash was found, which resets the iteration counter). Projects are
+served with deficit round-robin: every turn a project earns a quantum of
+samples proportional to its weight, which depends on the project's
+priority, the crashes it found recently and how fast its fuzzers consume
+samples. When every tube is full the generator waits on a condition with
+an adaptive timeout instead of polling the queues every 0.1 seconds.
+@author: joxean
+"""
+
+import sys
+import time
+import random
+
+from threading import Lock, Condition
+
+from nfp_log import log, debug
+
+#-----------------------------------------------------------------------
+# Number of seconds after which the project engines are read again
+REFRESH_INTERVAL = 10
+# Half life, in seconds, of the crashes score
+CRASH_HALF_LIFE = 300
+# Weight of the new measures in the consumption rate's moving average
+RATE_ALPHA = 0.3
+# Minimum and maximum number of seconds to wait when every tube is full
+MIN_WAIT = 0.05
+MAX_WAIT = 2
+
+#-----------------------------------------------------------------------
+# Scheduling columns of the projects and the values used when the
+# database wasn't upgraded yet.
+PROJECT_COLUMNS = "p.priority priority, p.job_ttr job_ttr"
+DEFAULT_PROJECT_COLUMNS = "1 priority, 0 job_ttr"
+
+PROJECT_ENGINES_SQL = """ select p.name project_name,
+                                 subfolder,
+                                 tube_prefix,
+                                 command,
+                                 maximum_samples,
+                                 %s,
+                                 p.project_id project_id,
+                                 me.mutation_engine_id mutation_engine_id,
+                                 me.name mutation_generator
+                            from projects p,
+                                 project_engines pe,
+                                 mutation_engines me
+                           where p.project_id = pe.project_id
+                             and me.mutation_engine_id = pe.mutation_engine_id
+                             and p.enabled = 1
+                             and ifnull((select iteration
+                                    from statistics s
+                                   where project_id = p.project_id
+                                     and mutation_engine_id = -1), 0) < p.maximum_iteration
+                           order by p.project_id"""
+
+#-----------------------------------------------------------------------
+class CScheduledProject:
+  def __init__(self, project_id):
+    self.project_id = project_id
+    self.engines = []
+    self.priority = 1
+    self.weight = 1.
+    self.deficit = 0.
+
+    # Crashes found recently, decaying with time
+    self.crash_score = 0.
+    # Samples created since the last refresh and the moving average of
+    # samples per second consumed by the project's fuzzers.
+    self.samples = 0
+    self.rate = 0.
+
+  def __repr__(self):
+    return "<project %d weight %.2f deficit %.2f>" % (self.project_id, self.weight, self.deficit)
+
+#-----------------------------------------------------------------------
+class CProjectScheduler:
+  def __init__(self, db, refresh_interval=REFRESH_INTERVAL, get_projects=None):
+    """ If given, @get_projects returns the set of project identifiers
+        this scheduler is responsible of. """
+    self.db = db
+    self.refresh_interval = refresh_interval
+    self.get_projects = get_projects
+
+    self.lock = Lock()
+    self.condition = Condition(self.lock)
+
+    # project_id -> CScheduledProject
+    self.projects = {}
+    self.ring = []
+    self.current = 0
+    self.credited = False
+
+    self.has_columns = True
+    self.last_refresh = 0
+    self.changed = True
+    self.woken = False
+    self.wait_time = MIN_WAIT
+
+  def read_project_engines(self):
+    if self.has_columns:
+      try:
+        return list(self.db.query(PROJECT_ENGINES_SQL % PROJECT_COLUMNS))
+      except:
+        log("Cannot read projects' priority and job TTR, using the defaults for all: %s" % str(sys.exc_info()[1]))
+        self.has_columns = False
+    return list(self.db.query(PROJECT_ENGINES_SQL % DEFAULT_PROJECT_COLUMNS))
+
+  def refresh_if_needed(self):
+    if self.changed or time.time() - self.last_refresh > self.refresh_interval:
+      self.refresh()
+
+  def refresh(self):
+    rows = self.read_project_engines()
+    if self.get_projects is not None:
+      allowed = self.get_projects()
+      rows = [row for row in rows if row.project_id in allowed]
+
+    self.lock.acquire()
+    try:
+      now = time.time()
+      elapsed = max(now - self.last_refresh, 0.001)
+      first = self.last_refresh == 0
+      self.last_refresh = now
+      self.changed = False
+
+      projects = {}
+      for row in rows:
+        project = projects.get(row.project_id)
+        if project is None:
+          project = self.projects.get(row.project_id)
+          if project is None:
+            project = CScheduledProject(row.project_id)
+          project.engines = []
+          project.priority = max(int(row.priority or 1), 1)
+          projects[row.project_id] = project
+        project.engines.append(row)
+
+      for project in projects.values():
+        if not first:
+          rate = project.samples / elapsed
+          project.rate = RATE_ALPHA * rate + (1 - RATE_ALPHA) * project.rate
+        project.samples = 0
+        project.crash_score *= 0.5 ** (elapsed / CRASH_HALF_LIFE)
+
+      self.projects = projects
+      self.ring = sorted(projects)
+      if self.current >= len(self.ring):
+        self.current = 0
+        self.credited = False
+      self.update_weights()
+    finally:
+      self.lock.release()
+
+    debug("Scheduler refreshed, %d project(s): %s" % (len(self.ring), self.projects.values()))
+
+  def update_weights(self):
+    total_rate = sum([p.rate for p in self.projects.values()])
+    for project in self.projects.values():
+      weight = float(project.priority)
+      weight *= 1 + project.crash_score
+      if total_rate > 0:
+        weight *= 1 + project.rate / total_rate
+      project.weight = weight
+
+  def advance(self):
+    self.current = (self.current + 1) % len(self.ring)
+    self.credited = False
+
+  def next_batch(self, get_pending, batch_size):
+    """ Return the tuple (project engine, total samples) to create next
+        or None if every project's tube is full. The function @get_pending
+        returns the number of jobs the tube of a project engine is
+        missing. It's called without holding the lock, as it asks the
+        queue server, so the crash and delete workers aren't blocked. """
+    self.refresh_if_needed()
+
+    for step in range(2 * len(self.ring)):
+      self.lock.acquire()
+      try:
+        if len(self.ring) == 0:
+          return None
+        project_id = self.ring[self.current]
+        pe = random.choice(self.projects[project_id].engines)
+      finally:
+        self.lock.release()
+
+      pending = get_pending(pe)
+
+      self.lock.acquire()
+      try:
+        project = self.projects.get(project_id)
+        if project is None or len(self.ring) == 0 or \
+           self.ring[self.current] != project_id:
+          # Refreshed while asking the queue server
+          continue
+
+        if pending <= 0:
+          # Idle projects don't accumulate credit
+          project.deficit = 0
+          self.advance()
+          continue
+
+        if not self.credited:
+          project.deficit += batch_size * project.weight
+          self.credited = True
+
+        total = int(min(project.deficit, pending, batch_size))
+        if total < 1:
+          self.advance()
+          continue
+
+        project.deficit -= total
+        self.wait_time = MIN_WAIT
+        return pe, total
+      finally:
+        self.lock.release()
+
+    return None
+
+  def add_samples(self, project_id, total):
+    self.lock.acquire()
+    try:
+      project = self.projects.get(project_id)
+      if project is not None:
+        project.samples += total
+    finally:
+      self.lock.release()
+
+  def crash_found(self, project_id):
+    self.lock.acquire()
+    try:
+      project = self.projects.get(project_id)
+      if project is not None:
+        project.crash_score += 1
+        self.update_weights()
+    finally:
+      self.lock.release()
+    # A crash resets the iteration counter, the project may be back
+    self.invalidate()
+
+  def invalidate(self):
+    """ Force a refresh and wake up the generator. """
+    self.condition.acquire()
+    try:
+      self.changed = True
+      self.condition.notify_all()
+    finally:
+      self.condition.release()
+
+  def wake(self):
+    """ Wake up the generator, some fuzzer consumed samples. """
+    self.condition.acquire()
+    try:
+      self.woken = True
+      self.condition.notify_all()
+    finally:
+      self.condition.release()
+
+  def wait(self):
+    """ Wait until something changes, a fuzzer consumes samples or the
+        adaptive timeout expires. The timeout doubles every time it
+        expires with nothing to do, as not every consumed sample can be
+        noticed (i.e., seeded samples). """
+    self.condition.acquire()
+    try:
+      if not self.changed and not self.woken:
+        self.condition.wait(self.wait_time)
+
+      if self.woken or self.changed:
+        self.wait_time = MIN_WAIT
+      else:
+        self.wait_time = min(self.wait_time * 2, MAX_WAIT)
+      self.woken = False
+    finally:
+      self.condition.release()
@@ -0,0 +1,141 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Nightmare Fuzzing Project
+Coordinated multi-process samples generation.
+
+Instead of running N identical generators racing for the same tubes,
+the enabled projects are partitioned across N generator processes with
+consistent hashing over their tube prefix, and only one more process
+stores the crashes and removes the obsolete files. The parent process
+watches the enabled projects, publishes the assignment in a shared
+dictionary and restarts the processes that die with the same backoff
+used for the fuzzers (see CProcessSupervisor).
+@author: joxean
+"""
+
+import sys
+import time
+import bisect
+
+from hashlib import md5
+from multiprocessing import Manager
+
+from nfp_db import init_web_db
+from nfp_log import log, debug
+from nfp_process import CProcessSupervisor
+
+#-----------------------------------------------------------------------
+# Number of points per shard in the hash ring
+RING_REPLICAS = 100
+# Number of seconds between checks of the enabled projects
+REBALANCE_INTERVAL = 10
+
+#-----------------------------------------------------------------------
+def ring_hash(key):
+  return int(md5(key).hexdigest()[:8], 16)
+
+#-----------------------------------------------------------------------
+class CHashRing:
+  def __init__(self, nodes, replicas=RING_REPLICAS):
+    self.points = []
+    self.nodes = {}
+    for node in nodes:
+      for i in range(replicas):
+        point = ring_hash("%s-%d" % (node, i))
+        self.nodes[point] = node
+        self.points.append(point)
+    self.points.sort()
+
+  def get_node(self, key):
+    if len(self.points) == 0:
+      return None
+    pos = bisect.bisect(self.points, ring_hash(key)) % len(self.points)
+    return self.nodes[self.points[pos]]
+
+#-----------------------------------------------------------------------
+class CShardSupervisor(CProcessSupervisor):
+  """ Supervise the processes of the sharded @engine: the crash ingestion
+      one is the child 0 and the generator of every shard the next ones. """
+  def __init__(self, engine):
+    CProcessSupervisor.__init__(self, engine.total_shards + 1, None, ())
+    self.engine = engine
+
+  def get_child_target(self, child):
+    if child.index == 0:
+      return self.engine.ingest_target, ()
+    return self.engine.generate_target, (self.engine.assignment, child.index - 1)
+
+  def get_child_name(self, child):
+    if child.index == 0:
+      return "ingest"
+    return "shard %d" % (child.index - 1)
+
+  def tick(self):
+    return self.engine.rebalance_if_needed()
+
+#-----------------------------------------------------------------------
+class CShardedEngine:
+  """ Run @total_shards processes calling @generate_target(assignment,
+      shard_id) and one process calling @ingest_target(). The assignment
+      is a shared dictionary of project_id -> shard_id. """
+  def __init__(self, total_shards, generate_target, ingest_target):
+    self.total_shards = total_shards
+    self.generate_target = generate_target
+    self.ingest_target = ingest_target
+    self.ring = CHashRing(range(total_shards))
+
+    self.db = None
+    self.manager = None
+    self.assignment = None
+    self.last_rebalance = 0
+
+  def read_projects(self):
+    what = "project_id, tube_prefix"
+    res = self.db.select("projects", what=what, where="enabled = 1")
+    return dict([(row.project_id, row.tube_prefix) for row in res])
+
+  def rebalance(self):
+    self.last_rebalance = time.time()
+    assignment = {}
+    for project_id, tube_prefix in self.read_projects().items():
+      assignment[project_id] = self.ring.get_node(str(tube_prefix))
+
+    current = dict(self.assignment)
+    if assignment == current:
+      return
+
+    for project_id in set(current) - set(assignment):
+      del self.assignment[project_id]
+    for project_id, shard_id in assignment.items():
+      if current.get(project_id) != shard_id:
+        self.assignment[project_id] = shard_id
+
+    for shard_id in range(self.total_shards):
+      total = assignment.values().count(shard_id)
+      log("Shard %d has %d project(s) assigned" % (shard_id, total))
+
+  def rebalance_if_needed(self):
+    """ Rebalance the projects every REBALANCE_INTERVAL seconds. Return
+        the number of seconds until the next time. """
+    if time.time() - self.last_rebalance >= REBALANCE_INTERVAL:
+      try:
+        self.rebalance()
+      except:
+        self.last_rebalance = time.time()
+        log("Error rebalancing projects: %s" % str(sys.exc_info()[1]))
+    return self.last_rebalance + REBALANCE_INTERVAL - time.time()
+
+  def run(self):
+    self.db = init_web_db()
+    self.db.printing = False
+    self.manager = Manager()
+    self.assignment = self.manager.dict()
+    self.rebalance()
+
+    log("Starting %d generator(s) and one crash ingestion process..." % self.total_shards)
+    try:
+      # Stops the processes on SIGTERM or Ctrl+C
+      CShardSupervisor(self).run()
+    finally:
+      self.manager.shutdown()
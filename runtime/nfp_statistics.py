@@ -0,0 +1,183 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Nightmare Fuzzing Project
+Write-behind aggregator for the 'statistics' table.
+
+Instead of reading and updating the statistics rows for every single
+sample, counters are accumulated in memory per (project, mutation engine)
+and flushed to the database with one select and one transaction every
+@flush_samples samples or every @flush_interval seconds, whatever happens
+first. Resets of the iteration counter (done when a crash is found) are
+also written behind, as well as the target depth of the projects' samples
+tubes (the rows with mutation_engine_id -2). The pending counters must be
+flushed before exiting.
+@author: joxean
+"""
+
+import sys
+import time
+
+from threading import Lock
+
+from nfp_log import log, debug
+
+#-----------------------------------------------------------------------
+DEFAULT_FLUSH_SAMPLES = 100
+DEFAULT_FLUSH_INTERVAL = 5
+
+#-----------------------------------------------------------------------
+class CStatisticsAggregator:
+  def __init__(self, db, flush_samples=DEFAULT_FLUSH_SAMPLES,
+               flush_interval=DEFAULT_FLUSH_INTERVAL):
+    self.db = db
+    self.flush_samples = flush_samples
+    self.flush_interval = flush_interval
+
+    self.lock = Lock()
+    self.flush_lock = Lock()
+    # (project_id, mutation_engine_id) -> number of new samples
+    self.totals = {}
+    # project_id -> number of new iterations
+    self.iterations = {}
+    # projects whose iteration counter must be reset
+    self.resets = set()
+    # project_id -> target depth of the project's samples tube
+    self.depths = {}
+    self.pending = 0
+    self.last_flush = time.time()
+
+  def add(self, project_id, mutation_engine_id, total=1):
+    self.lock.acquire()
+    try:
+      key = (project_id, mutation_engine_id)
+      self.totals[key] = self.totals.get(key, 0) + total
+      self.iterations[project_id] = self.iterations.get(project_id, 0) + total
+      self.pending += total
+    finally:
+      self.lock.release()
+
+    self.flush_if_needed()
+
+  def reset_iteration(self, project_id):
+    """ Forget the not yet flushed iterations of @project_id and reset
+        its iteration counter with the next flush. """
+    self.lock.acquire()
+    try:
+      self.iterations.pop(project_id, None)
+      self.resets.add(project_id)
+    finally:
+      self.lock.release()
+
+  def set_queue_depth(self, project_id, target):
+    """ Record the current target depth of the project's samples tube,
+        stored in the statistics row with mutation_engine_id -2. """
+    self.lock.acquire()
+    try:
+      self.depths[project_id] = target
+    finally:
+      self.lock.release()
+
+  def flush_if_needed(self):
+    if self.pending >= self.flush_samples or \
+       ((self.pending > 0 or len(self.resets) > 0 or len(self.depths) > 0) and \
+        time.time() - self.last_flush >= self.flush_interval):
+      self.flush()
+
+  def read_statistic_ids(self, project_ids):
+    ret = {}
+    if len(project_ids) == 0:
+      return ret
+
+    where = "project_id in (%s)" % ", ".join(map(str, map(int, project_ids)))
+    what = "statistic_id, project_id, mutation_engine_id"
+    for row in self.db.select("statistics", what=what, where=where):
+      ret[(row.project_id, row.mutation_engine_id)] = row.statistic_id
+    return ret
+
+  def flush(self):
+    self.flush_lock.acquire()
+    try:
+      self.lock.acquire()
+      try:
+        totals, self.totals = self.totals, {}
+        iterations, self.iterations = self.iterations, {}
+        resets, self.resets = self.resets, set()
+        depths, self.depths = self.depths, {}
+        self.pending = 0
+        self.last_flush = time.time()
+      finally:
+        self.lock.release()
+
+      if len(totals) == 0 and len(iterations) == 0 and len(resets) == 0 and \
+         len(depths) == 0:
+        return
+
+      try:
+        self.write(totals, iterations, resets, depths)
+      except:
+        log("Error flushing statistics: %s" % str(sys.exc_info()[1]))
+        self.restore(totals, iterations, resets, depths)
+    finally:
+      self.flush_lock.release()
+
+  def write(self, totals, iterations, resets, depths={}):
+    project_ids = set(iterations)
+    project_ids.update([key[0] for key in totals])
+    project_ids.update(depths)
+    ids = self.read_statistic_ids(project_ids)
+
+    debug("Flushing statistics for %d project engine(s)" % len(totals))
+    with self.db.transaction():
+      for project_id in resets:
+        vars = {"project_id":project_id}
+        where = "project_id = $project_id and mutation_engine_id = -1"
+        self.db.update("statistics", iteration=0, where=where, vars=vars)
+
+      for key, total in totals.items():
+        project_id, mutation_engine_id = key
+        if key in ids:
+          sql = """update statistics
+                      set total = total + $total,
+                          iteration = iteration + $total
+                    where statistic_id = $id"""
+          self.db.query(sql, vars={"total":total, "id":ids[key]})
+        else:
+          self.db.insert("statistics", project_id=project_id,
+                         mutation_engine_id=mutation_engine_id, total=total)
+
+      for project_id, total in iterations.items():
+        key = (project_id, -1)
+        if key in ids:
+          sql = """update statistics
+                      set iteration = ifnull(iteration, 0) + $total
+                    where statistic_id = $id"""
+          self.db.query(sql, vars={"total":total, "id":ids[key]})
+        else:
+          self.db.insert("statistics", project_id=project_id,
+                         mutation_engine_id=-1, total=0, iteration=total)
+
+      for project_id, target in depths.items():
+        key = (project_id, -2)
+        if key in ids:
+          where = "statistic_id = $id"
+          self.db.update("statistics", total=target, where=where, vars={"id":ids[key]})
+        else:
+          self.db.insert("statistics", project_id=project_id,
+                         mutation_engine_id=-2, total=target, iteration=0)
+
+  def restore(self, totals, iterations, resets, depths={}):
+    # Put back the counters we failed to write so they are retried with
+    # the next flush.
+    self.lock.acquire()
+    try:
+      for project_id, target in depths.items():
+        self.depths.setdefault(project_id, target)
+      for key, total in totals.items():
+        self.totals[key] = self.totals.get(key, 0) + total
+        self.pending += total
+      for project_id, total in iterations.items():
+        self.iterations[project_id] = self.iterations.get(project_id, 0) + total
+      self.resets.update(resets)
+    finally:
+      self.lock.release()
@@ -0,0 +1,193 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Nightmare Fuzzing Project
+In-memory index of template files.
+
+Listing a directory with many thousands of templates for every sample is
+more expensive than mutating the sample itself. The index is built only
+once per directory and refreshed incrementally when the directory's
+modification time changes, statting only the new files. Random selection
+is O(1) even when it's weighted (e.g. preferring small templates) as it
+uses the alias method over the precomputed weights.
+@author: joxean
+"""
+
+import os
+import stat
+import time
+import random
+
+from hashlib import sha1
+
+from nfp_log import log, debug
+
+#-----------------------------------------------------------------------
+# Minimum number of seconds between checks of the directory's mtime
+CHECK_INTERVAL = 1
+# Force a full rescan every this number of seconds, in case the file
+# system's timestamps are too coarse to notice some change.
+RESCAN_INTERVAL = 300
+
+# Supported weighting modes
+WEIGHTING_UNIFORM = "uniform"
+WEIGHTING_SMALL = "small"
+
+#-----------------------------------------------------------------------
+def build_alias_table(weights):
+  """ Build the probability and alias tables for Vose's alias method. """
+  total = len(weights)
+  weights_sum = float(sum(weights))
+  prob = [w * total / weights_sum for w in weights]
+  alias = [0] * total
+
+  small = [i for i in range(total) if prob[i] < 1]
+  large = [i for i in range(total) if prob[i] >= 1]
+  while len(small) > 0 and len(large) > 0:
+    s = small.pop()
+    l = large.pop()
+    alias[s] = l
+    prob[l] = prob[l] + prob[s] - 1
+    if prob[l] < 1:
+      small.append(l)
+    else:
+      large.append(l)
+
+  for i in small + large:
+    prob[i] = 1
+
+  return prob, alias
+
+#-----------------------------------------------------------------------
+class CTemplatesIndex:
+  def __init__(self, path, weighting=WEIGHTING_UNIFORM):
+    self.path = path
+    self.weighting = weighting
+
+    # Dictionary of filename -> [size, mtime, sha1 hash or None]
+    self.files = {}
+    # Dictionary of sha1 hash -> filename, filled lazily by find_hash
+    self.hashes = {}
+    self.names = []
+    self.prob = []
+    self.alias = []
+
+    self.mtime = None
+    self.last_check = 0
+    self.last_rescan = 0
+
+  def refresh(self, force=False):
+    now = time.time()
+    if not force and now - self.last_check < CHECK_INTERVAL:
+      return False
+    self.last_check = now
+
+    mtime = os.stat(self.path).st_mtime
+    if not force and mtime == self.mtime and now - self.last_rescan < RESCAN_INTERVAL:
+      return False
+
+    self.mtime = mtime
+    self.last_rescan = now
+
+    names = set(os.listdir(self.path))
+    for name in set(self.files) - names:
+      del self.files[name]
+
+    added = 0
+    for name in names - set(self.files):
+      try:
+        st = os.stat(os.path.join(self.path, name))
+      except OSError:
+        continue
+
+      if stat.S_ISREG(st.st_mode):
+        self.files[name] = [st.st_size, st.st_mtime, None]
+        added += 1
+
+    debug("Templates index for %s refreshed, %d file(s), %d new" % (self.path, len(self.files), added))
+    self.build_tables()
+    return True
+
+  def get_weight(self, name):
+    if self.weighting == WEIGHTING_SMALL:
+      return 1. / max(self.files[name][0], 1)
+    return 1.
+
+  def build_tables(self):
+    self.names = list(self.files)
+    if self.weighting == WEIGHTING_UNIFORM or len(self.names) == 0:
+      self.prob = []
+      self.alias = []
+    else:
+      weights = map(self.get_weight, self.names)
+      self.prob, self.alias = build_alias_table(weights)
+
+  def choose(self):
+    """ Return the full path of a randomly selected template. """
+    self.refresh()
+    if len(self.names) == 0:
+      raise Exception("No template files in %s" % self.path)
+
+    i = random.randrange(len(self.names))
+    if len(self.prob) > 0 and random.random() >= self.prob[i]:
+      i = self.alias[i]
+    return os.path.join(self.path, self.names[i])
+
+  def get_size(self, filename):
+    return self.files[os.path.basename(filename)][0]
+
+  def get_hash(self, filename):
+    """ Return the SHA1 hash of the template @filename, calculating it
+        only the first time or if the file was modified. """
+    name = os.path.basename(filename)
+    entry = self.files[name]
+    path = os.path.join(self.path, name)
+    st = os.stat(path)
+    if entry[2] is None or st.st_mtime != entry[1] or st.st_size != entry[0]:
+      entry[0] = st.st_size
+      entry[1] = st.st_mtime
+      entry[2] = sha1(open(path, "rb").read()).hexdigest()
+    return entry[2]
+
+  def find_hash(self, template_hash):
+    """ Return the full path of the template whose SHA1 hash is
+        @template_hash or None if there is no such template. """
+    self.refresh()
+    name = self.hashes.get(template_hash)
+    if name in self.files and self.get_hash(name) == template_hash:
+      return os.path.join(self.path, name)
+
+    # Unknown or modified template, hash the whole directory
+    debug("Hashing templates in %s" % self.path)
+    self.hashes = {}
+    for name in list(self.files):
+      try:
+        self.hashes[self.get_hash(name)] = name
+      except (IOError, OSError):
+        continue
+
+    name = self.hashes.get(template_hash)
+    if name is None:
+      return None
+    return os.path.join(self.path, name)
+
+#-----------------------------------------------------------------------
+class CTemplatesCache:
+  """ Templates indexes for every project's templates subfolder. """
+  def __init__(self, base_path, weighting=WEIGHTING_UNIFORM):
+    self.base_path = base_path
+    self.weighting = weighting
+    self.indexes = {}
+
+  def get_index(self, folder):
+    index = self.indexes.get(folder)
+    if index is None:
+      path = os.path.join(self.base_path, folder)
+      log("Building templates index for %s" % path)
+      index = CTemplatesIndex(path, self.weighting)
+      index.refresh(force=True)
+      self.indexes[folder] = index
+    return index
+
+  def choose(self, folder):
+    return self.get_index(folder).choose()
@@ -0,0 +1,258 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Nightmare Fuzzing Project
+Automatic calibration of the targets' timeouts.
+
+Instead of a fixed timeout (90 seconds by default) the wall time of every
+execution is recorded in a rolling histogram and the timeout is set to
+the 99th percentile multiplied by timeout-multiplier, never lower than
+timeout-minimum and never higher than the configured timeout. The first
+run, the generic fuzzer calibrates it running a sample of the templates.
+Executions timing out aren't recorded: hangs don't make the timeout
+grow, only the executions finishing do.
+
+Calibrations are per target and way of running it (i.e., the fork server
+and the debuggers have a very different overhead) and are persisted, by
+default, in the file <configuration file>.timeouts, so the next run (or
+the other workers) starts already calibrated.
+@author: joxean
+"""
+
+import os
+import sys
+import math
+import json
+import time
+import tempfile
+
+from collections import deque
+
+from nfp_log import log, debug
+
+#-----------------------------------------------------------------------
+DEFAULT_MULTIPLIER = 5
+DEFAULT_MIN_TIMEOUT = 1
+# Maximum timeout used when the configured one is "auto"
+DEFAULT_AUTO_TIMEOUT = 60
+
+PERCENTILE = 99
+# Number of executions in the rolling histogram
+WINDOW_SIZE = 1000
+# Executions required before calibrating the timeout
+MIN_SAMPLES = 20
+# Templates run by the generic fuzzer to calibrate the timeout
+CALIBRATION_SAMPLES = 20
+# Executions between every recalculation of the timeout
+UPDATE_INTERVAL = 50
+# Minimum number of seconds between every write of the state file
+SAVE_INTERVAL = 60
+
+# Buckets of the histogram, growing exponentially from 1 millisecond.
+# The last one is a bit more than 23 days.
+BUCKET_BASE = 0.001
+BUCKET_RATIO = 1.25
+BUCKETS = 96
+
+#-----------------------------------------------------------------------
+def get_bucket(elapsed):
+  if elapsed <= BUCKET_BASE:
+    return 0
+  bucket = int(math.log(elapsed / BUCKET_BASE) / math.log(BUCKET_RATIO))
+  return min(bucket, BUCKETS - 1)
+
+def get_bucket_limit(bucket):
+  """ Return the upper limit, in seconds, of the bucket @bucket. """
+  return BUCKET_BASE * BUCKET_RATIO ** (bucket + 1)
+
+def get_state_file(cfg):
+  return "%s.timeouts" % os.path.abspath(cfg)
+
+#-----------------------------------------------------------------------
+class CTimeoutCalibrator:
+  """ Calibrate the timeout of the target @name, persisting it in the
+      JSON file @state_file. The timeout is the p99 of the last
+      WINDOW_SIZE executions multiplied by @multiplier, between @minimum
+      and @maximum seconds. """
+  def __init__(self, name, state_file, maximum, multiplier=DEFAULT_MULTIPLIER,
+               minimum=DEFAULT_MIN_TIMEOUT):
+    self.name = name
+    self.state_file = state_file
+    self.maximum = maximum
+    self.multiplier = multiplier
+    self.minimum = min(minimum, maximum)
+
+    self.counts = [0] * BUCKETS
+    self.window = deque()
+    self.timeout = None
+    self.hangs = 0
+    self.runs = 0
+
+    self.pending = 0
+    self.dirty = False
+    self.last_save = time.time()
+    self.save_failed = False
+    self.load()
+
+  def get_settings(self):
+    return (self.name, self.state_file, self.maximum, self.multiplier,
+            self.minimum)
+
+  def is_calibrated(self):
+    return self.timeout is not None
+
+  def get_timeout(self):
+    """ Return the calibrated timeout or the maximum one if it isn't
+        calibrated yet. """
+    if self.timeout is None:
+      return self.maximum
+    return self.timeout
+
+  def add_bucket(self, bucket):
+    if len(self.window) == WINDOW_SIZE:
+      self.counts[self.window.popleft()] -= 1
+    self.window.append(bucket)
+    self.counts[bucket] += 1
+
+  def add(self, elapsed, timed_out=False):
+    """ Record an execution that took @elapsed seconds. """
+    self.runs += 1
+    if timed_out:
+      self.hangs += 1
+    else:
+      self.add_bucket(get_bucket(elapsed))
+      self.pending += 1
+      self.dirty = True
+
+    if (self.timeout is None and len(self.window) >= MIN_SAMPLES) or \
+       self.pending >= UPDATE_INTERVAL:
+      self.update()
+
+    if self.dirty and time.time() - self.last_save >= SAVE_INTERVAL:
+      self.save()
+
+  def get_percentile(self, percentile=PERCENTILE):
+    """ Return the upper limit of the histogram's bucket where the given
+        @percentile of the executions is or None if it's empty. """
+    total = len(self.window)
+    if total == 0:
+      return None
+
+    wanted = int(math.ceil(total * percentile / 100.))
+    seen = 0
+    for bucket in xrange(BUCKETS):
+      seen += self.counts[bucket]
+      if seen >= wanted:
+        return get_bucket_limit(bucket)
+    return get_bucket_limit(BUCKETS - 1)
+
+  def update(self):
+    self.pending = 0
+    if len(self.window) < MIN_SAMPLES:
+      return
+
+    p99 = self.get_percentile()
+    timeout = p99 * self.multiplier
+    timeout = min(max(timeout, self.minimum), self.maximum)
+    # The debugging interfaces only support whole seconds
+    timeout = int(math.ceil(timeout))
+    if timeout != self.timeout:
+      line = "Timeout of %s set to %d second(s), p%d %.3f second(s)"
+      line = line % (self.name, timeout, PERCENTILE, p99)
+      if self.runs > 0:
+        line += ", %d hang(s) in %d run(s)" % (self.hangs, self.runs)
+      log(line)
+      self.timeout = timeout
+
+  def load(self):
+    try:
+      with open(self.state_file, "rb") as f:
+        state = json.load(f).get(self.name)
+    except (IOError, ValueError):
+      return
+
+    if state is None or len(state.get("histogram", [])) != BUCKETS:
+      return
+
+    for bucket, count in enumerate(state["histogram"]):
+      for i in xrange(count):
+        self.add_bucket(bucket)
+
+    # Calculated again, the multiplier or the limits may have changed
+    self.update()
+    debug("Loaded %d execution(s) of %s from %s" % (len(self.window), self.name, self.state_file))
+
+  def save(self):
+    """ Write our histogram in the state file, keeping the ones of the
+        other targets. With many workers the last one writing wins. """
+    self.last_save = time.time()
+    self.dirty = False
+    try:
+      try:
+        with open(self.state_file, "rb") as f:
+          states = json.load(f)
+      except (IOError, ValueError):
+        states = {}
+
+      states[self.name] = {"timeout":self.timeout,
+                           "histogram":self.counts,
+                           "updated":int(time.time())}
+
+      # Written in a new file and then renamed, so readers never see a
+      # partially written file.
+      fd, filename = tempfile.mkstemp(prefix=".nfp-timeouts-",
+                                      dir=os.path.dirname(self.state_file))
+      with os.fdopen(fd, "wb") as f:
+        json.dump(states, f)
+      os.rename(filename, self.state_file)
+    except (IOError, OSError):
+      if not self.save_failed:
+        log("Cannot save the timeouts in %s: %s" % (self.state_file, str(sys.exc_info()[1])))
+        self.save_failed = True
+
+  def close(self):
+    if self.dirty:
+      self.save()
+
+#-----------------------------------------------------------------------
+def read_timeout_calibrator(parser, section, cfg, name, timeout, current=None):
+  """ Return the timeout calibrator of the target @name configured in the
+      section @section of the config parser @parser, or None if the
+      timeout isn't calibrated. The @timeout configured is the maximum.
+      The @current calibrator is returned if its settings didn't change. """
+  try:
+    enabled = parser.getboolean(section, 'calibrate-timeout')
+  except:
+    enabled = False
+
+  if not enabled:
+    if current is not None:
+      current.close()
+    return None
+
+  if str(timeout).lower() == "auto":
+    maximum = DEFAULT_AUTO_TIMEOUT
+  else:
+    maximum = float(timeout)
+
+  try:
+    multiplier = parser.getfloat(section, 'timeout-multiplier')
+  except:
+    multiplier = DEFAULT_MULTIPLIER
+
+  try:
+    minimum = parser.getfloat(section, 'timeout-minimum')
+  except:
+    minimum = DEFAULT_MIN_TIMEOUT
+
+  try:
+    state_file = os.path.abspath(parser.get(section, 'timeout-state'))
+  except:
+    state_file = get_state_file(cfg)
+
+  settings = (name, state_file, maximum, multiplier, min(minimum, maximum))
+  if current is not None:
+    if current.get_settings() == settings:
+      return current
+    current.close()
+  return CTimeoutCalibrator(name, state_file, maximum, multiplier, minimum)
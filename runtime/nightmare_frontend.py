@@ -259,13 +259,17 @@ class add_project:
     
     i = web.input(name="", description="", subfolder="", tube_prefix="",
                   max_files=100, max_iteration=1000000,
-                  ignore_duplicates=0)
+                  ignore_duplicates=0, priority=1, job_ttr=0)
     if i.name == "":
       return render.error("No project name specified")
     elif i.description == "":
       return render.error("No project description specified")
     elif i.tube_prefix == "":
       return render.error("Invalid tube prefix")
+    elif not str(i.priority).isdigit() or int(i.priority) < 1:
+      return render.error("Invalid priority")
+    elif not str(i.job_ttr).isdigit():
+      return render.error("Invalid job TTR")
     
     if i.ignore_duplicates == "on":
       ignore_duplicates = 1
@@ -279,7 +283,8 @@ class add_project:
               maximum_samples=i.max_files, archived=0,
               maximum_iteration=i.max_iteration,
               date=web.SQLLiteral("CURRENT_DATE"),
-              ignore_duplicates=ignore_duplicates)
+              ignore_duplicates=ignore_duplicates,
+              priority=i.priority, job_ttr=i.job_ttr)
 
     return web.redirect("/projects")
 
@@ -291,7 +296,7 @@ class edit_project:
       return render.login(f)
     i = web.input(id=-1, name="", description="", subfolder="",
                   tube_prefix="", enabled="", archived="",
-                  ignore_duplicates=0)
+                  ignore_duplicates=0, priority=1, job_ttr=0)
     if i.id == -1:
       return render.error("Invalid project identifier")
     elif i.name == "":
@@ -300,6 +305,10 @@ class edit_project:
       return render.error("No project description specified")
     elif i.tube_prefix == "":
       return render.error("No tube prefix specified")
+    elif not str(i.priority).isdigit() or int(i.priority) < 1:
+      return render.error("Invalid priority")
+    elif not str(i.job_ttr).isdigit():
+      return render.error("Invalid job TTR")
 
     if i.enabled == "on":
       enabled = 1
@@ -326,6 +335,7 @@ class edit_project:
                 maximum_iteration=i.max_iteration,
                 archived=archived, where="project_id = $project_id",
                 ignore_duplicates=ignore_duplicates,
+                priority=i.priority, job_ttr=i.job_ttr,
                 vars={"project_id":i.id})
     return web.redirect("/projects")
   
@@ -340,7 +350,7 @@ class edit_project:
     db = init_web_db()
     what = """project_id, name, description, subfolder, tube_prefix,
               maximum_samples, enabled, date, archived,
-              maximum_iteration, ignore_duplicates """
+              maximum_iteration, ignore_duplicates, priority, job_ttr """
     where = "project_id = $project_id"
     vars = {"project_id":i.id}
     res = db.select("projects", what=what, where=where, vars=vars)
@@ -839,7 +849,13 @@ class statistics:
                         from statistics st
                        where st.project_id = p.project_id
                          and st.mutation_engine_id = -1
-                     ) iteration
+                     ) iteration,
+                     ifnull((
+                      select total
+                        from statistics st
+                       where st.project_id = p.project_id
+                         and st.mutation_engine_id = -2
+                     ), p.maximum_samples) queue_depth
                 from statistics s,
                      projects p,
                      mutation_engines m
@@ -848,7 +864,7 @@ class statistics:
                  and p.enabled = 1
                group by p.name """
     db = init_web_db()
-    project_stats = db.query(sql)
+    project_stats = list(db.query(sql))
 
     sql = """ select distinct exploitability, count(*) count
                 from crashes c,
@@ -889,9 +905,9 @@ class statistics:
 
     tubes = {}
     q = get_queue(watch=True, name="delete")
-    for tube in q.tubes():
-      if tube != "default":
-        tubes[tube] = q.stats_tube(tube)["current-jobs-ready"]
+    names = [tube for tube in q.tubes() if tube != "default"]
+    for tube, stats in q.stats_tubes(names).items():
+      tubes[tube] = stats["current-jobs-ready"]
 
     return render.statistics(project_stats, exploitables, signals, disassemblies, bugs, tubes)
 
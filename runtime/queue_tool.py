@@ -2,12 +2,15 @@
 
 import os
 import sys
-import json
-import base64
 import tempfile
 
 from nfp_log import log
 from nfp_queue import get_queue
+from nfp_frame import encode_sample
+
+#-----------------------------------------------------------------------
+# Number of jobs reserved and deleted at once when emptying a queue
+EMPTY_BATCH_SIZE = 256
 
 #-----------------------------------------------------------------------
 class CFileQueuer:
@@ -28,8 +31,7 @@ class CFileQueuer:
       with open(temp_file, "wb") as f:
         f.write(buf)
 
-      json_buf = json.dumps([base64.b64encode(buf), temp_file])
-      self.q.put(json_buf)
+      self.q.put(encode_sample(buf, temp_file))
       l = "File '%s' put in queue %s as temporary file '%s'"
       log(l % (filename, self.tube_prefix, temp_file))
     except:
@@ -39,14 +41,15 @@ class CFileQueuer:
 #-----------------------------------------------------------------------
 def list_queues():
   q = get_queue(watch=False, name="default")
-  for tube in q.tubes():
-    if tube not in ["default"]:
+  tubes = [tube for tube in q.tubes() if tube not in ["default"]]
+  stats = q.stats_tubes(tubes)
+  for tube in tubes:
+    if tube in stats:
       line = "Tube %s, total of %d job(s)"
-      try:
-        print line % (tube, q.stats_tube(tube)["current-jobs-ready"])
-      except:
-        sys.stderr.write("Error reading tube %s: %s\n" % (tube, str(sys.exc_info()[1])))
-        sys.stderr.flush()
+      print line % (tube, stats[tube]["current-jobs-ready"])
+    else:
+      sys.stderr.write("Error reading tube %s\n" % tube)
+      sys.stderr.flush()
 
 #-----------------------------------------------------------------------
 def empty_queue():
@@ -57,10 +60,10 @@ def empty_queue():
     q = get_queue(watch=True, name=tube)
 
     while 1:
-      job = q.reserve(1)
-      if not job:
+      jobs = q.reserve_many(EMPTY_BATCH_SIZE, 1)
+      if len(jobs) == 0:
         break
-      job.delete()
+      q.delete_many(jobs)
 
 #-----------------------------------------------------------------------
 def check_command(cmd):